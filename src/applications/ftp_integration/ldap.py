@@ -1,22 +1,229 @@
 import logging
+import queue
 import re
+import threading
 import unicodedata
+from collections import Counter, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Generator, Iterable
 
 import ldap
 from django.conf import settings
+from ldap.cidict import cidict
+from ldap.controls import SimplePagedResultsControl
+from ldap.dn import str2dn
+from ldap.filter import escape_filter_chars
 from ldap.ldapobject import ReconnectLDAPObject
 from ldap.modlist import addModlist, modifyModlist
 
-from applications.ftp_integration.utils import launch_ssh_command
+from applications.ftp_integration.utils import (
+    KeyOrderedExecutor,
+    launch_ssh_command,
+    launch_ssh_powershell_batch,
+    powershell_quote,
+)
 
 logger = logging.getLogger(__name__)
 
+ResultCallback = Callable[[ldap.LDAPError | None], None]
+
+
+class PasswordResetError(ldap.LDAPError):
+    """
+    The user was created but its initial password could not be set, it is set again when its creation is retried
+    """
+
+
+def raise_on_error(error: ldap.LDAPError | None):
+    if error is not None:
+        raise error
+
+
+class LDAPWritePipeline:
+    """
+    Send asynchronous write operations on a bound connection,
+    keeping at most `window` of them waiting for their result.
+    Each result is given back to the callback of its operation, with the LDAPError raised if any
+    """
+
+    def __init__(
+        self,
+        connection: ldap.ldapobject.LDAPObject,
+        window: int,
+        count_operation: Callable[[str], None] = None,
+    ):
+        self.connection = connection
+        self.window = window
+        self.count_operation = count_operation
+        self.pending: deque[tuple[int, ResultCallback]] = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.flush()
+
+    def submit(self, method_name: str, dn: str, *args, callback: ResultCallback):
+        """
+        Call the asynchronous `method_name` of the connection (add, modify, delete, passwd)
+        """
+        while len(self.pending) >= self.window:
+            self.wait_oldest()
+        logger.debug(f"{method_name} {dn} {args}")
+        if self.count_operation is not None:
+            self.count_operation(method_name)
+        msgid = getattr(self.connection, method_name)(dn, *args)
+        self.pending.append((msgid, callback))
+
+    def wait_oldest(self):
+        msgid, callback = self.pending.popleft()
+        try:
+            self.connection.result3(msgid)
+        except ldap.LDAPError as e:
+            callback(e)
+        else:
+            callback(None)
+
+    def flush(self):
+        while self.pending:
+            self.wait_oldest()
+
+
+class LDAPPooledWrites:
+    """
+    Run synchronous write methods of an integration by worker threads, each one using a connection of its pool,
+    the writes of a same user in submission order, keeping at most `window` of them waiting for their result.
+    Like LDAPWritePipeline, each result is given back to the callback of its write,
+    in submission order and on the submitting thread
+    """
+
+    def __init__(self, integration: "BaseLDAPIntegration", window: int):
+        self.integration = integration
+        self.window = window
+        self.executor = KeyOrderedExecutor(integration.pool_size)
+        self.pending: deque[tuple[Future, ResultCallback]] = deque()
+
+    def __enter__(self):
+        self.executor.__enter__()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.executor.__exit__(exc_type, *args)
+
+    def submit(
+        self, user_id: str, method_name: str, *args, callback: ResultCallback, **kwargs
+    ):
+        """
+        Call the synchronous `method_name` of the integration (update_ldap_user, delete_ldap_user...)
+        """
+        while len(self.pending) >= self.window:
+            self.wait_oldest()
+        future = self.executor.submit(user_id, self.run, method_name, *args, **kwargs)
+        self.pending.append((future, callback))
+
+    def run(self, method_name: str, *args, **kwargs) -> ldap.LDAPError | None:
+        with self.integration.checkout_connection():
+            try:
+                getattr(self.integration, method_name)(*args, **kwargs)
+            except ldap.LDAPError as e:
+                return e
+        return None
+
+    def wait_oldest(self):
+        future, callback = self.pending.popleft()
+        callback(future.result())
+
+    def flush(self):
+        while self.pending:
+            self.wait_oldest()
+
+
+class LDAPConnectionPool:
+    """
+    Pool of bound connections, each one being used by a single thread at a time
+    """
+
+    def __init__(self, connect: Callable[[], ldap.ldapobject.LDAPObject], size: int):
+        self.connections: queue.Queue[ldap.ldapobject.LDAPObject] = queue.Queue()
+        for _ in range(size):
+            self.connections.put(connect())
+
+    @contextmanager
+    def checkout(self) -> Generator[ldap.ldapobject.LDAPObject, None, None]:
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get_nowait().unbind_s()
+
+
+class HomonymAllocator:
+    """
+    Allocate names by adding the lowest number suffix not already taken.
+    Allocated names are reserved, so that homonyms created during the same run don't collide
+    """
+
+    def __init__(self):
+        self.reserved: set[str] = set()
+        self.lock = threading.Lock()
+
+    def allocate(self, name: str, taken_names: Iterable[str]) -> str:
+        # LDAP names are case-insensitive
+        taken_names = {taken_name.lower() for taken_name in taken_names}
+        with self.lock:
+            candidate = name
+            suffix = 0
+            while (
+                candidate.lower() in taken_names or candidate.lower() in self.reserved
+            ):
+                suffix += 1
+                candidate = f"{name}{suffix}"
+            self.reserved.add(candidate.lower())
+        return candidate
+
 
 class BaseLDAPIntegration:
     user_id_attribute = None
+    # attributes read by the integration, the only ones requested when searching users
+    managed_attributes = ["givenName", "sn", "displayName", "mail"]
 
-    def __init__(self):
+    def __init__(self, use_snapshot: bool = None, pool_size: int = None):
         self.connection: ldap.ldapobject.LDAPObject = None
+        self.use_snapshot = (
+            settings.LDAP_USE_SNAPSHOT if use_snapshot is None else use_snapshot
+        )
+        self.pool_size = settings.LDAP_POOL_SIZE if pool_size is None else pool_size
+        self.pool: LDAPConnectionPool | None = None
+        # connections checked out of the pool by worker threads
+        self.thread_connections = threading.local()
+        # number of nested context managers, the connection is shared between them
+        self.depth = 0
+        # number of LDAP requests sent, by operation
+        self.operation_counts: Counter[str] = Counter()
+        self.operation_counts_lock = threading.Lock()
+        # index of every user under USERS_DN, only loaded in snapshot mode
+        # maps the normalized user id to (dn, attributes)
+        self.snapshot: dict[str, tuple[str, cidict]] | None = None
+        # users searched in advance by prefetch_ldap_users, None for those not found
+        self.prefetched: dict[str, tuple[str, cidict] | None] = {}
+
+    @property
+    def connection(self) -> ldap.ldapobject.LDAPObject:
+        return getattr(self.thread_connections, "connection", self.main_connection)
+
+    @connection.setter
+    def connection(self, connection: ldap.ldapobject.LDAPObject):
+        self.main_connection = connection
 
     def assert_connection(self):
         assert (
@@ -26,8 +233,54 @@ class BaseLDAPIntegration:
         )
 
     def __enter__(self):
+        self.depth += 1
+        if self.depth > 1:
+            return self
+        self.connection = self.connect()
+        if self.use_snapshot:
+            self.load_snapshot()
+        return self
+
+    def __exit__(self, *args):
+        self.depth -= 1
+        if self.depth:
+            return
+        logger.info(f"LDAP operations sent: {dict(self.operation_counts)}")
+        self.snapshot = None
+        self.prefetched = {}
+        self.connection.unbind_s()
+
+    @contextmanager
+    def open_pool(self):
+        """
+        Bind the connections of the pool, only while writes are processed in parallel
+        """
+        self.assert_connection()
+        assert self.pool is None, "the connection pool is already open"
+        self.pool = LDAPConnectionPool(self.connect, self.pool_size)
+        try:
+            yield self.pool
+        finally:
+            self.pool.close()
+            self.pool = None
+
+    @contextmanager
+    def checkout_connection(self):
+        """
+        Use a connection of the pool for the LDAP operations of the current thread
+        """
+        self.assert_connection()
+        assert self.pool is not None, "the connection pool is not enabled"
+        with self.pool.checkout() as connection:
+            self.thread_connections.connection = connection
+            try:
+                yield connection
+            finally:
+                del self.thread_connections.connection
+
+    def connect(self) -> ldap.ldapobject.LDAPObject:
         logger.debug("initialize")
-        self.connection = ReconnectLDAPObject(
+        connection = ReconnectLDAPObject(
             settings.LDAP_URL,
             bytes_mode=False,
             trace_level=2
@@ -36,25 +289,222 @@ class BaseLDAPIntegration:
             if settings.LOGLEVEL == "INFO"
             else 0,
         )
-        self.connection.set_option(ldap.OPT_REFERRALS, ldap.OPT_OFF)
-        self.connection.set_option(
+        connection.set_option(ldap.OPT_REFERRALS, ldap.OPT_OFF)
+        connection.set_option(
             ldap.OPT_X_TLS_REQUIRE_CERT,
             ldap.OPT_X_TLS_NEVER,
         )
-        self.connection.set_option(
+        connection.set_option(
             ldap.OPT_X_TLS_NEWCTX,
             0,
         )
 
         logger.debug(f"simple_bind_s {settings.BIND_DN}")
-        self.connection.simple_bind_s(
+        connection.simple_bind_s(
             who=settings.BIND_DN,
             cred=settings.BIND_PASSWORD,
         )
-        return self
+        return connection
 
-    def __exit__(self, *args):
-        self.connection.unbind_s()
+    def count_operation(self, operation: str):
+        with self.operation_counts_lock:
+            self.operation_counts[operation] += 1
+
+    def search_attributes(self) -> list[str]:
+        return [self.user_id_attribute, *self.managed_attributes]
+
+    def snapshot_key(self, user_id: str) -> str:
+        # user id attributes (uid, userPrincipalName) are matched case-insensitively by the LDAP
+        return user_id.lower()
+
+    def load_snapshot(self):
+        """
+        Load every user under USERS_DN once, so that lookups done during the run
+        don't need a search each
+        """
+        self.assert_connection()
+        self.snapshot = {}
+        for dn, values in self.paged_search(
+            settings.USERS_DN,
+            ldap.SCOPE_SUBTREE,
+            f"({self.user_id_attribute}=*)",
+            self.search_attributes(),
+        ):
+            self.snapshot_store(dn, values)
+        logger.info(f"loaded {len(self.snapshot)} users from {settings.USERS_DN}")
+
+    def paged_search(
+        self,
+        base: str,
+        scope: int,
+        filterstr: str,
+        attrlist: list[str] = None,
+        page_size: int = None,
+    ) -> Generator[tuple[str, dict], None, None]:
+        """
+        Search using the Simple Paged Results control (RFC 2696),
+        so that results aren't limited by the server size limit.
+        Entries are yielded one by one, only one page is kept in memory at a time
+        """
+        self.assert_connection()
+        page_control = SimplePagedResultsControl(
+            True, size=page_size or settings.LDAP_PAGE_SIZE, cookie=""
+        )
+        try:
+            while True:
+                logger.debug(f"search_ext {base} {filterstr} {page_control.cookie}")
+                self.count_operation("search")
+                msgid = self.connection.search_ext(
+                    base, scope, filterstr, attrlist, serverctrls=[page_control]
+                )
+                _, results, _, response_controls = self.connection.result3(msgid)
+                for dn, values in results:
+                    if dn is None:
+                        # search continuation reference
+                        continue
+                    yield dn, values
+                page_control.cookie = next(
+                    (
+                        control.cookie
+                        for control in response_controls
+                        if control.controlType == SimplePagedResultsControl.controlType
+                    ),
+                    None,
+                )
+                if not page_control.cookie:
+                    break
+        except BaseException:
+            if page_control.cookie:
+                # iteration was stopped early, tell the server to release the paged search
+                page_control.size = 0
+                try:
+                    self.count_operation("search")
+                    self.connection.search_ext_s(
+                        base, scope, filterstr, attrlist, serverctrls=[page_control]
+                    )
+                except ldap.LDAPError as e:
+                    # the original error is raised instead
+                    logger.warning(f"Could not abandon paged search: {e}")
+            raise
+
+    def snapshot_store(self, dn: str, values: dict):
+        values = cidict(
+            {
+                key: value if isinstance(value, list) else [value]
+                for key, value in values.items()
+            }
+        )
+        user_ids = values.get(self.user_id_attribute)
+        if not user_ids:
+            return
+        key = self.snapshot_key(user_ids[0].decode())
+        if self.snapshot is not None:
+            self.snapshot[key] = (dn, values)
+        if key in self.prefetched:
+            self.prefetched[key] = (dn, values)
+
+    def snapshot_update(self, user_id: str, values: dict):
+        key = self.snapshot_key(user_id)
+        index = self.snapshot if self.snapshot is not None else self.prefetched
+        entry = index.get(key)
+        if entry is None:
+            return
+        dn, old_values = entry
+        for attribute, value in values.items():
+            if value:
+                old_values[attribute] = value
+            elif attribute in old_values:
+                del old_values[attribute]
+
+    def snapshot_discard(self, user_id: str):
+        key = self.snapshot_key(user_id)
+        if self.snapshot is not None:
+            self.snapshot.pop(key, None)
+        if key in self.prefetched:
+            self.prefetched[key] = None
+
+    def search_ldap_users(
+        self, user_ids: Iterable[str], chunk_size: int = None
+    ) -> dict[str, tuple[str, dict]]:
+        """
+        Search users with one OR filter per chunk of user ids,
+        returns the (dn, attributes) of the users found by their user id
+        """
+        self.assert_connection()
+        chunk_size = chunk_size or settings.LDAP_LOOKUP_CHUNK_SIZE
+        assert chunk_size > 0, "chunk_size must be a positive number"
+        user_ids_by_key = {self.snapshot_key(user_id): user_id for user_id in user_ids}
+        user_ids = list(user_ids_by_key.values())
+        users = {}
+        for start in range(0, len(user_ids), chunk_size):
+            filterstr = "(|{})".format(
+                "".join(
+                    f"({self.user_id_attribute}={escape_filter_chars(user_id)})"
+                    for user_id in user_ids[start : start + chunk_size]
+                )
+            )
+            self.count_operation("search")
+            results = self.connection.search_s(
+                settings.USERS_DN,
+                ldap.SCOPE_SUBTREE,
+                filterstr,
+                self.search_attributes(),
+            )
+            for dn, values in results:
+                if dn is None:
+                    # search continuation reference
+                    continue
+                values = cidict(values)
+                entry_user_ids = values.get(self.user_id_attribute)
+                if not entry_user_ids:
+                    continue
+                user_id = user_ids_by_key.get(
+                    self.snapshot_key(entry_user_ids[0].decode())
+                )
+                if user_id is not None:
+                    users[user_id] = (dn, values)
+        return users
+
+    def prefetch_ldap_users(self, user_ids: Iterable[str]):
+        """
+        Search the given users by chunks, so that the following lookups on them don't need a search each.
+        Replaces previously prefetched users, to keep memory bounded
+        """
+        if self.snapshot is not None:
+            # every user is already known
+            return
+        user_ids = list(user_ids)
+        users = self.search_ldap_users(user_ids)
+        self.prefetched = {self.snapshot_key(user_id): None for user_id in user_ids}
+        for user_id, entry in users.items():
+            self.prefetched[self.snapshot_key(user_id)] = entry
+
+    def clear_prefetched_ldap_users(self):
+        """
+        Forget the prefetched users once the writes they were searched for are done,
+        so that later lookups don't rely on a user not found before being created in between
+        """
+        self.prefetched = {}
+
+    def find_ldap_user(self, user_id: str) -> (str, dict):
+        self.assert_connection()
+        key = self.snapshot_key(user_id)
+        if self.snapshot is not None:
+            entry = self.snapshot.get(key)
+        elif key in self.prefetched:
+            entry = self.prefetched[key]
+        else:
+            self.count_operation("search")
+            results = self.connection.search_s(
+                settings.USERS_DN,
+                ldap.SCOPE_SUBTREE,
+                f"({self.user_id_attribute}={escape_filter_chars(user_id)})",
+                self.search_attributes(),
+            )
+            entry = results[0] if results else None
+        if entry is None:
+            raise ldap.NO_SUCH_OBJECT(f"User {user_id} not found")
+        return entry
 
     def normalize(self, value: str):
         value = str(value)
@@ -103,24 +553,16 @@ class BaseLDAPIntegration:
     ) -> (str, bool):
         self.assert_connection()
         updated = False
-        results = self.connection.search_s(
-            settings.USERS_DN,
-            ldap.SCOPE_SUBTREE,
-            f"({self.user_id_attribute}={user_id})",
-            [],
-        )
-
-        if results is not None and len(results) > 0:
-            dn, old_values = results[0]
-        else:
-            raise ldap.NO_SUCH_OBJECT(f"User {user_id} not found")
+        dn, old_values = self.find_ldap_user(user_id)
 
         values = self.get_base_attributes(first_name, last_name, email)
         modlist = modifyModlist(old_values, values, ignore_oldexistent=True)
 
         if modlist:
             logger.debug(f"modify_s {dn} {modlist}")
+            self.count_operation("modify")
             self.connection.modify_s(dn, modlist)
+            self.snapshot_update(user_id, values)
             updated = True
         return dn, updated
 
@@ -129,59 +571,275 @@ class BaseLDAPIntegration:
         user_id: str,
     ) -> str:
         self.assert_connection()
-        results = self.connection.search_s(
-            settings.USERS_DN,
-            ldap.SCOPE_SUBTREE,
-            f"({self.user_id_attribute}={user_id})",
-            [],
-        )
-
-        if results is not None and len(results) > 0:
-            dn, old_values = results[0]
-        else:
-            raise ldap.NO_SUCH_OBJECT(f"User {user_id} not found")
+        dn, old_values = self.find_ldap_user(user_id)
 
+        self.count_operation("delete")
         self.connection.delete_s(dn)
+        self.snapshot_discard(user_id)
         return dn
 
+    @property
+    def defers_password_resets(self) -> bool:
+        """
+        Whether the password of the created users is only set by flush_password_resets
+        """
+        return False
+
+    def flush_password_resets(self) -> dict[str, str | None]:
+        """
+        Set the passwords of the created users still waiting for one.
+        Returns the error of each user whose password was handled since the previous flush,
+        by user id, None for those activated
+        """
+        return {}
+
+    def reset_ldap_user_password(self, user_id: str):
+        """
+        Set again the initial password of a user whose password could not be set on creation
+        """
+        raise NotImplementedError()
+
+    def write_pipeline(self, window: int) -> LDAPWritePipeline:
+        self.assert_connection()
+        return LDAPWritePipeline(self.connection, window, self.count_operation)
+
+    @contextmanager
+    def pooled_writes(self, window: int) -> Generator[LDAPPooledWrites, None, None]:
+        """
+        Bind the connections of the pool for the writes done by worker threads
+        """
+        with self.open_pool(), LDAPPooledWrites(self, window) as writes:
+            yield writes
+
+    def submit_create_ldap_user(
+        self,
+        pipeline: LDAPWritePipeline,
+        callback: ResultCallback,
+        user_id: str,
+        first_name: str,
+        last_name: str,
+        email: str,
+    ):
+        # by default creation is done synchronously,
+        # for integrations whose creation steps can't be pipelined
+        try:
+            self.create_ldap_user(user_id, first_name, last_name, email)
+        except ldap.LDAPError as e:
+            callback(e)
+        else:
+            callback(None)
+
+    def submit_update_ldap_user(
+        self,
+        pipeline: LDAPWritePipeline,
+        callback: ResultCallback,
+        user_id: str,
+        first_name: str,
+        last_name: str,
+        email: str,
+    ):
+        self.assert_connection()
+        try:
+            dn, old_values = self.find_ldap_user(user_id)
+        except ldap.NO_SUCH_OBJECT as e:
+            callback(e)
+            return
+
+        values = self.get_base_attributes(first_name, last_name, email)
+        modlist = modifyModlist(old_values, values, ignore_oldexistent=True)
+        if not modlist:
+            callback(None)
+            return
+
+        # the cache is updated right away, so that a following write of the same user
+        # in the pipeline is compared to this one, and rolled back if it fails
+        previous_values = {
+            attribute: list(old_values.get(attribute, [])) for attribute in values
+        }
+        self.snapshot_update(user_id, values)
+
+        def on_modified(error: ldap.LDAPError | None):
+            if error is not None:
+                self.snapshot_update(user_id, previous_values)
+            callback(error)
+
+        pipeline.submit("modify", dn, modlist, callback=on_modified)
+
+    def submit_delete_ldap_user(
+        self,
+        pipeline: LDAPWritePipeline,
+        callback: ResultCallback,
+        user_id: str,
+    ):
+        self.assert_connection()
+        try:
+            dn, old_values = self.find_ldap_user(user_id)
+        except ldap.NO_SUCH_OBJECT as e:
+            callback(e)
+            return
+
+        self.snapshot_discard(user_id)
+
+        def on_deleted(error: ldap.LDAPError | None):
+            if error is not None:
+                self.snapshot_store(dn, old_values)
+            callback(error)
+
+        pipeline.submit("delete", dn, callback=on_deleted)
+
 
 class ActiveDirectoryIntegration(BaseLDAPIntegration):
     user_id_attribute = "userPrincipalName"
+    allocation_attempts = 3
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.homonym_allocator = HomonymAllocator()
+        # users created without LDAPS, waiting for their password to be set through SSH,
+        # as (user id, dn, password)
+        self.pending_password_resets: list[tuple[str, str, str]] = []
+        # error of each user whose password was handled since the last flush, by user id
+        self.password_reset_errors: dict[str, str | None] = {}
+        self.password_resets_lock = threading.Lock()
 
-    def _set_password(self, dn: str, pwd: str):
-        if settings.LDAP_TLS:
+    def __exit__(self, *args):
+        if self.depth == 1:
+            self.flush_password_resets()
+        super().__exit__(*args)
+
+    def _activate_user(self, dn: str, pwd: str | None):
+        """
+        Set the password of a newly created user and activate it,
+        pwd being None if the password was already set.
+        The user state is known from its creation, so no search is needed beforehand
+        """
+        modlist = []
+        if pwd is not None and settings.LDAP_TLS:
             # Will not work without SSL
             # prerequisite for password: https://nawilson.com/2010/08/26/ldap-password-changes-in-active-directory/
             formatted_pwd = f'"{pwd}"'.encode("utf-16-le")
             # replace is needed: https://learn.microsoft.com/en-us/openspecs/windows_protocols/ms-adts/6e803168-f140-4d23-b2d3-c3a8ab5917d2
-            modlist = [(ldap.MOD_REPLACE, "unicodePwd", [formatted_pwd])]
-            logger.debug(f"modify_s {dn} {modlist}")
-            self.connection.modify_s(dn, modlist)
-        else:
+            # modifications are applied in order, so the account is enabled after its password is set
+            modlist.append((ldap.MOD_REPLACE, "unicodePwd", [formatted_pwd]))
+        elif pwd is not None:
             launch_ssh_command(
                 f'Set-ADAccountPassword -Identity "{dn}" -Reset -NewPassword (ConvertTo-SecureString -AsPlainText "{pwd}" -Force)',
                 "id_ad_server",
             )
-
-    def _activate_user(self, dn: str):
         # activate user, see https://github.com/go-ldap/ldap/issues/106#issuecomment-342698860
+        modlist += [
+            # 512 is for NORMAL_ACCOUNT, see https://learn.microsoft.com/en-us/troubleshoot/windows-server/identity/useraccountcontrol-manipulate-account-properties
+            (ldap.MOD_REPLACE, "userAccountControl", [b"512"]),
+            # see https://learn.microsoft.com/en-us/windows/win32/adschema/a-pwdlastset
+            (ldap.MOD_REPLACE, "pwdLastSet", [b"0"]),
+        ]
+        logger.debug(f"modify_s {dn} {modlist}")
+        self.count_operation("modify")
+        self.connection.modify_s(dn, modlist)
+
+    @property
+    def defers_password_resets(self) -> bool:
+        return not settings.LDAP_TLS and settings.AD_PASSWORD_BATCH_SIZE > 1
+
+    def _queue_password_reset(self, user_id: str, dn: str, pwd: str):
+        with self.password_resets_lock:
+            self.pending_password_resets.append((user_id, dn, pwd))
+            batch_full = (
+                len(self.pending_password_resets) >= settings.AD_PASSWORD_BATCH_SIZE
+            )
+        if batch_full:
+            self._reset_passwords()
+
+    def _reset_passwords(self):
+        """
+        Set the password of every user waiting for one with a single SSH session,
+        then activate those whose password could be set
+        """
+        with self.password_resets_lock:
+            password_resets = self.pending_password_resets
+            self.pending_password_resets = []
+        if not password_resets:
+            return
+
+        errors = launch_ssh_powershell_batch(
+            [
+                f"Set-ADAccountPassword -Identity {powershell_quote(dn)} -Reset -NewPassword (ConvertTo-SecureString -AsPlainText {powershell_quote(pwd)} -Force)"
+                for _, dn, pwd in password_resets
+            ],
+            "id_ad_server",
+        )
+        results = {}
+        for (user_id, dn, _), error in zip(password_resets, errors):
+            if error is None:
+                try:
+                    self._activate_user(dn, None)
+                except ldap.LDAPError as e:
+                    error = f"activation failed: {e}"
+            if error is not None:
+                # the user stays disabled until its password is set
+                logger.error(f"Could not set password of user {dn}: {error}")
+            results[user_id] = error
+        with self.password_resets_lock:
+            self.password_reset_errors.update(results)
+
+    def flush_password_resets(self) -> dict[str, str | None]:
+        self._reset_passwords()
+        with self.password_resets_lock:
+            results = self.password_reset_errors
+            self.password_reset_errors = {}
+        return results
+
+    def reset_ldap_user_password(self, user_id: str):
+        self.assert_connection()
+        dn, _ = self.find_ldap_user(user_id)
+        pwd = user_id
+        if self.defers_password_resets:
+            self._queue_password_reset(user_id, dn, pwd)
+        else:
+            self._activate_user(dn, pwd)
+
+    def allocate_names(self, user_id: str, username: str, cn: str) -> (str, str):
+        """
+        Find the first free sAMAccountName and CN for a new user with a single search,
+        by adding the lowest number suffix not used by a homonym
+        """
+        self.count_operation("search")
         results = self.connection.search_s(
-            settings.USERS_DN,
+            settings.LDAP_DOMAIN,
             ldap.SCOPE_SUBTREE,
-            f"(distinguishedName={dn})",
-            [],
+            "(|({user_id_attribute}={user_id})(sAMAccountName={username}*)(cn={cn}*))".format(
+                user_id_attribute=self.user_id_attribute,
+                user_id=escape_filter_chars(user_id),
+                username=escape_filter_chars(username),
+                cn=escape_filter_chars(cn),
+            ),
+            [self.user_id_attribute, "sAMAccountName"],
+        )
+        users_dn = str2dn(settings.USERS_DN.lower())
+        taken_usernames = []
+        taken_cns = []
+        for dn, values in results:
+            if dn is None:
+                # search continuation reference
+                continue
+            values = cidict(values)
+            if any(
+                self.snapshot_key(value.decode()) == self.snapshot_key(user_id)
+                for value in values.get(self.user_id_attribute, [])
+            ):
+                raise ldap.ALREADY_EXISTS(f"User {user_id} already exists")
+            taken_usernames.extend(
+                value.decode() for value in values.get("sAMAccountName", [])
+            )
+            rdn, *parent_dn = str2dn(dn.lower())
+            # CN only needs to be unique in its container
+            if parent_dn == users_dn:
+                taken_cns.extend(value for _, value, _ in rdn)
+
+        return (
+            self.homonym_allocator.allocate(username, taken_usernames),
+            self.homonym_allocator.allocate(cn, taken_cns),
         )
-        dn, old_values = results[0]
-        values = {
-            # 512 is for NORMAL_ACCOUNT, see https://learn.microsoft.com/en-us/troubleshoot/windows-server/identity/useraccountcontrol-manipulate-account-properties
-            "userAccountControl": [b"512"],
-            # see https://learn.microsoft.com/en-us/windows/win32/adschema/a-pwdlastset
-            "pwdLastSet": [b"0"],
-        }
-        modlist = modifyModlist(old_values, values, ignore_oldexistent=True)
-        if modlist:
-            logger.debug(f"modify_s {dn} {modlist}")
-            self.connection.modify_s(dn, modlist)
 
     def create_ldap_user(
         self,
@@ -192,45 +850,40 @@ class ActiveDirectoryIntegration(BaseLDAPIntegration):
     ) -> (str, str):
         self.assert_connection()
         pwd = user_id
-        user_id = user_id.encode()
-        username = self.normalize(f"{first_name[0]}{last_name}").encode()
+        username = self.normalize(f"{first_name[0]}{last_name}")
         cn = f"{first_name} {last_name.upper()}"
-        homonym_suffix = 1
 
-        values = dict(
-            **self.get_base_attributes(first_name, last_name, email),
-            **{self.user_id_attribute: user_id},
-            sAMAccountName=username,
-            objectClass=[b"top", b"user", b"person", b"organizationalPerson"],
-            objectCategory=f"CN=Person,CN=Schema,CN=Configuration,{settings.LDAP_DOMAIN}".encode(),
-            instanceType=b"4",
-        )
-        dn = f"CN={cn},{settings.USERS_DN}"
+        for attempt in range(self.allocation_attempts):
+            allocated_username, allocated_cn = self.allocate_names(
+                user_id, username, cn
+            )
+            values = dict(
+                **self.get_base_attributes(first_name, last_name, email),
+                **{self.user_id_attribute: user_id.encode()},
+                sAMAccountName=allocated_username.encode(),
+                objectClass=[b"top", b"user", b"person", b"organizationalPerson"],
+                objectCategory=f"CN=Person,CN=Schema,CN=Configuration,{settings.LDAP_DOMAIN}".encode(),
+                instanceType=b"4",
+            )
+            dn = f"CN={allocated_cn},{settings.USERS_DN}"
 
-        modlist = addModlist(values)
-        logger.debug(f"add_s {dn} {modlist}")
-        while True:
-            try:
-                self.connection.add_s(dn, modlist)
-            except ldap.ALREADY_EXISTS:
-                # sAMAccountName is already used by someone with the same username
-                values["sAMAccountName"] = username + str(homonym_suffix).encode()
-                modlist = addModlist(values)
-                # reset DN in case it was changed by previous loop, to try a creation without any DN suffix
-                dn = f"CN={cn},{settings.USERS_DN}"
-            else:
-                break
+            modlist = addModlist(values)
+            logger.debug(f"add_s {dn} {modlist}")
             try:
+                self.count_operation("add")
                 self.connection.add_s(dn, modlist)
             except ldap.ALREADY_EXISTS:
-                # DN is already used by someone with the same complete name
-                # (or there is another conflict on username, but it will be taken care of by next loop
-                dn = f"CN={cn}{homonym_suffix},{settings.USERS_DN}"
+                if attempt + 1 == self.allocation_attempts:
+                    raise
+                # a homonym was created by someone else since the names were allocated
+                logger.warning(f"{dn} already exists, allocating new names")
             else:
                 break
-            homonym_suffix += 1
-        self._set_password(dn, pwd)
-        self._activate_user(dn)
+        if self.defers_password_resets:
+            self._queue_password_reset(user_id, dn, pwd)
+        else:
+            self._activate_user(dn, pwd)
+        self.snapshot_store(dn, values)
 
         return dn, pwd
 
@@ -246,6 +899,64 @@ class OpenLDAPIntegration(BaseLDAPIntegration):
         email: str,
     ) -> (str, str):
         self.assert_connection()
+        dn, values, pwd = self.get_user_entry(user_id, first_name, last_name, email)
+
+        modlist = addModlist(values)
+        logger.debug(f"add_s {dn} {modlist}")
+        self.count_operation("add")
+        self.connection.add_s(dn, modlist)
+        self.set_password(dn, pwd)
+        self.snapshot_store(dn, values)
+
+        return dn, pwd
+
+    def set_password(self, dn: str, pwd: str):
+        self.count_operation("passwd")
+        try:
+            self.connection.passwd_s(dn, None, pwd)
+        except ldap.LDAPError as e:
+            raise PasswordResetError(e) from e
+
+    def reset_ldap_user_password(self, user_id: str):
+        self.assert_connection()
+        dn, _ = self.find_ldap_user(user_id)
+        self.set_password(dn, user_id)
+
+    def submit_create_ldap_user(
+        self,
+        pipeline: LDAPWritePipeline,
+        callback: ResultCallback,
+        user_id: str,
+        first_name: str,
+        last_name: str,
+        email: str,
+    ):
+        self.assert_connection()
+        dn, values, pwd = self.get_user_entry(user_id, first_name, last_name, email)
+
+        def on_password_set(error: ldap.LDAPError | None):
+            if error is None:
+                self.snapshot_store(dn, values)
+                callback(None)
+                return
+            callback(PasswordResetError(error))
+
+        def on_added(error: ldap.LDAPError | None):
+            if error is not None:
+                callback(error)
+                return
+            # the password can only be set once the user creation is acknowledged
+            pipeline.submit("passwd", dn, None, pwd, callback=on_password_set)
+
+        pipeline.submit("add", dn, addModlist(values), callback=on_added)
+
+    def get_user_entry(
+        self,
+        user_id: str,
+        first_name: str,
+        last_name: str,
+        email: str,
+    ) -> (str, dict, str):
         pwd = user_id
         home_directory = f"/home/users/users/{user_id}".encode()
         uid_number = self.get_uid_number(user_id)
@@ -263,13 +974,7 @@ class OpenLDAPIntegration(BaseLDAPIntegration):
             sambaacctflags=b"[U]",
         )
         dn = f"CN={user_id},{settings.USERS_DN}"
-
-        modlist = addModlist(values)
-        logger.debug(f"add_s {dn} {modlist}")
-        self.connection.add_s(dn, modlist)
-        self.connection.passwd_s(dn, None, pwd)
-
-        return dn, pwd
+        return dn, values, pwd
 
     def get_uid_number(self, user_id: str):
         match = re.match(r"C(\d+)", user_id)
@@ -0,0 +1,386 @@
+import itertools
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Generator, Iterable
+
+import ldap
+from django.conf import settings
+from ldap.cidict import cidict
+from ldap.controls import SimplePagedResultsControl
+from ldap.dn import dn2str, str2dn
+
+from applications.ftp_integration.ldap import OpenLDAPIntegration
+
+
+def normalize_dn(dn: str) -> str:
+    return dn2str(str2dn(dn.lower()))
+
+
+def as_list(value) -> list[bytes]:
+    return value if isinstance(value, list) else [value]
+
+
+class InMemoryDirectory:
+    """
+    Directory content shared by every in-memory connection.
+    Entries are indexed by their user id attributes, so that searching users by equality
+    does not go through every entry
+    """
+
+    indexed_attributes = ("uid", "userPrincipalName", "sAMAccountName", "cn")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # normalized DN -> (DN, attributes)
+        self.entries: dict[str, tuple[str, cidict]] = {}
+        # normalized DN -> parsed DN, compared to the search bases
+        self.parsed_dns: dict[str, list] = {}
+        # (lowercased attribute, lowercased value) -> normalized DNs of the entries having it
+        self.index: defaultdict[tuple[str, bytes], set[str]] = defaultdict(set)
+        self.passwords: dict[str, str] = {}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.parsed_dns.clear()
+            self.index.clear()
+            self.passwords.clear()
+
+    def index_keys(self, values: cidict) -> Generator[tuple[str, bytes], None, None]:
+        for attribute in self.indexed_attributes:
+            for value in values.get(attribute, []):
+                yield attribute.lower(), value.lower()
+
+    def add(self, dn: str, modlist: list):
+        with self.lock:
+            key = normalize_dn(dn)
+            if key in self.entries:
+                raise ldap.ALREADY_EXISTS({"desc": "Already exists", "matched": dn})
+            values = cidict({attribute: as_list(value) for attribute, value in modlist})
+            self.entries[key] = (dn, values)
+            self.parsed_dns[key] = str2dn(key)
+            self.index_entry(key, values)
+
+    def index_entry(self, key: str, values: cidict):
+        for index_key in self.index_keys(values):
+            self.index[index_key].add(key)
+
+    def unindex_entry(self, key: str, values: cidict):
+        for index_key in self.index_keys(values):
+            self.index[index_key].discard(key)
+            if not self.index[index_key]:
+                del self.index[index_key]
+
+    def modify(self, dn: str, modlist: list):
+        with self.lock:
+            _, values = self.get(dn)
+            key = normalize_dn(dn)
+            self.unindex_entry(key, values)
+            for operation, attribute, value in modlist:
+                value = as_list(value) if value is not None else []
+                if operation == ldap.MOD_ADD:
+                    values[attribute] = values.get(attribute, []) + value
+                elif operation == ldap.MOD_REPLACE and value:
+                    values[attribute] = value
+                elif operation == ldap.MOD_DELETE and value:
+                    remaining = [v for v in values.get(attribute, []) if v not in value]
+                    if remaining:
+                        values[attribute] = remaining
+                    elif attribute in values:
+                        del values[attribute]
+                elif attribute in values:
+                    # MOD_DELETE or MOD_REPLACE without value removes the whole attribute
+                    del values[attribute]
+            self.index_entry(key, values)
+
+    def delete(self, dn: str):
+        with self.lock:
+            _, values = self.get(dn)
+            key = normalize_dn(dn)
+            self.unindex_entry(key, values)
+            del self.entries[key]
+            del self.parsed_dns[key]
+            self.passwords.pop(key, None)
+
+    def passwd(self, dn: str, new_password: str):
+        with self.lock:
+            self.get(dn)
+            self.passwords[normalize_dn(dn)] = new_password
+
+    def check_password(self, dn: str, password: str) -> bool:
+        with self.lock:
+            return self.passwords.get(normalize_dn(dn)) == password
+
+    def get(self, dn: str) -> tuple[str, cidict]:
+        try:
+            return self.entries[normalize_dn(dn)]
+        except KeyError:
+            raise ldap.NO_SUCH_OBJECT({"desc": "No such object", "matched": dn})
+
+    def search(
+        self, base: str, scope: int, filterstr: str, attrlist: list[str] | None
+    ) -> list[tuple[str, dict]]:
+        base = str2dn(base.lower())
+        match, lookups = parse_filter(filterstr, self.indexed_attributes)
+        with self.lock:
+            if lookups is None:
+                keys = list(self.entries)
+            else:
+                # sorted so that pages of the same search follow the same order
+                keys = sorted(
+                    set().union(*(self.index.get(lookup, ()) for lookup in lookups))
+                )
+            entries = [(self.entries[key], self.parsed_dns[key]) for key in keys]
+        results = []
+        for (dn, values), rdns in entries:
+            depth = len(rdns) - len(base)
+            if depth < 0 or rdns[depth:] != base:
+                continue
+            if (scope == ldap.SCOPE_BASE and depth != 0) or (
+                scope == ldap.SCOPE_ONELEVEL and depth != 1
+            ):
+                continue
+            if not match(values):
+                continue
+            if attrlist:
+                values = {
+                    attribute: list(values[attribute])
+                    for attribute in attrlist
+                    if attribute in values
+                }
+            else:
+                values = {attribute: list(value) for attribute, value in values.items()}
+            results.append((dn, values))
+        return results
+
+
+FILTER_TOKEN = re.compile(r"\(|\)|[^()]+")
+
+
+def unescape_filter_value(value: str) -> bytes:
+    return re.sub(
+        rb"\\([0-9a-fA-F]{2})",
+        lambda match: bytes([int(match[1], 16)]),
+        value.encode(),
+    )
+
+
+def compile_filter(filterstr: str):
+    """
+    Compile a RFC 4515 search filter into a function matching entry attributes.
+    Only equality, presence and substring assertions are supported, matched case-insensitively
+    """
+    return parse_filter(filterstr)[0]
+
+
+def parse_filter(filterstr: str, indexed_attributes: Iterable[str] = ()):
+    """
+    Compile a search filter like compile_filter, along with the (lowercased attribute, lowercased value)
+    of the indexed attributes one of which is held by any matching entry, None if there are none
+    """
+    indexed_attributes = {attribute.lower() for attribute in indexed_attributes}
+    tokens = FILTER_TOKEN.findall(filterstr)
+    position = 0
+
+    def parse():
+        nonlocal position
+        assert tokens[position] == "(", f"invalid filter {filterstr}"
+        position += 1
+        token = tokens[position]
+        if token in ("&", "|", "!"):
+            position += 1
+            operands = []
+            while tokens[position] == "(":
+                operands.append(parse())
+            position += 1
+            matches = [match for match, _ in operands]
+            lookups = [lookup for _, lookup in operands]
+            if token == "&":
+                # any operand with lookups restricts the entries to look at
+                return (
+                    lambda values: all(match(values) for match in matches),
+                    next((lookup for lookup in lookups if lookup is not None), None),
+                )
+            if token == "|":
+                return (
+                    lambda values: any(match(values) for match in matches),
+                    (
+                        None
+                        if None in lookups
+                        else [item for lookup in lookups for item in lookup]
+                    ),
+                )
+            return lambda values: not matches[0](values), None
+        position += 2
+        attribute, _, value = token.partition("=")
+        if value == "*":
+            return lambda values: bool(values.get(attribute)), None
+        pattern = re.compile(
+            b".*".join(
+                re.escape(unescape_filter_value(part)) for part in value.split("*")
+            ),
+            re.IGNORECASE | re.DOTALL,
+        )
+        lookups = None
+        if "*" not in value and attribute.lower() in indexed_attributes:
+            lookups = [(attribute.lower(), unescape_filter_value(value).lower())]
+        return (
+            lambda values: any(
+                pattern.fullmatch(item) for item in values.get(attribute, [])
+            ),
+            lookups,
+        )
+
+    return parse()
+
+
+class InMemoryLDAPConnection:
+    """
+    Stand-in for the python-ldap connection used by the integrations, keeping entries in memory.
+    Every request waits for `latency` seconds, asynchronous ones concurrently.
+    With `deferred`, asynchronous requests are only applied when their result is read,
+    like a server still processing them
+    """
+
+    def __init__(
+        self, directory: InMemoryDirectory, latency: float = 0, deferred: bool = False
+    ):
+        self.directory = directory
+        self.latency = latency
+        self.deferred = deferred
+        self.message_ids = itertools.count(1)
+        # message id -> (time the result is available, deferred operation or its result)
+        self.pending_results: dict[
+            int, tuple[float, Callable[[], tuple] | tuple | ldap.LDAPError]
+        ] = {}
+
+    def set_option(self, option: int, value):
+        pass
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def simple_bind_s(self, who: str = None, cred: str = None):
+        self.wait()
+        if who != settings.BIND_DN and not self.directory.check_password(who, cred):
+            raise ldap.INVALID_CREDENTIALS({"desc": "Invalid credentials"})
+
+    def unbind_s(self):
+        pass
+
+    def search_s(
+        self, base: str, scope: int, filterstr: str, attrlist: list[str] = None
+    ) -> list[tuple[str, dict]]:
+        self.wait()
+        return self.directory.search(base, scope, filterstr, attrlist)
+
+    def search_ext_s(
+        self,
+        base: str,
+        scope: int,
+        filterstr: str,
+        attrlist: list[str] = None,
+        serverctrls: list = None,
+    ) -> list[tuple[str, dict]]:
+        return self.result3(
+            self.search_ext(base, scope, filterstr, attrlist, serverctrls)
+        )[1]
+
+    def search_ext(
+        self,
+        base: str,
+        scope: int,
+        filterstr: str,
+        attrlist: list[str] = None,
+        serverctrls: list = None,
+    ) -> int:
+        results = self.directory.search(base, scope, filterstr, attrlist)
+        response_controls = []
+        for control in serverctrls or []:
+            if control.controlType != SimplePagedResultsControl.controlType:
+                continue
+            offset = int(control.cookie or 0)
+            end = offset + control.size
+            cookie = str(end).encode() if control.size and end < len(results) else b""
+            results = results[offset:end]
+            response_controls.append(
+                SimplePagedResultsControl(False, size=0, cookie=cookie)
+            )
+        return self._send(
+            lambda: (ldap.RES_SEARCH_RESULT, results, None, response_controls)
+        )
+
+    def add_s(self, dn: str, modlist: list):
+        return self.result3(self.add(dn, modlist))
+
+    def modify_s(self, dn: str, modlist: list):
+        return self.result3(self.modify(dn, modlist))
+
+    def delete_s(self, dn: str):
+        return self.result3(self.delete(dn))
+
+    def passwd_s(self, user: str, oldpw: str | None, newpw: str):
+        return self.result3(self.passwd(user, oldpw, newpw))
+
+    def add(self, dn: str, modlist: list) -> int:
+        return self._send(
+            lambda: self.directory.add(dn, modlist) or (ldap.RES_ADD, [], None, [])
+        )
+
+    def modify(self, dn: str, modlist: list) -> int:
+        return self._send(
+            lambda: self.directory.modify(dn, modlist)
+            or (ldap.RES_MODIFY, [], None, [])
+        )
+
+    def delete(self, dn: str) -> int:
+        return self._send(
+            lambda: self.directory.delete(dn) or (ldap.RES_DELETE, [], None, [])
+        )
+
+    def passwd(self, user: str, oldpw: str | None, newpw: str) -> int:
+        return self._send(
+            lambda: self.directory.passwd(user, newpw)
+            or (ldap.RES_EXTENDED, [], None, [])
+        )
+
+    def _send(self, operation: Callable[[], tuple]) -> int:
+        msgid = next(self.message_ids)
+        result = operation if self.deferred else self._apply(operation)
+        self.pending_results[msgid] = (time.monotonic() + self.latency, result)
+        return msgid
+
+    def _apply(self, operation: Callable[[], tuple]) -> tuple | ldap.LDAPError:
+        try:
+            return operation()
+        except ldap.LDAPError as e:
+            return e
+
+    def result3(self, msgid: int, all: int = 1, timeout: float = None) -> tuple:
+        available_at, result = self.pending_results.pop(msgid)
+        delay = available_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if callable(result):
+            result = self._apply(result)
+        if isinstance(result, ldap.LDAPError):
+            raise result
+        rtype, rdata, _, serverctrls = result
+        return rtype, rdata, msgid, serverctrls
+
+
+class InMemoryLDAPIntegration(OpenLDAPIntegration):
+    """
+    OpenLDAP integration working on an in-memory directory, for tests and benchmarks.
+    The latency of each LDAP request is set by LDAP_IN_MEMORY_LATENCY
+    """
+
+    directory = InMemoryDirectory()
+
+    def connect(self) -> InMemoryLDAPConnection:
+        return InMemoryLDAPConnection(
+            self.directory, latency=settings.LDAP_IN_MEMORY_LATENCY
+        )
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import io
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from applications.ftp_integration.ldap_memory import InMemoryLDAPIntegration
+from applications.ftp_integration.models import UserOperation
+from applications.ftp_integration.services import FTPIntegrationService
+from applications.ftp_integration.utils import DateParser
+
+
+class Command(BaseCommand):
+    help = "Measure processing steps on generated data, without touching the FTP or the LDAP"
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", choices=["ldap", "dates"])
+        parser.add_argument(
+            "--users", type=int, default=1000, help="number of generated users"
+        )
+        parser.add_argument(
+            "--dates",
+            type=int,
+            default=300,
+            help="number of distinct dates among the users, for the dates target",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.001,
+            help="latency in seconds of each request sent to the in-memory LDAP",
+        )
+        parser.add_argument("--window", type=int, default=settings.LDAP_PIPELINE_WINDOW)
+        parser.add_argument("--pool-size", type=int, default=settings.LDAP_POOL_SIZE)
+        parser.add_argument(
+            "--chunk-size", type=int, default=settings.LDAP_LOOKUP_CHUNK_SIZE
+        )
+
+    def handle(self, *args, target: str, **options):
+        getattr(self, f"benchmark_{target}")(**options)
+
+    @contextmanager
+    def measure(self, step: str, service: FTPIntegrationService):
+        operation_counts = Counter(service.ldap_integration.operation_counts)
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        operation_counts = service.ldap_integration.operation_counts - operation_counts
+        self.stdout.write(f"{step}: {elapsed:.3f}s {dict(operation_counts)}")
+
+    def benchmark_ldap(
+        self,
+        users: int,
+        latency: float,
+        window: int,
+        pool_size: int,
+        chunk_size: int,
+        **options,
+    ):
+        """
+        Create, update then delete generated users on an in-memory LDAP.
+        Database changes are rolled back at the end
+        """
+        with override_settings(
+            LDAP_INTEGRATION_CLASS="applications.ftp_integration.ldap_memory.InMemoryLDAPIntegration",
+            LDAP_IN_MEMORY_LATENCY=latency,
+            LDAP_PIPELINE_WINDOW=window,
+            LDAP_POOL_SIZE=pool_size,
+            LDAP_LOOKUP_CHUNK_SIZE=chunk_size,
+        ), transaction.atomic():
+            InMemoryLDAPIntegration.directory.clear()
+            service = FTPIntegrationService()
+            user_ids = [f"C{index}@domain.com" for index in range(users)]
+
+            UserOperation.objects.bulk_create(
+                UserOperation(
+                    user_id=user_id,
+                    first_name="Foo",
+                    last_name="BAR",
+                    email="fbar@domain.com",
+                    date_for_change=date.today(),
+                    type_operation=UserOperation.TypeChoices.CREATION,
+                )
+                for user_id in user_ids
+            )
+            with self.measure("creations", service):
+                service.process_db_operation()
+
+            file = io.StringIO(
+                "".join(
+                    [";".join(FTPIntegrationService.headers_mapping) + "\n"]
+                    + [
+                        f"Foo;BAZ;fbaz@domain.com;{user_id};01/01/2023;\n"
+                        for user_id in user_ids
+                    ]
+                )
+            )
+            file.name = "employee_update_benchmark.csv"
+            with self.measure("updates", service), service.ldap_integration:
+                service.parse_file(file)
+
+            UserOperation.objects.bulk_create(
+                UserOperation(
+                    user_id=user_id,
+                    first_name="Foo",
+                    last_name="BAZ",
+                    email="fbaz@domain.com",
+                    date_for_change=date.today() - timedelta(days=1),
+                    type_operation=UserOperation.TypeChoices.DELETION,
+                )
+                for user_id in user_ids
+            )
+            with self.measure("deletions", service):
+                service.process_db_operation()
+
+            InMemoryLDAPIntegration.directory.clear()
+            transaction.set_rollback(True)
+
+    def benchmark_dates(self, users: int, dates: int, **options):
+        """
+        Parse the begin and end dates of generated users with strptime then with DateParser
+        """
+        date_format = FTPIntegrationService.date_format
+        values = [
+            (date(2020, 1, 1) + timedelta(days=index % dates)).strftime(date_format)
+            for index in range(users * 2)
+        ]
+        start = time.perf_counter()
+        for value in values:
+            datetime.strptime(value, date_format).date()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"strptime: {elapsed:.3f}s {elapsed / users * 1e6:.2f}µs/row")
+        date_parser = DateParser(date_format)
+        start = time.perf_counter()
+        for value in values:
+            date_parser.parse(value)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"DateParser: {elapsed:.3f}s {elapsed / users * 1e6:.2f}µs/row"
+        )
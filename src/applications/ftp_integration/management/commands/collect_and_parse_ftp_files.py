@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import logging
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from applications.ftp_integration.services import FTPIntegrationService
@@ -10,10 +11,18 @@ logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-    help = "Parse files newly sent from ftp, then process pending DB operation for the day"
+    help = (
+        "Parse files newly sent from ftp, then process pending DB operation for the day"
+    )
 
     def handle(self, *args, **options):
         service = FTPIntegrationService()
-        service.retrieve_person_files()
-        service.process_person_files()
-        service.process_db_operation()
+        if not settings.FTP_STREAM_FILES:
+            service.retrieve_person_files()
+        # share the same LDAP connections between both steps
+        with service.ldap_integration:
+            # files left by a previous run are older than the ones on the FTP
+            service.process_person_files()
+            if settings.FTP_STREAM_FILES:
+                service.stream_person_files()
+            service.process_db_operation()
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from applications.ftp_integration.models import ProcessedFile
+from applications.ftp_integration.services import FTPIntegrationService
+
+
+class Command(BaseCommand):
+    help = "List the processed files from the archive manifest, or print the content of one of them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "sha256", nargs="?", help="start of the hash of the file to print"
+        )
+        parser.add_argument(
+            "--type", choices=FTPIntegrationService.file_type_name, dest="file_type"
+        )
+        parser.add_argument(
+            "--since", type=date.fromisoformat, help="processed since, as YYYY-MM-DD"
+        )
+
+    def handle(
+        self, *args, sha256: str | None, file_type: str | None, since, **options
+    ):
+        processed_files = ProcessedFile.objects.order_by("processed_at")
+        if file_type:
+            processed_files = processed_files.filter(file_type=file_type)
+        if since:
+            processed_files = processed_files.filter(processed_at__date__gte=since)
+        if sha256 is None:
+            for processed_file in processed_files:
+                self.stdout.write(
+                    f"{processed_file.processed_at:%Y-%m-%d %H:%M} {processed_file.sha256} "
+                    f"{processed_file.file_type or '-'} {processed_file.row_count} rows "
+                    f"{processed_file.file_name}"
+                )
+            return
+        try:
+            processed_file = processed_files.get(sha256__startswith=sha256)
+        except (ProcessedFile.DoesNotExist, ProcessedFile.MultipleObjectsReturned):
+            raise CommandError(f"No single processed file with hash {sha256}")
+        with FTPIntegrationService().open_archived_file(processed_file) as f:
+            for line in f:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 17:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ftp_integration", "0002_processedfile"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EmployeeFingerprint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("user_id", models.CharField(max_length=20, unique=True)),
+                ("fingerprint", models.CharField(max_length=32)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-17 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ftp_integration", "0004_filecheckpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RemoteFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("path", models.CharField(max_length=255, unique=True)),
+                ("size", models.PositiveBigIntegerField(null=True)),
+                ("modified", models.CharField(blank=True, max_length=32)),
+                ("downloaded_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
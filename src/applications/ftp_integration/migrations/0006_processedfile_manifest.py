@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ftp_integration", "0005_remotefile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="processedfile",
+            name="archive_path",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name="processedfile",
+            name="file_type",
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name="processedfile",
+            name="row_count",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="processedfile",
+            index=models.Index(
+                fields=["file_type", "processed_at"],
+                name="ftp_integra_file_ty_901f74_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ftp_integration", "0006_processedfile_manifest"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="useroperation",
+            index=models.Index(
+                fields=["type_operation", "date_for_change"],
+                name="ftp_integra_type_op_14ac9d_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ftp_integration", "0007_useroperation_due_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="useroperation",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="useroperation",
+            name="last_error",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="useroperation",
+            name="next_attempt_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="useroperation",
+            name="status",
+            field=models.CharField(
+                choices=[("P", "Pending"), ("F", "Failed")], default="P", max_length=1
+            ),
+        ),
+    ]
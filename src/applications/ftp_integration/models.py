@@ -1,3 +1,7 @@
+import hashlib
+from datetime import datetime, timezone
+from pathlib import Path
+
 from django.db import models
 
 
@@ -6,12 +10,23 @@ class UserOperation(models.Model):
         CREATION = "C"
         DELETION = "D"
 
+    class StatusChoices(models.TextChoices):
+        PENDING = "P"
+        FAILED = "F"
+
     user_id = models.CharField(max_length=20)
     last_name = models.CharField(max_length=50)
     first_name = models.CharField(max_length=50)
     email = models.EmailField()
     date_for_change = models.DateField()
     type_operation = models.CharField(max_length=1, choices=TypeChoices.choices)
+    # failed operations are retried at next_attempt_at, or given up if it is empty
+    status = models.CharField(
+        max_length=1, choices=StatusChoices.choices, default=StatusChoices.PENDING
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(null=True)
 
     class Meta:
         constraints = [
@@ -20,3 +35,100 @@ class UserOperation(models.Model):
                 name="%(app_label)s_%(class)s_unique_operation_for_user",
             ),
         ]
+        # due operations are read by type and date
+        indexes = [models.Index(fields=["type_operation", "date_for_change"])]
+
+    @classmethod
+    def pending_fields(cls) -> dict:
+        """
+        Fields to reset when an operation is scheduled again, so that it is processed on the next run
+        """
+        return dict(
+            status=cls.StatusChoices.PENDING,
+            attempts=0,
+            last_error="",
+            next_attempt_at=None,
+        )
+
+
+class ProcessedFile(models.Model):
+    """
+    Ledger of the files already processed, identified by their content
+    """
+
+    file_name = models.CharField(max_length=255)
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveBigIntegerField()
+    modified_at = models.DateTimeField()
+    processed_at = models.DateTimeField(auto_now_add=True)
+    # manifest of the archive, empty for files archived before it was kept
+    file_type = models.CharField(max_length=20, blank=True)
+    row_count = models.PositiveIntegerField(null=True)
+    archive_path = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["file_type", "processed_at"])]
+
+    @classmethod
+    def from_path(cls, file_path: Path) -> "ProcessedFile":
+        stat = file_path.stat()
+        with file_path.open("rb") as f:
+            sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+        return cls(
+            file_name=file_path.name,
+            sha256=sha256,
+            size=stat.st_size,
+            modified_at=datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+        )
+
+
+class EmployeeFingerprint(models.Model):
+    """
+    Fingerprint of the last employee update row applied for a user,
+    so that unchanged rows of the following exports can be skipped
+    """
+
+    user_id = models.CharField(max_length=20, unique=True)
+    fingerprint = models.CharField(max_length=32)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def compute(data: dict) -> str:
+        return hashlib.blake2b(
+            "\x1f".join(
+                f"{key}={value or ''}" for key, value in sorted(data.items())
+            ).encode(),
+            digest_size=16,
+        ).hexdigest()
+
+
+class FileCheckpoint(models.Model):
+    """
+    Position of the next row to process in a file being parsed, to resume it after an interruption
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    file_name = models.CharField(max_length=255)
+    offset = models.PositiveBigIntegerField(default=0)
+    row_index = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class RemoteFile(models.Model):
+    """
+    Size and modification time, as given by the FTP, of the files last downloaded
+    """
+
+    path = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(null=True)
+    modified = models.CharField(max_length=32, blank=True)
+    downloaded_at = models.DateTimeField(auto_now=True)
+
+    def is_same_as(self, other: "RemoteFile | None") -> bool:
+        # without both facts, a change can't be detected
+        return (
+            other is not None
+            and self.size is not None
+            and bool(self.modified)
+            and (self.size, self.modified) == (other.size, other.modified)
+        )
@@ -1,25 +1,258 @@
 from __future__ import annotations
 
 import csv
+import io
 import logging
-from datetime import date, datetime, timedelta
-from ftplib import FTP
+import os
+import queue
+import re
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import nullcontext
+from datetime import date, timedelta
+from functools import partial
+from itertools import islice
+from ftplib import FTP, error_perm
 from pathlib import Path
-from typing import Generator, TextIO
+from typing import Callable, Generator, Iterable, TextIO
 
 import ldap
+import zstandard
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 from django.utils.module_loading import import_string
 
-from applications.ftp_integration.ldap import BaseLDAPIntegration
-from applications.ftp_integration.models import UserOperation
-from applications.ftp_integration.utils import SessionReuseFTP_TLS
+from applications.ftp_integration.ldap import (
+    BaseLDAPIntegration,
+    LDAPPooledWrites,
+    LDAPWritePipeline,
+    PasswordResetError,
+    raise_on_error,
+)
+from applications.ftp_integration.models import (
+    EmployeeFingerprint,
+    FileCheckpoint,
+    ProcessedFile,
+    RemoteFile,
+    UserOperation,
+)
+from applications.ftp_integration.utils import (
+    ChunkStream,
+    CSVRowDecoder,
+    DateParser,
+    DeflateFTP,
+    KeyOrderedExecutor,
+    OffsetLineReader,
+    SessionReuseFTP_TLS,
+    chunked,
+    decompressed,
+)
 
 logger = logging.getLogger(__name__)
 
 
+class MissingColumnError(ValueError):
+    pass
+
+
+# decoded row of a person file, with the fields of FTPIntegrationService.headers_mapping,
+# fields not given being empty cells.
+# Declared at module level so that the rows decoded by worker processes can be pickled
+PersonRecord = namedtuple(
+    "PersonRecord",
+    ["first_name", "last_name", "email", "user_id", "date_begin", "date_end"],
+    defaults=[""] * 6,
+)
+
+
+def count_person_rows(file: TextIO) -> int:
+    """
+    Number of rows of a person file, without its header and blank lines
+    """
+    reader = csv.reader(file, strict=True, delimiter=";")
+    return max(sum(1 for row in reader if row) - 1, 0)
+
+
+def open_person_file(file_path: Path) -> TextIO:
+    """
+    Text of a person file, decompressed for .gz and .zst files
+    """
+    return io.TextIOWrapper(decompressed(file_path.open("rb")), encoding="utf-8-sig")
+
+
+def read_person_rows(
+    file: TextIO | OffsetLineReader,
+    headers_mapping: dict[str, str],
+    start_offset: int = 0,
+    start_index: int = 0,
+) -> Generator[tuple[int, str, PersonRecord], None, None]:
+    """
+    Rows of a person file as (line index, user_id, record).
+    With an OffsetLineReader, rows can start from the byte offset and index of a checkpoint
+    """
+    reader = csv.reader(
+        file,
+        strict=True,
+        delimiter=";",
+    )
+    header = next(reader, None)
+    if header is None:
+        return
+    decoder = CSVRowDecoder(header, headers_mapping, PersonRecord)
+    if start_offset:
+        file.seek(start_offset)
+    # skip blank lines like csv.DictReader
+    for index, row in enumerate((row for row in reader if row), start_index):
+        if decoder.missing_headers:
+            raise MissingColumnError(
+                f'Missing column "{decoder.missing_headers[0]}" in file {file.name}'
+            )
+        record = decoder(row)
+        yield index, record.user_id, record
+
+
+def decode_person_file(
+    file_path: Path, headers_mapping: dict[str, str], date_format: str
+) -> tuple[list[tuple[int, str, PersonRecord]], str | None]:
+    """
+    Read the rows of a file with their dates parsed, to be run by a worker process.
+    Returns the error to log if the file could not be read until the end
+    """
+    rows = []
+    date_parser = DateParser(date_format)
+    try:
+        with open_person_file(file_path) as f:
+            for index, user_id, record in read_person_rows(f, headers_mapping):
+                dates = {}
+                for key in ("date_begin", "date_end"):
+                    if value := getattr(record, key):
+                        try:
+                            dates[key] = date_parser.parse(value)
+                        except ValueError:
+                            # reported with its line when the row is processed
+                            pass
+                if dates:
+                    record = record._replace(**dates)
+                rows.append((index, user_id, record))
+    except MissingColumnError as e:
+        return rows, str(e)
+    return rows, None
+
+
+class UserOperationBuffer:
+    """
+    Collect upserts of scheduled operations to write them by batches,
+    with a single query per set of updated fields
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        # (user_id, type_operation) -> (operation, fields to update if it already exists)
+        self.pending: dict[tuple[str, str], tuple[UserOperation, set[str]]] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.flush()
+
+    def upsert(self, type_operation: str, user_id: str, **fields):
+        key = (user_id, type_operation)
+        if key not in self.pending:
+            self.pending[key] = (
+                UserOperation(user_id=user_id, type_operation=type_operation),
+                set(),
+            )
+        self.update(type_operation, user_id, **fields)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def update(self, type_operation: str, user_id: str, **fields) -> bool:
+        """
+        Change the pending upsert of an operation, returns False if there is none
+        """
+        try:
+            operation, updated_fields = self.pending[(user_id, type_operation)]
+        except KeyError:
+            return False
+        for name, value in fields.items():
+            setattr(operation, name, value)
+        updated_fields.update(fields)
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return
+        batches = defaultdict(list)
+        for operation, updated_fields in self.pending.values():
+            batches[frozenset(updated_fields)].append(operation)
+        with transaction.atomic():
+            for updated_fields, operations in batches.items():
+                UserOperation.objects.bulk_create(
+                    operations,
+                    update_conflicts=True,
+                    unique_fields=["user_id", "type_operation"],
+                    update_fields=sorted(updated_fields),
+                )
+        self.pending.clear()
+
+
+class PersonRowsByKindCoalescer:
+    """
+    Fold the rows of several files into a single row per user and type of file (first letter of its name),
+    so a user found in every type of file is still processed three times.
+    Types are not merged together as each one has its own effects and errors:
+    hiring rows schedule operations, employee update rows write to LDAP, position update rows move scheduled dates.
+    Rows of a same user are merged, the last value given for each field winning,
+    like when the rows are applied one after the other.
+    Rows that would be rejected are kept as they are, so that their errors are still reported
+    """
+
+    kinds = ("h", "e", "p")
+
+    def __init__(self):
+        # kind -> user_id -> (file name, line index, record)
+        self.folded: dict[str, dict[str, tuple[str, int, PersonRecord]]] = {
+            kind: {} for kind in self.kinds
+        }
+        # kind -> [(file name, line index, user_id, record)]
+        self.rejected: dict[str, list[tuple[str, int, str, PersonRecord]]] = {
+            kind: [] for kind in self.kinds
+        }
+
+    def add(self, file_name: str, index: int, user_id: str, record: PersonRecord):
+        kind = file_name[0]
+        if not user_id or (kind == "h" and not record.date_begin):
+            self.rejected[kind].append((file_name, index, user_id, record))
+            return
+        previous = self.folded[kind].get(user_id)
+        if previous is not None:
+            # empty cells don't replace the values of the previous rows
+            record = previous[2]._replace(
+                **{
+                    field: value
+                    for field, value in zip(record._fields, record)
+                    if value
+                }
+            )
+        self.folded[kind][user_id] = (file_name, index, record)
+
+    def rows(
+        self, kind: str
+    ) -> Generator[tuple[str, int, str, PersonRecord], None, None]:
+        yield from self.rejected[kind]
+        for user_id, (file_name, index, record) in self.folded[kind].items():
+            yield file_name, index, user_id, record
+
+
 class FTPIntegrationService:
     file_type_name = (
         "hiring",
@@ -36,132 +269,593 @@ class FTPIntegrationService:
         "Date de fin": "date_end",
     }
     date_format = "%d/%m/%Y"
+    # number of rows compared at once to the fingerprints of the last applied rows
+    fingerprint_chunk_size = 500
+    # number of due operations read with a single query, then deleted with a single query once processed
+    operation_chunk_size = 500
+    # number of employee updates waiting for their result when written by the connection pool, see LDAP_POOL_SIZE
+    pooled_update_window = 256
+    # number of downloaded chunks waiting to be parsed before the transfer is paused, see FTP_STREAM_FILES
+    stream_max_chunks = 64
 
     def __init__(self) -> None:
         super().__init__()
         self.ldap_integration: BaseLDAPIntegration = import_string(
             settings.LDAP_INTEGRATION_CLASS
         )()
+        # set while writes are pipelined, see LDAP_PIPELINE_WINDOW
+        self.write_pipeline: LDAPWritePipeline | None = None
+        # set while employee updates are written by the connection pool, see LDAP_POOL_SIZE
+        self.pooled_writes: LDAPPooledWrites | None = None
+        # file name and line index of the row being parsed
+        self.current_row: tuple[str, int] | None = None
+        # called once the row being parsed is applied, whenever its result arrives, see FILE_EMPLOYEE_UPDATE_DELTA
+        self.current_row_applied: Callable[[], None] = lambda: None
+        # set while parsing files, see OPERATION_UPSERT_BATCH_SIZE
+        self.operation_buffer: UserOperationBuffer | None = None
+        # primary key -> error, of the scheduled operations that failed in the chunk being processed
+        self.operation_errors: dict[int, Exception] = {}
+        # primary key -> number of LDAP requests waiting for their result, of the scheduled operations
+        self.operation_requests: Counter[int] = Counter()
+        # primary keys of the scheduled operations saved as their results arrived, before the end of their chunk
+        self.completed_operations: set[int] = set()
+        # set while operations are processed by threads, the database being only written by the calling thread
+        self.operation_executor: KeyOrderedExecutor | None = None
+        self.date_parser = DateParser(self.date_format)
 
     def retrieve_person_files(self):
-        ftp_class = SessionReuseFTP_TLS if settings.FTP_USE_TLS else FTP
         settings.FTP_FOLDER.mkdir(parents=True, exist_ok=True)
+        with self.open_ftp() as ftp:
+            remote_files = self.changed_remote_files(self.list_person_files(ftp))
+            if settings.FTP_DOWNLOAD_WORKERS <= 1:
+                for remote_file in remote_files:
+                    self.download_person_file(ftp, remote_file)
+                    self.save_remote_file(remote_file)
+                return
+        self.download_person_files_in_parallel(remote_files)
 
-        with ftp_class(**settings.FTP_CONNEXION) as ftp:
-            if settings.FTP_USE_TLS:
-                ftp.prot_p()
-            for file_path in ftp.nlst(self.export_folder):
-                # folder prefix or not in the path depends on the FTP server implementation
-                if not file_path.startswith(f"{self.export_folder}/"):
-                    file_path = f"{self.export_folder}/{file_path}"
-                file_path = Path(file_path)
-                if not file_path.name.startswith(self.file_type_name):
-                    continue
-                output_file_path = settings.FTP_FOLDER / file_path.name
-                with output_file_path.open(mode="wb") as output_file:
-                    ftp.retrbinary(f"RETR {file_path}", output_file.write)
-                if settings.FTP_CLEANUP_FILE:
-                    ftp.delete(str(file_path))
-                logger.info(
-                    f"processed file {file_path.name} from FTP {settings.FTP_CONNEXION['host']}"
+    def open_ftp(self) -> FTP:
+        ftp_class = SessionReuseFTP_TLS if settings.FTP_USE_TLS else DeflateFTP
+        ftp = ftp_class(**settings.FTP_CONNEXION)
+        if settings.FTP_USE_TLS:
+            ftp.prot_p()
+        return ftp
+
+    def list_person_files(self, ftp: FTP) -> list[RemoteFile]:
+        """
+        Files to download with their size and modification time,
+        from MLSD or from SIZE and MDTM if the server does not support it
+        """
+        try:
+            entries = [
+                (name, facts)
+                for name, facts in ftp.mlsd(
+                    self.export_folder, facts=["type", "size", "modify"]
                 )
+                if facts.get("type", "file") == "file"
+            ]
+        except error_perm:
+            entries = None
+        if entries is None:
+            # SIZE is usually refused in ASCII mode
+            ftp.voidcmd("TYPE I")
+            entries = [(name, None) for name in ftp.nlst(self.export_folder)]
 
-    def process_creation(self, user_id: str, data: dict):
+        remote_files = []
+        for file_path, facts in entries:
+            # folder prefix or not in the path depends on the FTP server implementation
+            if not file_path.startswith(f"{self.export_folder}/"):
+                file_path = f"{self.export_folder}/{file_path}"
+            if not Path(file_path).name.startswith(self.file_type_name):
+                continue
+            if facts is None:
+                facts = self.get_remote_file_facts(ftp, file_path)
+            remote_files.append(
+                RemoteFile(
+                    path=file_path,
+                    size=int(facts["size"]) if facts.get("size") else None,
+                    modified=facts.get("modify", ""),
+                )
+            )
+        return remote_files
+
+    def get_remote_file_facts(self, ftp: FTP, file_path: str) -> dict[str, str]:
+        facts = {}
+        try:
+            facts["size"] = str(ftp.size(file_path))
+        except error_perm:
+            pass
+        try:
+            # "213 YYYYMMDDHHMMSS[.sss]"
+            facts["modify"] = ftp.voidcmd(f"MDTM {file_path}").split()[1]
+        except (error_perm, IndexError):
+            pass
+        return facts
+
+    def changed_remote_files(self, remote_files: list[RemoteFile]) -> list[RemoteFile]:
+        """
+        Skip the files with the same size and modification time as when they were last downloaded
+        """
+        downloaded_files = RemoteFile.objects.in_bulk(
+            [remote_file.path for remote_file in remote_files], field_name="path"
+        )
+        changed_files = []
+        for remote_file in remote_files:
+            if remote_file.is_same_as(downloaded_files.get(remote_file.path)):
+                logger.info(f"skip file {remote_file.path}, unchanged on FTP")
+                continue
+            changed_files.append(remote_file)
+        return changed_files
+
+    def save_remote_file(self, remote_file: RemoteFile):
+        if settings.FTP_CLEANUP_FILE:
+            # the file is not on the FTP anymore
+            return
+        RemoteFile.objects.update_or_create(
+            path=remote_file.path,
+            defaults=dict(size=remote_file.size, modified=remote_file.modified),
+        )
+
+    def download_person_file(self, ftp: FTP, remote_file: RemoteFile):
+        file_path = Path(remote_file.path)
+        output_file_path = settings.FTP_FOLDER / file_path.name
+        # only complete files get a name handled by sorted_ftp_files,
+        # partial downloads are resumed while the remote file is unchanged
+        if remote_file.modified:
+            part_file_path = (
+                settings.FTP_FOLDER / f".{file_path.name}.{remote_file.modified}.part"
+            )
+        else:
+            part_file_path = settings.FTP_FOLDER / f".{file_path.name}.part"
+        # older versions of this file only, not those of files whose name starts the same
+        other_part_file_name = re.compile(
+            rf"\.{re.escape(file_path.name)}(\.[0-9.]+)?\.part"
+        )
+        for other_part_file_path in settings.FTP_FOLDER.iterdir():
+            if (
+                other_part_file_name.fullmatch(other_part_file_path.name)
+                and other_part_file_path != part_file_path
+            ):
+                other_part_file_path.unlink(missing_ok=True)
+
+        offset = 0
+        if remote_file.modified and part_file_path.exists():
+            offset = part_file_path.stat().st_size
+            if remote_file.size is not None and offset > remote_file.size:
+                offset = 0
+        try:
+            if remote_file.size is None or offset < remote_file.size:
+                if offset:
+                    logger.info(f"resume download of {file_path.name} at byte {offset}")
+                with part_file_path.open(mode="ab" if offset else "wb") as output_file:
+                    ftp.retrbinary(
+                        f"RETR {file_path}", output_file.write, rest=offset or None
+                    )
+        except BaseException:
+            if not remote_file.modified:
+                part_file_path.unlink(missing_ok=True)
+            raise
+        os.replace(part_file_path, output_file_path)
+        if settings.FTP_CLEANUP_FILE:
+            ftp.delete(str(file_path))
+        logger.info(
+            f"processed file {file_path.name} from FTP {settings.FTP_CONNEXION['host']}"
+        )
+
+    def download_person_files_in_parallel(self, remote_files: list[RemoteFile]):
+        """
+        Download files with FTP_DOWNLOAD_WORKERS threads, each one using its own FTP connection
+        """
+        pending_files = queue.SimpleQueue()
+        for remote_file in remote_files:
+            pending_files.put(remote_file)
+        downloaded_files = queue.SimpleQueue()
+
+        def download_pending_files():
+            with self.open_ftp() as ftp:
+                while True:
+                    try:
+                        remote_file = pending_files.get_nowait()
+                    except queue.Empty:
+                        return
+                    self.download_person_file(ftp, remote_file)
+                    downloaded_files.put(remote_file)
+
+        try:
+            with ThreadPoolExecutor(settings.FTP_DOWNLOAD_WORKERS) as executor:
+                futures = [
+                    executor.submit(download_pending_files)
+                    for _ in range(
+                        min(settings.FTP_DOWNLOAD_WORKERS, len(remote_files))
+                    )
+                ]
+            # files of a failed worker are downloaded by the other ones, then the error is raised
+            for future in futures:
+                future.result()
+        finally:
+            # saved from this thread, the database is not shared between threads
+            while not downloaded_files.empty():
+                self.save_remote_file(downloaded_files.get())
+
+    def stream_person_files(self):
+        """
+        Download the changed files one after the other, parsing each one while it is transferred.
+        A copy of each file is still written to FTP_FOLDER, then archived like the files processed from there
+        """
+        settings.FTP_FOLDER.mkdir(parents=True, exist_ok=True)
+        with self.ldap_integration, self.open_ftp() as ftp:
+            remote_files = sorted(
+                self.changed_remote_files(self.list_person_files(ftp)),
+                key=lambda remote_file: self.file_sort_key(Path(remote_file.path).name),
+            )
+            for remote_file in remote_files:
+                self.stream_person_file(ftp, remote_file)
+                self.save_remote_file(remote_file)
+
+    def stream_person_file(self, ftp: FTP, remote_file: RemoteFile):
+        file_path = Path(remote_file.path)
+        output_file_path = settings.FTP_FOLDER / file_path.name
+        part_file_path = settings.FTP_FOLDER / f".{file_path.name}.part"
+        stream = ChunkStream(str(output_file_path), self.stream_max_chunks)
+
+        def transfer():
+            try:
+                with part_file_path.open("wb") as output_file:
+
+                    def write(chunk: bytes):
+                        output_file.write(chunk)
+                        stream.put(chunk)
+
+                    ftp.retrbinary(f"RETR {file_path}", write)
+            except BaseException as e:
+                # raised by the parsing thread, unless the parsing already failed
+                stream.end(e)
+            else:
+                stream.end()
+
+        try:
+            with ThreadPoolExecutor(1) as executor:
+                executor.submit(transfer)
+                # closed on error, which stops the transfer
+                with io.TextIOWrapper(
+                    decompressed(io.BufferedReader(stream)), encoding="utf-8-sig"
+                ) as f:
+                    row_count = self.parse_file(f)
+                    # the rows may not be read until the end, on missing columns
+                    stream.drain()
+        except BaseException:
+            part_file_path.unlink(missing_ok=True)
+            raise
+        os.replace(part_file_path, output_file_path)
+
+        processed_file = ProcessedFile.from_path(output_file_path)
+        # the content is only known once parsed, unlike files processed from FTP_FOLDER
+        if not ProcessedFile.objects.filter(sha256=processed_file.sha256).exists():
+            processed_file.save()
+        self.archive_file(output_file_path, processed_file, row_count)
+        if settings.FTP_CLEANUP_FILE:
+            ftp.delete(str(file_path))
+        logger.info(
+            f"processed file {file_path.name} from FTP {settings.FTP_CONNEXION['host']}"
+        )
+
+    def open_write_pipeline(self) -> LDAPWritePipeline | nullcontext:
+        """
+        Pipeline LDAP writes if configured, otherwise they are done synchronously
+        """
+        if settings.LDAP_PIPELINE_WINDOW:
+            return self.ldap_integration.write_pipeline(settings.LDAP_PIPELINE_WINDOW)
+        return nullcontext()
+
+    def open_operation_buffer(self) -> UserOperationBuffer | nullcontext:
+        if settings.OPERATION_UPSERT_BATCH_SIZE:
+            return UserOperationBuffer(settings.OPERATION_UPSERT_BATCH_SIZE)
+        return nullcontext()
+
+    def _upsert_operation(self, type_operation: str, user_id: str, **fields):
+        fields.update(UserOperation.pending_fields())
+        if self.operation_buffer is not None:
+            self.operation_buffer.upsert(type_operation, user_id, **fields)
+            return
+        UserOperation.objects.update_or_create(
+            type_operation=type_operation, user_id=user_id, defaults=fields
+        )
+
+    def _update_operation(self, type_operation: str, user_id: str, **fields) -> bool:
+        """
+        Update an existing scheduled operation, returns False if there is none.
+        Its retry state is only reset when the update changes it,
+        so that a failing operation repeated by every file is still given up
+        """
+        if self.operation_buffer is not None and self.operation_buffer.update(
+            type_operation, user_id, **fields
+        ):
+            # the buffered upsert overwrites the fields of the existing operation if any, and resets it
+            return True
+        operations = UserOperation.objects.filter(
+            type_operation=type_operation, user_id=user_id
+        )
+        if fields and operations.exclude(**fields).update(
+            **fields, **UserOperation.pending_fields()
+        ):
+            return True
+        return operations.exists()
+
+    def parse_date(self, value: str | date) -> date:
+        # dates are already parsed when files are decoded by worker processes
+        if isinstance(value, date):
+            return value
+        return self.date_parser.parse(value)
+
+    def process_creation(self, user_id: str, record: PersonRecord):
         assert user_id, "user_id can't be empty"
-        date_begin = data.pop("date_begin", None)
-        date_end = data.pop("date_end", None)
-        if not date_begin:
+        if not record.date_begin:
             raise ValueError("Missing date_begin field")
-        UserOperation.objects.update_or_create(
-            type_operation=UserOperation.TypeChoices.CREATION,
-            user_id=user_id,
-            defaults=dict(
-                date_for_change=datetime.strptime(date_begin, self.date_format), **data
-            ),
+        self._upsert_operation(
+            UserOperation.TypeChoices.CREATION,
+            user_id,
+            date_for_change=self.parse_date(record.date_begin),
+            first_name=record.first_name,
+            last_name=record.last_name,
+            email=record.email,
         )
-        self._update_date_end(user_id, date_end)
+        self._update_date_end(user_id, record.date_end)
 
-    def process_employee_update(self, user_id: str, data: dict):
+    def process_employee_update(self, user_id: str, record: PersonRecord):
         assert user_id, "user_id can't be empty"
-        employee_data = {
-            key: data[key]
-            for key in {"first_name", "last_name", "email"}
-            if key in data
-        }
-        try:
-            self.ldap_integration.update_ldap_user(user_id, **employee_data)
-        except ldap.NO_SUCH_OBJECT:
-            # try to update existing creation query
-            object_number = UserOperation.objects.filter(
-                type_operation=UserOperation.TypeChoices.CREATION, user_id=user_id
-            ).update(**employee_data)
-            if object_number == 0:
-                # No operation scheduled, treat the line as a creation instead
-                self.process_creation(user_id, data)
-
-    def process_position_update(self, user_id: str, data: dict):
+        employee_data = dict(
+            first_name=record.first_name,
+            last_name=record.last_name,
+            email=record.email,
+        )
+        if self.write_pipeline is None and self.pooled_writes is None:
+            try:
+                self.ldap_integration.update_ldap_user(user_id, **employee_data)
+            except ldap.NO_SUCH_OBJECT:
+                self._update_creation_operation(user_id, record, employee_data)
+            self.current_row_applied()
+            return
+
+        file_name, index = self.current_row
+        row_applied = self.current_row_applied
+
+        def on_result(error: ldap.LDAPError | None):
+            if not isinstance(error, ldap.NO_SUCH_OBJECT):
+                if error is not None:
+                    raise error
+                row_applied()
+                return
+            try:
+                self._update_creation_operation(user_id, record, employee_data)
+            except (ValueError, AssertionError) as e:
+                # the row is not the one currently parsed, log it with its own position
+                logger.exception(f"Error '{e}' in file {file_name} L.{index+1}")
+            else:
+                row_applied()
+
+        if self.pooled_writes is not None:
+            # the database is only written by this thread, from the callbacks
+            self.pooled_writes.submit(
+                user_id,
+                "update_ldap_user",
+                user_id,
+                callback=on_result,
+                **employee_data,
+            )
+            return
+        self.ldap_integration.submit_update_ldap_user(
+            self.write_pipeline, on_result, user_id, **employee_data
+        )
+
+    def _update_creation_operation(
+        self, user_id: str, record: PersonRecord, employee_data: dict
+    ):
+        # try to update existing creation query
+        if not self._update_operation(
+            UserOperation.TypeChoices.CREATION, user_id, **employee_data
+        ):
+            # No operation scheduled, treat the line as a creation instead
+            self.process_creation(user_id, record)
+
+    def process_position_update(self, user_id: str, record: PersonRecord):
         assert user_id, "user_id can't be empty"
         # update only begin and end date for now, no management of job change
-        date_begin = data.pop("date_begin", None)
-        date_end = data.pop("date_end", None)
-        if date_begin:
+        if record.date_begin:
             # We don't care if it does not exist, that means the user was already created
-            UserOperation.objects.filter(
-                type_operation=UserOperation.TypeChoices.CREATION, user_id=user_id
-            ).update(date_for_change=datetime.strptime(date_begin, self.date_format))
-        self._update_date_end(user_id, date_end)
+            self._update_operation(
+                UserOperation.TypeChoices.CREATION,
+                user_id,
+                date_for_change=self.parse_date(record.date_begin),
+            )
+        self._update_date_end(user_id, record.date_end)
 
     def _update_date_end(self, user_id: str, date_end: str):
         if date_end:
-            UserOperation.objects.update_or_create(
-                type_operation=UserOperation.TypeChoices.DELETION,
-                user_id=user_id,
-                defaults=dict(
-                    date_for_change=datetime.strptime(date_end, self.date_format),
-                ),
+            self._upsert_operation(
+                UserOperation.TypeChoices.DELETION,
+                user_id,
+                date_for_change=self.parse_date(date_end),
             )
 
-    def parse_file(self, file: TextIO):
-        logger.debug(f" Parsing file : {file.name}")
-
-        match Path(file.name).name[0]:
+    def get_process_function(
+        self, file_name: str
+    ) -> Callable[[str, PersonRecord], None]:
+        match Path(file_name).name[0]:
             case "h":  # Hiring
-                process_function = self.process_creation
+                return self.process_creation
             case "e":  # Employee
-                process_function = self.process_employee_update
+                return self.process_employee_update
             case "p":  # Position
-                process_function = self.process_position_update
+                return self.process_position_update
             case _:
-                raise ValueError(f"File {file.name} is not handled")
+                raise ValueError(f"File {file_name} is not handled")
 
-        reader = csv.DictReader(
-            file,
-            strict=True,
-            delimiter=";",
+    def parse_file(self, file: TextIO) -> int:
+        logger.debug(f" Parsing file : {file.name}")
+        process_function = self.get_process_function(file.name)
+        return self.process_rows(
+            process_function,
+            (
+                (file.name, index, user_id, record)
+                for index, user_id, record in self.read_rows(file)
+            ),
         )
-        for index, line in enumerate(reader):
-            try:
-                data = {
-                    data_key: line[line_header]
-                    for line_header, data_key in self.headers_mapping.items()
-                }
-            except KeyError as e:
-                logger.error(f'Missing column "{e.args[0]}" in file {file.name}')
-                break
-            user_id = data.pop("user_id")
-            try:
-                process_function(user_id, data)
-            except (ValueError, AssertionError) as e:
-                logger.exception(f"Error '{e}' in file {file.name} L.{index+1}")
+
+    def process_rows(
+        self,
+        process_function: Callable[[str, PersonRecord], None],
+        rows: Iterable[tuple[str, int, str, PersonRecord]],
+    ) -> int:
+        """
+        Apply process_function on each (file name, line index, user_id, record) row,
+        returns the number of rows read
+        """
+        # only updates need to look for existing users in LDAP
+        prefetch = (
+            settings.LDAP_LOOKUP_CHUNK_SIZE
+            and process_function == self.process_employee_update
+        )
+        delta = (
+            settings.FILE_EMPLOYEE_UPDATE_DELTA
+            and process_function == self.process_employee_update
+        )
+        pooled = (
+            settings.LDAP_POOL_SIZE > 1
+            and process_function == self.process_employee_update
+        )
+        chunk_size = settings.LDAP_LOOKUP_CHUNK_SIZE or (
+            self.fingerprint_chunk_size if delta else 1
+        )
+        # user_id -> fingerprint of the last row applied
+        applied_fingerprints = {}
+        # user_id -> fingerprint of the last row kept, compared to the following rows of the same user
+        accepted_fingerprints = {}
+        row_count = 0
+        # the pipeline or the pooled writes are flushed at the end of the rows, before any following file is parsed,
+        # then the buffered operations, including those scheduled by the write callbacks
+        try:
+            with (
+                self.open_operation_buffer() as self.operation_buffer,
+                (
+                    self.ldap_integration.pooled_writes(self.pooled_update_window)
+                    if pooled
+                    else nullcontext()
+                ) as self.pooled_writes,
+                (
+                    nullcontext() if pooled else self.open_write_pipeline()
+                ) as self.write_pipeline,
+            ):
+                for chunk in chunked(rows, chunk_size):
+                    row_count += len(chunk)
+                    if delta:
+                        chunk = self.changed_employee_rows(chunk, accepted_fingerprints)
+                    else:
+                        chunk = [(*row, None) for row in chunk]
+                    if prefetch:
+                        if self.pooled_writes is not None:
+                            # the writes of the previous chunk look for their users in its prefetched ones
+                            self.pooled_writes.flush()
+                        self.ldap_integration.prefetch_ldap_users(
+                            user_id for _, _, user_id, _, _ in chunk if user_id
+                        )
+                    for file_name, index, user_id, record, fingerprint in chunk:
+                        self.current_row = (file_name, index)
+                        if fingerprint is None:
+                            self.current_row_applied = lambda: None
+                        else:
+                            self.current_row_applied = partial(
+                                applied_fingerprints.__setitem__, user_id, fingerprint
+                            )
+                        try:
+                            process_function(user_id, record)
+                        except (ValueError, AssertionError) as e:
+                            logger.exception(
+                                f"Error '{e}' in file {file_name} L.{index+1}"
+                            )
+        finally:
+            self.write_pipeline = None
+            self.pooled_writes = None
+            self.operation_buffer = None
+            self.current_row_applied = lambda: None
+            if prefetch:
+                self.ldap_integration.clear_prefetched_ldap_users()
+        if applied_fingerprints:
+            # only saved once every write is done, so that failed rows are applied again next time
+            EmployeeFingerprint.objects.bulk_create(
+                [
+                    EmployeeFingerprint(user_id=user_id, fingerprint=fingerprint)
+                    for user_id, fingerprint in applied_fingerprints.items()
+                ],
+                batch_size=self.fingerprint_chunk_size,
+                update_conflicts=True,
+                unique_fields=["user_id"],
+                update_fields=["fingerprint", "updated_at"],
+            )
+        return row_count
+
+    def changed_employee_rows(
+        self,
+        rows: list[tuple[str, int, str, PersonRecord]],
+        accepted_fingerprints: dict[str, str],
+    ) -> list[tuple[str, int, str, PersonRecord, str]]:
+        """
+        Keep the rows that differ from the last one kept for the same user during this run,
+        or else from the last one applied by a previous run, with their fingerprint.
+        accepted_fingerprints is updated with the rows kept
+        """
+        fingerprints = dict(
+            EmployeeFingerprint.objects.filter(
+                user_id__in={user_id for _, _, user_id, _ in rows}
+            ).values_list("user_id", "fingerprint")
+        )
+        changed_rows = []
+        for file_name, index, user_id, record in rows:
+            fingerprint = EmployeeFingerprint.compute(self.fingerprint_data(record))
+            if not user_id:
+                changed_rows.append((file_name, index, user_id, record, fingerprint))
                 continue
+            last_fingerprint = accepted_fingerprints.get(
+                user_id, fingerprints.get(user_id)
+            )
+            if last_fingerprint != fingerprint:
+                accepted_fingerprints[user_id] = fingerprint
+                changed_rows.append((file_name, index, user_id, record, fingerprint))
+        logger.debug(f"{len(rows) - len(changed_rows)} unchanged rows skipped")
+        return changed_rows
 
-    def sorted_ftp_files(self, folder_path: Path) -> Generator[Path, None, None]:
+    def fingerprint_data(self, record: PersonRecord) -> dict:
+        """
+        Row data without its user id and with its dates parsed, so that rows decoded by worker processes
+        get the same fingerprint as those parsed in this process
+        """
+        data = record._asdict()
+        del data["user_id"]
+        for key in ("date_begin", "date_end"):
+            if data.get(key):
+                try:
+                    data[key] = self.parse_date(data[key])
+                except ValueError:
+                    pass
+        return data
+
+    def read_rows(
+        self, file: TextIO
+    ) -> Generator[tuple[int, str, PersonRecord], None, None]:
+        try:
+            yield from read_person_rows(file, self.headers_mapping)
+        except MissingColumnError as e:
+            logger.error(e)
+
+    @staticmethod
+    def file_sort_key(file_name: str) -> str:
         # assign ordering from first letter of file name
         file_ordering = {"h": 0, "e": 1, "p": 1}
+        return f"{file_ordering.get(file_name[0], -1)}{file_name}"
+
+    def sorted_ftp_files(self, folder_path: Path) -> Generator[Path, None, None]:
         # iterate so that user creation comes first
         for file_path in sorted(
-            folder_path.iterdir(),
-            key=lambda path: f"{file_ordering.get(path.name[0], -1)}{path.name}",
+            folder_path.iterdir(), key=lambda path: self.file_sort_key(path.name)
         ):
             if not file_path.is_file() or not file_path.name.startswith(
                 self.file_type_name
@@ -171,16 +865,222 @@ class FTPIntegrationService:
 
     def process_person_files(self):
         with self.ldap_integration:
-            for file_path in self.sorted_ftp_files(
-                settings.FTP_FOLDER,
+            if settings.FILE_COALESCE_ROWS:
+                self.process_coalesced_person_files()
+                return
+            if settings.FILE_DECODE_WORKERS > 1:
+                pending_files = list(self.pending_person_files())
+                for rows, (file_path, processed_file) in zip(
+                    self.decode_person_files(pending_files), pending_files
+                ):
+                    logger.debug(f" Parsing file : {file_path}")
+                    row_count = self.process_rows(
+                        self.get_process_function(file_path.name),
+                        (
+                            (str(file_path), index, user_id, record)
+                            for index, user_id, record in rows
+                        ),
+                    )
+                    processed_file.save()
+                    self.archive_file(file_path, processed_file, row_count)
+                return
+            for file_path, processed_file in self.pending_person_files():
+                if settings.FILE_CHECKPOINT_INTERVAL:
+                    row_count = self.parse_file_with_checkpoints(
+                        file_path, processed_file.sha256
+                    )
+                else:
+                    with open_person_file(file_path) as f:
+                        row_count = self.parse_file(f)
+                with transaction.atomic():
+                    processed_file.save()
+                    FileCheckpoint.objects.filter(sha256=processed_file.sha256).delete()
+                self.archive_file(file_path, processed_file, row_count)
+
+    def parse_file_with_checkpoints(self, file_path: Path, sha256: str) -> int:
+        """
+        Parse the file by batches of FILE_CHECKPOINT_INTERVAL rows, saving the position of the next row
+        once the writes of a batch are done, so that an interrupted parsing resumes from there.
+        Returns the number of rows read, including those of the interrupted runs
+        """
+        process_function = self.get_process_function(file_path.name)
+        checkpoint, _ = FileCheckpoint.objects.get_or_create(
+            sha256=sha256, defaults=dict(file_name=file_path.name)
+        )
+        if checkpoint.offset:
+            logger.info(
+                f"resume file {file_path.name} from L.{checkpoint.row_index + 1}"
+            )
+        logger.debug(f" Parsing file : {file_path}")
+        with decompressed(file_path.open("rb")) as f:
+            reader = OffsetLineReader(f)
+            rows = read_person_rows(
+                reader, self.headers_mapping, checkpoint.offset, checkpoint.row_index
+            )
+            try:
+                for batch in chunked(rows, settings.FILE_CHECKPOINT_INTERVAL):
+                    # the pipeline and buffered operations are flushed at the end of the batch
+                    self.process_rows(
+                        process_function,
+                        (
+                            (str(file_path), index, user_id, record)
+                            for index, user_id, record in batch
+                        ),
+                    )
+                    checkpoint.offset = reader.offset
+                    checkpoint.row_index = batch[-1][0] + 1
+                    checkpoint.save(update_fields=["offset", "row_index", "updated_at"])
+            except MissingColumnError as e:
+                logger.error(e)
+        return checkpoint.row_index
+
+    def decode_person_files(
+        self, pending_files: list[tuple[Path, ProcessedFile]]
+    ) -> Generator[list[tuple[int, str, PersonRecord]], None, None]:
+        """
+        Rows of each file, in the same order, decoded in parallel by FILE_DECODE_WORKERS processes
+        while the rows of the previous files are processed.
+        Only FILE_DECODE_WORKERS files are decoded ahead, so that the rows of every file are not held at once
+        """
+        pending_file_paths = (file_path for file_path, _ in pending_files)
+        with ProcessPoolExecutor(settings.FILE_DECODE_WORKERS) as executor:
+
+            def submit(file_path: Path) -> Future:
+                return executor.submit(
+                    decode_person_file,
+                    file_path,
+                    self.headers_mapping,
+                    self.date_format,
+                )
+
+            futures = deque(
+                submit(file_path)
+                for file_path in islice(
+                    pending_file_paths, settings.FILE_DECODE_WORKERS
+                )
+            )
+            while futures:
+                rows, error = futures.popleft().result()
+                next_file_path = next(pending_file_paths, None)
+                if next_file_path is not None:
+                    futures.append(submit(next_file_path))
+                yield rows
+                if error is not None:
+                    # logged after the rows read before the error, like parse_file
+                    logger.error(error)
+
+    def process_coalesced_person_files(self):
+        """
+        Read every pending file before applying the rows, so that each user is processed at most once
+        per type of file whatever the number of files they appear in
+        """
+        pending_files = list(self.pending_person_files())
+        coalescer = PersonRowsByKindCoalescer()
+        row_counts = {}
+        for file_path, _ in pending_files:
+            logger.debug(f" Reading file : {file_path.name}")
+            row_counts[file_path] = 0
+            with open_person_file(file_path) as f:
+                for index, user_id, record in self.read_rows(f):
+                    coalescer.add(file_path.name, index, user_id, record)
+                    row_counts[file_path] += 1
+        # same ordering as sorted_ftp_files: creations first
+        for kind in coalescer.kinds:
+            self.process_rows(self.get_process_function(kind), coalescer.rows(kind))
+        for file_path, processed_file in pending_files:
+            processed_file.save()
+            self.archive_file(file_path, processed_file, row_counts[file_path])
+
+    def pending_person_files(self) -> Generator[tuple[Path, ProcessedFile], None, None]:
+        """
+        Files to process with their ledger entry, to save once processed.
+        Files with the same content as an already processed one are archived without being parsed
+        """
+        pending_hashes = set()
+        for file_path in self.sorted_ftp_files(settings.FTP_FOLDER):
+            processed_file = ProcessedFile.from_path(file_path)
+            if (
+                processed_file.sha256 in pending_hashes
+                or ProcessedFile.objects.filter(sha256=processed_file.sha256).exists()
             ):
-                with file_path.open("r", encoding="utf-8-sig") as f:
-                    self.parse_file(f)
-                processed_folder = Path(
-                    timezone.now().strftime(str(settings.FTP_PROCESSED_FOLDER))
+                logger.info(f"skip file {file_path.name}, already processed")
+                self.archive_file(file_path, processed_file)
+                continue
+            pending_hashes.add(processed_file.sha256)
+            yield file_path, processed_file
+
+    def archive_file(
+        self, file_path: Path, processed_file: ProcessedFile, row_count: int = None
+    ):
+        """
+        Move a file out of FTP_FOLDER once processed, recording in its ledger entry
+        its type, its number of rows read and where it is archived.
+        With FILE_ARCHIVE_COMPRESSED, each content is stored once in FTP_ARCHIVE_FOLDER, compressed with zstandard
+        """
+        if settings.FILE_ARCHIVE_COMPRESSED:
+            archive_path = self.compressed_archive_path(processed_file.sha256)
+            if not archive_path.exists():
+                archive_path.parent.mkdir(parents=True, exist_ok=True)
+                part_path = archive_path.with_name(f".{archive_path.name}.part")
+                with (
+                    decompressed(file_path.open("rb")) as f,
+                    part_path.open("wb") as output_file,
+                ):
+                    zstandard.ZstdCompressor().copy_stream(f, output_file)
+                os.replace(part_path, archive_path)
+        else:
+            processed_folder = Path(
+                timezone.now().strftime(str(settings.FTP_PROCESSED_FOLDER))
+            )
+            processed_folder.mkdir(parents=True, exist_ok=True)
+            archive_path = processed_folder / file_path.name
+
+        file_type = next(
+            (
+                file_type
+                for file_type in self.file_type_name
+                if file_path.name.startswith(file_type)
+            ),
+            "",
+        )
+        if processed_file.pk is not None:
+            processed_file.file_type = file_type
+            processed_file.row_count = row_count
+            processed_file.archive_path = str(archive_path)
+            processed_file.save(
+                update_fields=["file_type", "row_count", "archive_path"]
+            )
+        else:
+            # the content was already processed, but its ledger entry has no archive
+            # when the run processing it stopped before archiving the file
+            unarchived_files = ProcessedFile.objects.filter(
+                sha256=processed_file.sha256, archive_path=""
+            )
+            if unarchived_files.exists():
+                if row_count is None:
+                    with open_person_file(file_path) as f:
+                        row_count = count_person_rows(f)
+                unarchived_files.update(
+                    file_type=file_type,
+                    row_count=row_count,
+                    archive_path=str(archive_path),
                 )
-                processed_folder.mkdir(parents=True, exist_ok=True)
-                file_path.rename(processed_folder / file_path.name)
+
+        if settings.FILE_ARCHIVE_COMPRESSED:
+            file_path.unlink()
+        else:
+            file_path.rename(archive_path)
+
+    def compressed_archive_path(self, sha256: str) -> Path:
+        # sharded so that folders stay small
+        return settings.FTP_ARCHIVE_FOLDER / sha256[:2] / f"{sha256}.csv.zst"
+
+    def open_archived_file(self, processed_file: ProcessedFile) -> TextIO:
+        if not processed_file.archive_path:
+            raise FileNotFoundError(
+                f"No archive recorded for file {processed_file.file_name}"
+            )
+        return open_person_file(Path(processed_file.archive_path))
 
     def process_db_operation(self):
         today = date.today()
@@ -188,46 +1088,295 @@ class FTPIntegrationService:
         # would be good to use select_for_update to lock the rows, but it does not exist on sqlite
         # it is of no matter because all operations are launched sequentially
         # so we don't really care about concurrency
-        creation_filter = Q(
+        # failed operations are retried once their delay is over
+        retry_filter = Q(status=UserOperation.StatusChoices.PENDING) | Q(
+            status=UserOperation.StatusChoices.FAILED,
+            next_attempt_at__lte=timezone.now(),
+        )
+        creation_filter = retry_filter & Q(
             type_operation=UserOperation.TypeChoices.CREATION,
             date_for_change__lte=today + timedelta(days=1),
         )
-        deletion_filter = Q(
+        deletion_filter = retry_filter & Q(
             type_operation=UserOperation.TypeChoices.DELETION,
             date_for_change__lte=today - timedelta(days=1),
         )
 
         with self.ldap_integration:
-            for operation in UserOperation.objects.filter(creation_filter):
-                # employee arrive tomorrow or before, create them
-                employee_data = dict(
-                    user_id=operation.user_id,
-                    first_name=operation.first_name,
-                    last_name=operation.last_name,
-                    email=operation.email,
+            if settings.LDAP_POOL_SIZE > 1:
+                self._process_db_operation_in_parallel(creation_filter, deletion_filter)
+            else:
+                with self.open_write_pipeline() as pipeline:
+                    for operations in self.due_operations(creation_filter):
+                        for operation in operations:
+                            # employee arrive tomorrow or before, create them
+                            self.create_user(operation, pipeline)
+                        if pipeline is not None:
+                            # creations must be done before deleting their operations and the same users
+                            pipeline.flush()
+                        self.check_password_resets(operations)
+                        self.complete_operations(operations)
+
+                    for operations in self.due_operations(
+                        deletion_filter, prefetch=True
+                    ):
+                        for operation in operations:
+                            # employee left yesterday or before, delete them
+                            self.delete_user(operation, pipeline)
+                        if pipeline is not None:
+                            pipeline.flush()
+                        self.complete_operations(operations)
+
+    def _process_db_operation_in_parallel(self, creation_filter: Q, deletion_filter: Q):
+        # operations are spread over the connection pool, chunk after chunk,
+        # so the creation of a user is done before their deletion
+        try:
+            with (
+                self.ldap_integration.open_pool(),
+                KeyOrderedExecutor(settings.LDAP_POOL_SIZE) as self.operation_executor,
+            ):
+                for function, operations_filter, prefetch in (
+                    (self.create_user, creation_filter, False),
+                    (self.delete_user, deletion_filter, True),
+                ):
+                    for operations in self.due_operations(operations_filter, prefetch):
+                        futures = {
+                            self.operation_executor.submit(
+                                operation.user_id,
+                                self._run_with_pooled_connection,
+                                function,
+                                operation,
+                            ): operation
+                            for operation in operations
+                        }
+                        for future in as_completed(futures):
+                            if future.exception() is None:
+                                self.finish_operation(futures[future])
+                        self.check_password_resets(operations)
+                        # unexpected errors are raised when leaving the executor, their operations are kept as is
+                        self.complete_operations(
+                            [
+                                operation
+                                for future, operation in futures.items()
+                                if future.exception() is None
+                            ]
+                        )
+        finally:
+            self.operation_executor = None
+
+    def due_operations(
+        self, operations_filter: Q, prefetch: bool = False
+    ) -> Generator[list[tuple], None, None]:
+        """
+        Iterate over operations by chunks, as rows with the fields used to process them.
+        Each chunk is read with its own query following the (type_operation, date_for_change) index,
+        so that operations can be deleted in between.
+        With prefetch, all users of a chunk are looked for in LDAP at once if configured
+        """
+        chunk_size = settings.LDAP_LOOKUP_CHUNK_SIZE or self.operation_chunk_size
+        operations = (
+            UserOperation.objects.filter(operations_filter)
+            .order_by("date_for_change", "pk")
+            .values_list(
+                "pk",
+                "type_operation",
+                "user_id",
+                "first_name",
+                "last_name",
+                "email",
+                "date_for_change",
+                "attempts",
+                "last_error",
+                named=True,
+            )
+        )
+        next_operations = operations
+        while True:
+            chunk = list(next_operations[:chunk_size])
+            if not chunk:
+                return
+            if prefetch and settings.LDAP_LOOKUP_CHUNK_SIZE:
+                self.ldap_integration.prefetch_ldap_users(
+                    operation.user_id for operation in chunk
+                )
+            yield chunk
+            if prefetch and settings.LDAP_LOOKUP_CHUNK_SIZE:
+                self.ldap_integration.clear_prefetched_ldap_users()
+            # keyset pagination, operations that failed are not read again
+            last_operation = chunk[-1]
+            next_operations = operations.filter(
+                Q(date_for_change__gt=last_operation.date_for_change)
+                | Q(pk__gt=last_operation.pk),
+                date_for_change__gte=last_operation.date_for_change,
+            )
+
+    def complete_operations(self, operations: list[tuple]):
+        """
+        Delete the processed operations with a single query,
+        and save the failed ones one by one to retry them after an exponential backoff.
+        Operations already completed as their results arrived are skipped
+        """
+        now = timezone.now()
+        done_pks = []
+        for operation in operations:
+            self.operation_requests.pop(operation.pk, None)
+            if operation.pk in self.completed_operations:
+                self.completed_operations.discard(operation.pk)
+                continue
+            error = self.operation_errors.pop(operation.pk, None)
+            if error is None:
+                done_pks.append(operation.pk)
+                continue
+            attempts = operation.attempts + 1
+            if (
+                settings.OPERATION_MAX_ATTEMPTS
+                and attempts >= settings.OPERATION_MAX_ATTEMPTS
+            ):
+                logger.error(
+                    f"User {operation.user_id} operation given up after {attempts} attempts"
+                )
+                next_attempt_at = None
+            else:
+                next_attempt_at = now + timedelta(
+                    seconds=settings.OPERATION_RETRY_DELAY * 2 ** (attempts - 1)
                 )
+            UserOperation.objects.filter(pk=operation.pk).update(
+                status=UserOperation.StatusChoices.FAILED,
+                attempts=attempts,
+                last_error=f"{type(error).__name__}: {error}",
+                next_attempt_at=next_attempt_at,
+            )
+        UserOperation.objects.filter(pk__in=done_pks).delete()
+
+    def check_password_resets(self, operations: list[tuple]):
+        """
+        Set the passwords still waiting for the users created by the operations,
+        and fail the operations of the users whose password could not be set so that they are retried
+        """
+        operations_by_user_id = {
+            operation.user_id: operation for operation in operations
+        }
+        for user_id, error in self.ldap_integration.flush_password_resets().items():
+            operation = operations_by_user_id.get(user_id)
+            if error is not None and operation is not None:
+                self.fail_operation(operation, PasswordResetError(error))
+
+    def finish_operation(self, operation: tuple):
+        """
+        Complete an operation once each of its LDAP requests got its result,
+        so that a run stopped before the end of the chunk does not process it again
+        """
+        if (
+            operation.type_operation == UserOperation.TypeChoices.CREATION
+            and self.ldap_integration.defers_password_resets
+        ):
+            # completed with its chunk, once its password is set
+            return
+        self.complete_operations([operation])
+        self.completed_operations.add(operation.pk)
+
+    def fail_operation(self, operation: tuple, error: Exception):
+        operation_name = UserOperation.TypeChoices(operation.type_operation).name
+        logger.error(
+            f"Error '{error}' in user {operation.user_id} {operation_name.lower()} operation",
+            exc_info=error,
+        )
+        self.operation_errors[operation.pk] = error
+
+    def operation_callback(
+        self, operation: tuple, callback: Callable[[ldap.LDAPError | None], None]
+    ) -> Callable[[ldap.LDAPError | None], None]:
+        """
+        Wrap a result callback so that the errors it raises are those of the operation,
+        whichever operation is being submitted when the result is received.
+        The operation is completed once the results of all its callbacks are received
+        """
+        self.operation_requests[operation.pk] += 1
+
+        def on_result(error: ldap.LDAPError | None):
+            try:
+                callback(error)
+            except (ValueError, ldap.LDAPError) as e:
+                self.fail_operation(operation, e)
+            self.operation_requests[operation.pk] -= 1
+            if (
+                not self.operation_requests[operation.pk]
+                and self.operation_executor is None
+            ):
+                self.finish_operation(operation)
+
+        return on_result
+
+    def _run_with_pooled_connection(self, function: Callable, *args):
+        with self.ldap_integration.checkout_connection():
+            function(*args)
+
+    def create_user(self, operation: tuple, pipeline: LDAPWritePipeline | None = None):
+        employee_data = dict(
+            user_id=operation.user_id,
+            first_name=operation.first_name,
+            last_name=operation.last_name,
+            email=operation.email,
+        )
+
+        def handle_result(error: ldap.LDAPError | None):
+            if not isinstance(error, ldap.ALREADY_EXISTS):
+                if error is not None:
+                    raise error
+                return
+            if operation.last_error.startswith(f"{PasswordResetError.__name__}:"):
+                # created by a previous attempt, but still disabled without a password
+                self.ldap_integration.reset_ldap_user_password(operation.user_id)
+            else:
+                logger.warning(
+                    f"Creation operation scheduled for already existing user {operation.user_id}"
+                )
+            if pipeline is None:
+                self.ldap_integration.update_ldap_user(**employee_data)
+            else:
+                self.ldap_integration.submit_update_ldap_user(
+                    pipeline,
+                    self.operation_callback(operation, raise_on_error),
+                    **employee_data,
+                )
+
+        on_result = self.operation_callback(operation, handle_result)
+        try:
+            if pipeline is None:
                 try:
                     self.ldap_integration.create_ldap_user(**employee_data)
-                except ValueError as e:
-                    logger.exception(
-                        f"Error '{e}' in user {operation.user_id} creation operation"
-                    )
-                    continue
-                except ldap.ALREADY_EXISTS:
-                    logger.warning(
-                        f"Creation operation scheduled for already existing user {operation.user_id}"
-                    )
-                    self.ldap_integration.update_ldap_user(**employee_data)
+                except ldap.LDAPError as e:
+                    on_result(e)
+                else:
+                    on_result(None)
+            else:
+                self.ldap_integration.submit_create_ldap_user(
+                    pipeline, on_result, **employee_data
+                )
+        except (ValueError, ldap.LDAPError) as e:
+            self.fail_operation(operation, e)
+
+    def delete_user(self, operation: tuple, pipeline: LDAPWritePipeline | None = None):
+        def handle_result(error: ldap.LDAPError | None):
+            if isinstance(error, ldap.NO_SUCH_OBJECT):
+                logger.warning(f"Trying to delete nonexistent user {operation.user_id}")
+            elif error is not None:
+                raise error
 
-            for operation in UserOperation.objects.filter(deletion_filter):
-                # employee left yesterday or before, delete them
+        on_result = self.operation_callback(operation, handle_result)
+        try:
+            if pipeline is None:
                 try:
                     self.ldap_integration.delete_ldap_user(
                         user_id=operation.user_id,
                     )
-                except ldap.NO_SUCH_OBJECT:
-                    logger.warning(
-                        f"Trying to delete nonexistent user {operation.user_id}"
-                    )
-                    continue
-        UserOperation.objects.filter(creation_filter | deletion_filter).delete()
+                except ldap.LDAPError as e:
+                    on_result(e)
+                else:
+                    on_result(None)
+            else:
+                self.ldap_integration.submit_delete_ldap_user(
+                    pipeline, on_result, user_id=operation.user_id
+                )
+        except (ValueError, ldap.LDAPError) as e:
+            self.fail_operation(operation, e)
@@ -1,10 +1,21 @@
+import gzip
 import logging
+from datetime import date
+from ftplib import error_perm
 
+import ldap
 import pytest
+import zstandard
 from _pytest.logging import LogCaptureFixture
 from pytest_mock import MockerFixture
 
-from applications.ftp_integration.services import FTPIntegrationService
+from applications.ftp_integration.models import (
+    FileCheckpoint,
+    ProcessedFile,
+    RemoteFile,
+    UserOperation,
+)
+from applications.ftp_integration.services import FTPIntegrationService, PersonRecord
 
 
 class TestFTPIntegrationServiceFile:
@@ -93,25 +104,28 @@ class TestFTPIntegrationServiceFile:
 
         assert not caplog.messages
 
-        common_data = {
-            "first_name": "a",
-            "last_name": "A",
-            "email": "e",
-            "date_begin": "d1",
-            "date_end": "d2",
-        }
+        def record(user_id):
+            return PersonRecord(
+                first_name="a",
+                last_name="A",
+                email="e",
+                user_id=user_id,
+                date_begin="d1",
+                date_end="d2",
+            )
+
         assert mock_process_creation.call_args_list == [
-            mocker.call("1", common_data),
-            mocker.call("", common_data),
+            mocker.call("1", record("1")),
+            mocker.call("", record("")),
         ]
         assert mock_process_employee_update.call_args_list == [
-            mocker.call("1", common_data),
-            mocker.call("2", common_data),
+            mocker.call("1", record("1")),
+            mocker.call("2", record("2")),
         ]
         assert mock_process_position_update.call_args_list == [
             mocker.call(
                 "1",
-                common_data,
+                record("1"),
             )
         ]
 
@@ -158,3 +172,543 @@ class TestFTPIntegrationServiceFile:
         ]
         mock_process_employee_update.assert_not_called()
         mock_process_position_update.assert_not_called()
+
+    def test_parse_file_prefetch(self, mocker: MockerFixture, settings):
+        settings.LDAP_LOOKUP_CHUNK_SIZE = 2
+        service = FTPIntegrationService()
+        mock_prefetch_ldap_users = mocker.patch.object(
+            service.ldap_integration, "prefetch_ldap_users"
+        )
+        mock_clear_prefetched_ldap_users = mocker.patch.object(
+            service.ldap_integration, "clear_prefetched_ldap_users"
+        )
+        mock_process_employee_update = mocker.patch.object(
+            service, "process_employee_update"
+        )
+        mocker.patch.object(service, "process_position_update")
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail"
+        mock_file = mocker.Mock(
+            __iter__=lambda _: iter(
+                [headers] + [f"{index};a;A;d1;d2;e" for index in range(3)]
+            )
+        )
+        mock_file.name = "employee_update1"
+        service.parse_file(mock_file)
+
+        assert [
+            list(call.args[0]) for call in mock_prefetch_ldap_users.call_args_list
+        ] == [["0", "1"], ["2"]]
+        assert mock_process_employee_update.call_count == 3
+        # not kept for the following steps
+        mock_clear_prefetched_ldap_users.assert_called_once()
+
+        mock_file.name = "position_update1"
+        service.parse_file(mock_file)
+        assert mock_prefetch_ldap_users.call_count == 2
+
+    def test_process_coalesced_person_files(
+        self, db, mocker: MockerFixture, caplog: LogCaptureFixture, settings, tmp_path
+    ):
+        settings.FILE_COALESCE_ROWS = True
+        settings.FTP_FOLDER = tmp_path
+        settings.FTP_PROCESSED_FOLDER = tmp_path / "processed"
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        mock_process_creation = mocker.patch.object(service, "process_creation")
+        mock_process_employee_update = mocker.patch.object(
+            service, "process_employee_update"
+        )
+        mock_process_position_update = mocker.patch.object(
+            service, "process_position_update"
+        )
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        files = {
+            "hiring1": "1;a;A;01/01/2023;03/01/2023;e\n2;b;B;01/01/2023;;e\n",
+            "hiring2": "1;c;C;02/01/2023;;e\n;x;X;01/01/2023;;e\n3;d;D;;;e\n",
+            "employee_update1": "1;d;D;;;e\n",
+            "employee_update2": "1;f;F;;;e\n2;g;G;;;e\n",
+            "position_update1": "1;;;05/01/2023;;\n",
+            "position_update2": "1;;;;06/01/2023;\n",
+        }
+        for name, content in files.items():
+            (tmp_path / name).write_text(headers + content, encoding="utf-8")
+
+        service.process_person_files()
+
+        def record(user_id, first_name, date_begin="", date_end=""):
+            return PersonRecord(
+                first_name=first_name,
+                last_name=first_name.upper(),
+                email="e" if first_name else "",
+                user_id=user_id,
+                date_begin=date_begin,
+                date_end=date_end,
+            )
+
+        assert mock_process_creation.call_args_list == [
+            mocker.call("", record("", "x", "01/01/2023")),
+            mocker.call("3", record("3", "d")),
+            mocker.call("1", record("1", "c", "02/01/2023", "03/01/2023")),
+            mocker.call("2", record("2", "b", "01/01/2023")),
+        ]
+        assert mock_process_employee_update.call_args_list == [
+            mocker.call("1", record("1", "f")),
+            mocker.call("2", record("2", "g")),
+        ]
+        assert mock_process_position_update.call_args_list == [
+            mocker.call("1", record("1", "", "05/01/2023", "06/01/2023")),
+        ]
+        assert sorted(
+            path.name for path in (tmp_path / "processed").iterdir()
+        ) == sorted(files)
+
+    def test_process_coalesced_person_files_same_result(
+        self, db, mocker: MockerFixture, settings, tmp_path
+    ):
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        # every user is still to be created
+        service.ldap_integration.update_ldap_user.side_effect = ldap.NO_SUCH_OBJECT
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        files = {
+            "hiring1": "1;a;A;01/01/2030;;e\n",
+            "employee_update1": "1;b;B;;;e\n2;c;C;01/01/2030;;f\n",
+            # the creation of user 2 is scheduled by the first row, with its begin date
+            "employee_update2": "2;c;Durand;;;f\n",
+            "position_update1": "1;;;02/01/2030;01/02/2030;\n2;;;;03/02/2030;\n",
+        }
+        results = []
+        for coalesce in (False, True):
+            settings.FILE_COALESCE_ROWS = coalesce
+            settings.FTP_FOLDER = tmp_path / str(coalesce)
+            settings.FTP_PROCESSED_FOLDER = tmp_path / str(coalesce) / "processed"
+            settings.FTP_FOLDER.mkdir()
+            for name, content in files.items():
+                (settings.FTP_FOLDER / name).write_text(
+                    headers + content, encoding="utf-8"
+                )
+            service.process_person_files()
+            results.append(
+                sorted(
+                    UserOperation.objects.values_list(
+                        "type_operation",
+                        "user_id",
+                        "first_name",
+                        "last_name",
+                        "email",
+                        "date_for_change",
+                    )
+                )
+            )
+            UserOperation.objects.all().delete()
+            ProcessedFile.objects.all().delete()
+
+        # rows of every type are applied as if processed one after the other
+        assert results[1] == results[0]
+        assert results[1] == sorted(
+            [
+                ("C", "1", "b", "B", "e", date(2030, 1, 2)),
+                ("D", "1", "", "", "", date(2030, 2, 1)),
+                ("C", "2", "c", "Durand", "f", date(2030, 1, 1)),
+                ("D", "2", "", "", "", date(2030, 2, 3)),
+            ]
+        )
+
+    def test_process_person_files_ledger(
+        self, db, mocker: MockerFixture, settings, tmp_path
+    ):
+        settings.FTP_FOLDER = tmp_path
+        settings.FTP_PROCESSED_FOLDER = tmp_path / "processed"
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        mock_parse_file = mocker.patch.object(service, "parse_file", return_value=1)
+        mock_count_person_rows = mocker.patch(
+            "applications.ftp_integration.services.count_person_rows"
+        )
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        (tmp_path / "hiring1").write_text(headers + "1;a;A;01/01/2023;;e\n")
+        service.process_person_files()
+        assert mock_parse_file.call_count == 1
+        # counted while parsed, not read again
+        mock_count_person_rows.assert_not_called()
+        processed_file = ProcessedFile.objects.get()
+        assert processed_file.file_name == "hiring1"
+        assert processed_file.size == len((headers + "1;a;A;01/01/2023;;e\n").encode())
+        assert processed_file.file_type == "hiring"
+        assert processed_file.row_count == 1
+        with service.open_archived_file(processed_file) as f:
+            assert f.read() == headers + "1;a;A;01/01/2023;;e\n"
+
+        # same content uploaded again, under the same or another name
+        (tmp_path / "hiring1").write_text(headers + "1;a;A;01/01/2023;;e\n")
+        (tmp_path / "hiring2").write_text(headers + "1;a;A;01/01/2023;;e\n")
+        (tmp_path / "hiring3").write_text(headers + "2;a;A;01/01/2023;;e\n")
+        (tmp_path / "hiring4").write_text(headers + "2;a;A;01/01/2023;;e\n")
+        service.process_person_files()
+        assert [call.args[0].name for call in mock_parse_file.call_args_list] == [
+            str(tmp_path / "hiring1"),
+            str(tmp_path / "hiring3"),
+        ]
+        assert ProcessedFile.objects.count() == 2
+        assert sorted(path.name for path in (tmp_path / "processed").iterdir()) == [
+            "hiring1",
+            "hiring2",
+            "hiring3",
+            "hiring4",
+        ]
+        assert not [path for path in tmp_path.iterdir() if path.is_file()]
+
+    def test_process_person_files_interrupted_archive(
+        self, db, mocker: MockerFixture, settings, tmp_path
+    ):
+        settings.FTP_FOLDER = tmp_path
+        settings.FTP_PROCESSED_FOLDER = tmp_path / "processed"
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        mocker.patch.object(service, "parse_file", return_value=2)
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        content = headers + "1;a;A;01/01/2023;;e\n2;b;B;01/01/2023;;f\n"
+        (tmp_path / "hiring1").write_text(content)
+        # stopped once the file is recorded as processed, before it is archived
+        mocker.patch.object(service, "archive_file", side_effect=KeyboardInterrupt)
+        with pytest.raises(KeyboardInterrupt):
+            service.process_person_files()
+        assert ProcessedFile.objects.get().archive_path == ""
+
+        mocker.stopall()
+        mocker.patch.object(service, "ldap_integration")
+        mock_parse_file = mocker.patch.object(service, "parse_file")
+        service.process_person_files()
+        # not parsed again, but archived and recorded in the manifest
+        mock_parse_file.assert_not_called()
+        processed_file = ProcessedFile.objects.get()
+        assert processed_file.file_type == "hiring"
+        assert processed_file.row_count == 2
+        with service.open_archived_file(processed_file) as f:
+            assert f.read() == content
+        assert not [path for path in tmp_path.iterdir() if path.is_file()]
+
+    def test_process_person_files_compressed_archive(
+        self, db, mocker: MockerFixture, settings, tmp_path
+    ):
+        settings.FILE_ARCHIVE_COMPRESSED = True
+        settings.FTP_FOLDER = tmp_path
+        settings.FTP_ARCHIVE_FOLDER = tmp_path / "archive"
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        mocker.patch.object(service, "process_creation")
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        content = headers + "1;a;A;01/01/2023;;e\n\n2;b;B;01/01/2023;;f\n"
+        (tmp_path / "hiring1").write_text(content)
+        (tmp_path / "hiring2").write_text(content)
+        (tmp_path / "employee_update1.csv.gz").write_bytes(
+            gzip.compress(headers.encode())
+        )
+        service.process_person_files()
+
+        # same content archived once, decompressed then compressed with zstandard
+        assert sorted(
+            path.name for path in (tmp_path / "archive").glob("*/*") if path.is_file()
+        ) == sorted(
+            f"{processed_file.sha256}.csv.zst"
+            for processed_file in ProcessedFile.objects.all()
+        )
+        assert not [path for path in tmp_path.iterdir() if path.is_file()]
+        assert list(
+            ProcessedFile.objects.order_by("file_name").values_list(
+                "file_name", "file_type", "row_count"
+            )
+        ) == [
+            ("employee_update1.csv.gz", "employee_update", 0),
+            ("hiring1", "hiring", 2),
+        ]
+        processed_file = ProcessedFile.objects.get(file_type="hiring")
+        with service.open_archived_file(processed_file) as f:
+            assert f.read() == content
+
+    def test_process_person_files_workers(
+        self, db, mocker: MockerFixture, caplog: LogCaptureFixture, settings, tmp_path
+    ):
+        settings.FILE_DECODE_WORKERS = 2
+        settings.FTP_FOLDER = tmp_path
+        settings.FTP_PROCESSED_FOLDER = tmp_path / "processed"
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        mock_process_creation = mocker.patch.object(service, "process_creation")
+        mock_process_position_update = mocker.patch.object(
+            service, "process_position_update"
+        )
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        (tmp_path / "hiring1").write_text(
+            headers + "1;a;A;01/01/2023;;e\n2;b;B;2023-01-01;;f\n"
+        )
+        (tmp_path / "position_update1").write_text(
+            "Identifiant;Date de fin\n1;02/01/2023\n"
+        )
+        # decoded once a worker is done with one of the previous files
+        (tmp_path / "position_update2").write_text(headers)
+        with caplog.at_level(logging.ERROR):
+            service.process_person_files()
+
+        assert mock_process_creation.call_args_list == [
+            mocker.call(
+                "1",
+                PersonRecord(
+                    first_name="a",
+                    last_name="A",
+                    email="e",
+                    user_id="1",
+                    date_begin=date(2023, 1, 1),
+                    date_end="",
+                ),
+            ),
+            # invalid dates are left as is, to be reported when the row is processed
+            mocker.call(
+                "2",
+                PersonRecord(
+                    first_name="b",
+                    last_name="B",
+                    email="f",
+                    user_id="2",
+                    date_begin="2023-01-01",
+                    date_end="",
+                ),
+            ),
+        ]
+        mock_process_position_update.assert_not_called()
+        assert caplog.messages == [
+            f'Missing column "Prénom" in file {tmp_path / "position_update1"}'
+        ]
+        assert len(list((tmp_path / "processed").iterdir())) == 3
+        assert service.parse_date(date(2023, 1, 1)) == date(2023, 1, 1)
+        assert service.parse_date("02/01/2023") == date(2023, 1, 2)
+
+    @pytest.mark.parametrize(
+        "file_name, compress",
+        [
+            ("hiring1", lambda content: content),
+            ("hiring1.csv.gz", gzip.compress),
+            ("hiring1.csv.zst", zstandard.compress),
+        ],
+    )
+    def test_process_person_files_checkpoints(
+        self, db, mocker: MockerFixture, settings, tmp_path, file_name, compress
+    ):
+        settings.FILE_CHECKPOINT_INTERVAL = 2
+        settings.FTP_FOLDER = tmp_path
+        settings.FTP_PROCESSED_FOLDER = tmp_path / "processed"
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        processed_user_ids = []
+
+        def process_creation(user_id, record):
+            if user_id == "4":
+                raise RuntimeError("interrupted")
+            processed_user_ids.append((user_id, record.first_name))
+
+        mocker.patch.object(service, "process_creation", side_effect=process_creation)
+        (tmp_path / file_name).write_bytes(
+            compress(
+                "\ufeffIdentifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\r\n".encode()
+                + '1;"a\r\nb";A;01/01/2023;;e\r\n'.encode()
+                + "\r\n".join(
+                    f"{index};é;A;01/01/2023;;e" for index in range(2, 6)
+                ).encode()
+            )
+        )
+        with pytest.raises(RuntimeError):
+            service.process_person_files()
+        checkpoint = FileCheckpoint.objects.get()
+        assert checkpoint.row_index == 2
+        assert processed_user_ids == [("1", "a\r\nb"), ("2", "é"), ("3", "é")]
+
+        processed_user_ids.clear()
+        process_creation_mock = mocker.patch.object(
+            service,
+            "process_creation",
+            side_effect=lambda user_id, record: processed_user_ids.append(
+                (user_id, record.first_name)
+            ),
+        )
+        service.process_person_files()
+        # the batch interrupted is processed again
+        assert processed_user_ids == [("3", "é"), ("4", "é"), ("5", "é")]
+        assert process_creation_mock.call_count == 3
+        assert not FileCheckpoint.objects.exists()
+        assert ProcessedFile.objects.count() == 1
+
+        # same rows without checkpoints
+        ProcessedFile.objects.all().delete()
+        (tmp_path / "processed" / file_name).rename(tmp_path / file_name)
+        settings.FILE_CHECKPOINT_INTERVAL = 0
+        processed_user_ids.clear()
+        service.process_person_files()
+        assert len(processed_user_ids) == 5
+
+    @pytest.mark.parametrize(
+        "workers, downloaded_files",
+        [
+            # a failure stops the download
+            (1, ["hiring1"]),
+            # a failure stops only the current file
+            (3, ["hiring1", "position_update1"]),
+        ],
+    )
+    def test_retrieve_person_files(
+        self, mocker: MockerFixture, db, settings, tmp_path, workers, downloaded_files
+    ):
+        settings.FTP_DOWNLOAD_WORKERS = workers
+        settings.FTP_USE_TLS = False
+        settings.FTP_CLEANUP_FILE = True
+        settings.FTP_FOLDER = tmp_path
+        mock_ftp_class = mocker.patch(
+            "applications.ftp_integration.services.DeflateFTP"
+        )
+        mock_ftp = mock_ftp_class.return_value.__enter__.return_value
+        # server without MLSD nor MDTM
+        mock_ftp.mlsd.side_effect = error_perm("500 Unknown command")
+
+        def voidcmd(cmd):
+            if cmd.startswith("MDTM"):
+                raise error_perm("500 Unknown command")
+            return "200 Type set to I"
+
+        mock_ftp.voidcmd.side_effect = voidcmd
+        mock_ftp.size.return_value = 100
+        mock_ftp.nlst.return_value = [
+            "export/hiring1",
+            "employee_update1",
+            "export/other",
+            "position_update1",
+        ]
+
+        def retrbinary(cmd, callback, rest=None):
+            if cmd == "RETR export/employee_update1":
+                callback(b"partial")
+                raise EOFError
+            callback(cmd.encode())
+
+        mock_ftp.retrbinary.side_effect = retrbinary
+        service = FTPIntegrationService()
+        with pytest.raises(EOFError):
+            service.retrieve_person_files()
+
+        # files are renamed once complete, and deleted from the FTP only then
+        assert sorted(path.name for path in tmp_path.iterdir()) == downloaded_files
+        assert (tmp_path / "hiring1").read_bytes() == b"RETR export/hiring1"
+        assert sorted(call.args[0] for call in mock_ftp.delete.call_args_list) == [
+            f"export/{file_name}" for file_name in downloaded_files
+        ]
+
+    def test_retrieve_person_files_incremental(
+        self, mocker: MockerFixture, db, settings, tmp_path
+    ):
+        settings.FTP_DOWNLOAD_WORKERS = 1
+        settings.FTP_USE_TLS = False
+        settings.FTP_CLEANUP_FILE = False
+        settings.FTP_FOLDER = tmp_path
+        RemoteFile.objects.create(
+            path="export/hiring1", size=7, modified="20230101120000"
+        )
+        RemoteFile.objects.create(
+            path="export/hiring2", size=7, modified="20230101120000"
+        )
+        # interrupted download of the current version of the file, and of an older one
+        (tmp_path / ".hiring2.20230102120000.part").write_bytes(b"hir")
+        (tmp_path / ".hiring2.20230101120000.part").write_bytes(b"old")
+        # interrupted download of another file
+        (tmp_path / ".hiring2.csv.gz.20230101120000.part").write_bytes(b"gz")
+        mock_ftp_class = mocker.patch(
+            "applications.ftp_integration.services.DeflateFTP"
+        )
+        mock_ftp = mock_ftp_class.return_value.__enter__.return_value
+        mock_ftp.mlsd.return_value = [
+            ("hiring1", {"type": "file", "size": "7", "modify": "20230101120000"}),
+            ("hiring2", {"type": "file", "size": "7", "modify": "20230102120000"}),
+            ("hiring3", {"type": "dir"}),
+        ]
+
+        def retrbinary(cmd, callback, rest=None):
+            callback(b"hiring2"[rest or 0 :])
+
+        mock_ftp.retrbinary.side_effect = retrbinary
+        service = FTPIntegrationService()
+        service.retrieve_person_files()
+
+        # unchanged file is skipped, changed one is resumed where it stopped
+        mock_ftp.retrbinary.assert_called_once_with(
+            "RETR export/hiring2", mocker.ANY, rest=3
+        )
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            ".hiring2.csv.gz.20230101120000.part",
+            "hiring2",
+        ]
+        assert (tmp_path / "hiring2").read_bytes() == b"hiring2"
+        assert RemoteFile.objects.get(path="export/hiring2").modified == (
+            "20230102120000"
+        )
+
+    def test_stream_person_files(
+        self, mocker: MockerFixture, db, caplog: LogCaptureFixture, settings, tmp_path
+    ):
+        settings.FTP_USE_TLS = False
+        settings.FTP_CLEANUP_FILE = True
+        settings.FTP_FOLDER = tmp_path
+        settings.FTP_PROCESSED_FOLDER = tmp_path / "processed"
+        mock_ftp_class = mocker.patch(
+            "applications.ftp_integration.services.DeflateFTP"
+        )
+        mock_ftp = mock_ftp_class.return_value.__enter__.return_value
+        mock_ftp.mlsd.return_value = [
+            ("position_update1", {"type": "file", "size": "10", "modify": "1"}),
+            ("hiring1", {"type": "file", "size": "10", "modify": "1"}),
+            ("employee_update1", {"type": "file", "size": "10", "modify": "1"}),
+        ]
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        contents = {
+            "RETR export/hiring1": f"\ufeff{headers}1;a;A;01/01/2023;;e\n".encode(),
+            "RETR export/position_update1": b"Identifiant\n1\n",
+        }
+
+        def retrbinary(cmd, callback):
+            if cmd not in contents:
+                raise EOFError
+            content = contents[cmd]
+            for start in range(0, len(content), 5):
+                callback(content[start : start + 5])
+
+        mock_ftp.retrbinary.side_effect = retrbinary
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        mock_process_creation = mocker.patch.object(service, "process_creation")
+        with pytest.raises(EOFError):
+            service.stream_person_files()
+
+        # rows are parsed while downloaded, in the same order as files downloaded before parsing
+        mock_process_creation.assert_called_once_with(
+            "1",
+            PersonRecord(
+                first_name="a",
+                last_name="A",
+                user_id="1",
+                date_begin="01/01/2023",
+                date_end="",
+                email="e",
+            ),
+        )
+        assert (tmp_path / "processed" / "hiring1").read_bytes() == contents[
+            "RETR export/hiring1"
+        ]
+        assert ProcessedFile.objects.get().file_name == "hiring1"
+        mock_ftp.delete.assert_called_once_with("export/hiring1")
+        assert not [path for path in tmp_path.iterdir() if path.is_file()]
+
+        mock_ftp.mlsd.return_value = [
+            ("position_update1", {"type": "file", "size": "10", "modify": "1"}),
+        ]
+        service.stream_person_files()
+        # the whole file is kept despite the missing columns
+        assert (tmp_path / "processed" / "position_update1").read_bytes() == (
+            b"Identifiant\n1\n"
+        )
+        assert 'Missing column "Prénom"' in caplog.text
@@ -1,16 +1,29 @@
 import logging
+import threading
+import time
 from typing import Callable
 
 import ldap
 import pytest
 from django.conf import settings
 from django.utils.module_loading import import_string
+from ldap.controls import SimplePagedResultsControl
+from pytest_mock import MockerFixture
 
 from applications.ftp_integration.ldap import (
     ActiveDirectoryIntegration,
     BaseLDAPIntegration,
+    LDAPConnectionPool,
+    LDAPWritePipeline,
     OpenLDAPIntegration,
 )
+from applications.ftp_integration.ldap_memory import (
+    InMemoryDirectory,
+    InMemoryLDAPConnection,
+    InMemoryLDAPIntegration,
+    compile_filter,
+    parse_filter,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -101,3 +114,535 @@ class TestBaseLDAPIntegration:
         assert ldap_integration.get_uid_number("C342@domain.com") == 1342
         with pytest.raises(ValueError):
             ldap_integration.get_uid_number("342@domain.com")
+
+    def test_snapshot(self, mocker: MockerFixture):
+        ldap_integration = OpenLDAPIntegration(use_snapshot=True)
+        ldap_integration.connection = mocker.Mock()
+        ldap_integration.connection.result3.return_value = (
+            ldap.RES_SEARCH_RESULT,
+            [
+                (
+                    "CN=C1,ou=people",
+                    {"UID": [b"C1@domain.com"], "givenName": [b"Foo"], "sn": [b"BAR"]},
+                ),
+                (None, ["ldap://domain.com/ou=other"]),
+                ("CN=C2,ou=people", {"uid": [b"C2@domain.com"], "sn": [b"BAZ"]}),
+            ],
+            1,
+            [],
+        )
+        ldap_integration.load_snapshot()
+        assert set(ldap_integration.snapshot) == {"c1@domain.com", "c2@domain.com"}
+
+        dn, updated = ldap_integration.update_ldap_user(
+            "c1@DOMAIN.com", "Foo", "BAR", ""
+        )
+        assert dn == "CN=C1,ou=people"
+        assert updated
+        dn, updated = ldap_integration.update_ldap_user(
+            "C1@domain.com", "Foo", "BAR", ""
+        )
+        assert not updated
+        assert ldap_integration.connection.modify_s.call_count == 1
+
+        assert ldap_integration.delete_ldap_user("C2@domain.com") == "CN=C2,ou=people"
+        ldap_integration.connection.delete_s.assert_called_once_with("CN=C2,ou=people")
+        with pytest.raises(ldap.NO_SUCH_OBJECT):
+            ldap_integration.delete_ldap_user("C2@domain.com")
+
+        dn, pwd = ldap_integration.create_ldap_user("C3@domain.com", "Foo", "Bar", "")
+        assert ldap_integration.find_ldap_user("C3@domain.com")[0] == dn
+        ldap_integration.connection.search_s.assert_not_called()
+        assert ldap_integration.connection.search_ext.call_count == 1
+
+    def test_paged_search(self, mocker: MockerFixture):
+        ldap_integration = OpenLDAPIntegration()
+        ldap_integration.connection = mocker.Mock()
+        ldap_integration.connection.result3.side_effect = [
+            (
+                ldap.RES_SEARCH_RESULT,
+                [("CN=C1,ou=people", {}), ("CN=C2,ou=people", {})],
+                1,
+                [
+                    mocker.Mock(controlType="1.2.3"),
+                    mocker.Mock(
+                        controlType=SimplePagedResultsControl.controlType,
+                        cookie=b"page2",
+                    ),
+                ],
+            ),
+            (
+                ldap.RES_SEARCH_RESULT,
+                [(None, ["ldap://domain.com/ou=other"]), ("CN=C3,ou=people", {})],
+                2,
+                [
+                    mocker.Mock(
+                        controlType=SimplePagedResultsControl.controlType, cookie=b""
+                    )
+                ],
+            ),
+        ]
+        results = ldap_integration.paged_search(
+            "ou=people", ldap.SCOPE_SUBTREE, "(uid=*)", page_size=2
+        )
+        assert [dn for dn, _ in results] == [
+            "CN=C1,ou=people",
+            "CN=C2,ou=people",
+            "CN=C3,ou=people",
+        ]
+        assert ldap_integration.connection.search_ext.call_count == 2
+        ldap_integration.connection.search_ext_s.assert_not_called()
+
+        # stopped early, the paged search is abandoned
+        error = ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+        ldap_integration.connection.result3.side_effect = [
+            (
+                ldap.RES_SEARCH_RESULT,
+                [("CN=C1,ou=people", {})],
+                3,
+                [
+                    mocker.Mock(
+                        controlType=SimplePagedResultsControl.controlType,
+                        cookie=b"page2",
+                    )
+                ],
+            ),
+            error,
+        ]
+        ldap_integration.connection.search_ext_s.side_effect = ldap.SERVER_DOWN(
+            {"desc": "Can't contact LDAP server"}
+        )
+        results = ldap_integration.paged_search(
+            "ou=people", ldap.SCOPE_SUBTREE, "(uid=*)", page_size=1
+        )
+        assert next(results)[0] == "CN=C1,ou=people"
+        # the error of the abandon doesn't hide the original one
+        with pytest.raises(ldap.SERVER_DOWN) as excinfo:
+            next(results)
+        assert excinfo.value is error
+        ldap_integration.connection.search_ext_s.assert_called_once()
+
+    def test_search_ldap_users(self, mocker: MockerFixture):
+        ldap_integration = OpenLDAPIntegration()
+        ldap_integration.connection = mocker.Mock()
+        ldap_integration.connection.search_s.side_effect = [
+            [
+                ("CN=C1,ou=people", {"uid": [b"c1@domain.com"]}),
+                (None, ["ldap://domain.com/ou=other"]),
+            ],
+            [("CN=C3*,ou=people", {"uid": [b"C3*@domain.com"]})],
+        ]
+        users = ldap_integration.search_ldap_users(
+            ["C1@domain.com", "C2@domain.com", "C1@domain.com", "C3*@domain.com"],
+            chunk_size=2,
+        )
+        assert users == {
+            "C1@domain.com": ("CN=C1,ou=people", {"uid": [b"c1@domain.com"]}),
+            "C3*@domain.com": ("CN=C3*,ou=people", {"uid": [b"C3*@domain.com"]}),
+        }
+        assert [
+            call.args[2] for call in ldap_integration.connection.search_s.call_args_list
+        ] == [
+            "(|(uid=C1@domain.com)(uid=C2@domain.com))",
+            "(|(uid=C3\\2a@domain.com))",
+        ]
+        assert ldap_integration.connection.search_s.call_args.args[3] == [
+            "uid",
+            "givenName",
+            "sn",
+            "displayName",
+            "mail",
+        ]
+
+    def test_prefetch_ldap_users(self, mocker: MockerFixture, settings):
+        settings.LDAP_LOOKUP_CHUNK_SIZE = 10
+        ldap_integration = OpenLDAPIntegration()
+        ldap_integration.connection = mocker.Mock()
+        ldap_integration.connection.search_s.side_effect = [
+            [("CN=C1,ou=people", {"uid": [b"C1@domain.com"]})],
+            [("CN=C3,ou=people", {"uid": [b"C3@domain.com"]})],
+        ]
+        ldap_integration.prefetch_ldap_users(["C1@domain.com", "C2@domain.com"])
+        assert ldap_integration.find_ldap_user("C1@domain.com")[0] == "CN=C1,ou=people"
+        with pytest.raises(ldap.NO_SUCH_OBJECT):
+            ldap_integration.find_ldap_user("C2@domain.com")
+        assert ldap_integration.connection.search_s.call_count == 1
+
+        ldap_integration.delete_ldap_user("C1@domain.com")
+        with pytest.raises(ldap.NO_SUCH_OBJECT):
+            ldap_integration.find_ldap_user("C1@domain.com")
+        # users not prefetched are searched
+        assert ldap_integration.find_ldap_user("C3@domain.com")[0] == "CN=C3,ou=people"
+        assert ldap_integration.connection.search_s.call_count == 2
+
+        # users not found are searched again once the prefetched users are cleared
+        ldap_integration.clear_prefetched_ldap_users()
+        ldap_integration.connection.search_s.side_effect = [
+            [("CN=C2,ou=people", {"uid": [b"C2@domain.com"]})]
+        ]
+        assert ldap_integration.find_ldap_user("C2@domain.com")[0] == "CN=C2,ou=people"
+
+    def test_active_directory_homonyms(self, mocker: MockerFixture, settings):
+        settings.LDAP_TLS = True
+        ldap_integration = ActiveDirectoryIntegration()
+        ldap_integration.connection = mocker.Mock()
+        homonyms = [
+            (f"CN=Jean MARTIN,{settings.USERS_DN}", {"sAMAccountName": [b"jmartin"]}),
+            (
+                f"CN=Jean MARTIN,ou=other,{settings.LDAP_DOMAIN}",
+                {"sAMAccountName": [b"JMartin1"]},
+            ),
+            (None, ["ldap://domain.com/ou=other"]),
+        ]
+
+        def search_s(base, scope, filterstr, attrlist):
+            if "C3@domain.com" in filterstr:
+                return [
+                    (
+                        f"CN=Jean MARTIN2,{settings.USERS_DN}",
+                        {"userPrincipalName": [b"c3@domain.com"]},
+                    )
+                ]
+            return homonyms
+
+        ldap_integration.connection.search_s.side_effect = search_s
+        dn, _ = ldap_integration.create_ldap_user("C1@domain.com", "Jean", "Martin", "")
+        assert dn == f"CN=Jean MARTIN1,{settings.USERS_DN}"
+        assert (
+            dict(ldap_integration.connection.add_s.call_args.args[1])["sAMAccountName"]
+            == b"jmartin2"
+        )
+        # one search for names, one creation, one modification for password and activation
+        assert ldap_integration.operation_counts == {"search": 1, "add": 1, "modify": 1}
+        assert [
+            attribute
+            for _, attribute, _ in ldap_integration.connection.modify_s.call_args.args[
+                1
+            ]
+        ] == ["unicodePwd", "userAccountControl", "pwdLastSet"]
+        # names allocated for the previous creation are reserved
+        dn, _ = ldap_integration.create_ldap_user("C2@domain.com", "Jean", "Martin", "")
+        assert dn == f"CN=Jean MARTIN2,{settings.USERS_DN}"
+        assert (
+            dict(ldap_integration.connection.add_s.call_args.args[1])["sAMAccountName"]
+            == b"jmartin3"
+        )
+        assert ldap_integration.connection.add_s.call_count == 2
+
+        with pytest.raises(ldap.ALREADY_EXISTS):
+            ldap_integration.create_ldap_user("C3@domain.com", "Jean", "Martin", "")
+        assert ldap_integration.connection.add_s.call_count == 2
+
+    def test_active_directory_password_batch(self, mocker: MockerFixture, settings):
+        settings.LDAP_TLS = False
+        settings.AD_PASSWORD_BATCH_SIZE = 2
+        mock_launch_ssh_powershell_batch = mocker.patch(
+            "applications.ftp_integration.ldap.launch_ssh_powershell_batch",
+            side_effect=lambda commands, key_file_name: [None, "Access denied", None][
+                : len(commands)
+            ],
+        )
+        mocker.patch.object(ActiveDirectoryIntegration, "connect")
+        with ActiveDirectoryIntegration() as ldap_integration:
+            ldap_integration.connection.search_s.return_value = []
+            dn1, _ = ldap_integration.create_ldap_user(
+                "C1@domain.com", "Foo", "Bar", ""
+            )
+            mock_launch_ssh_powershell_batch.assert_not_called()
+            ldap_integration.connection.modify_s.assert_not_called()
+            dn2, _ = ldap_integration.create_ldap_user(
+                "C2@domain.com", "Faa", "Bar", ""
+            )
+            # the batch is full
+            mock_launch_ssh_powershell_batch.assert_called_once()
+            # only the user with a password is activated
+            ldap_integration.connection.modify_s.assert_called_once()
+            assert ldap_integration.connection.modify_s.call_args.args[0] == dn1
+            dn3, _ = ldap_integration.create_ldap_user(
+                "C3@domain.com", "Fii", "Bar", ""
+            )
+        # pending passwords are set when leaving the context manager
+        assert mock_launch_ssh_powershell_batch.call_count == 2
+        assert ldap_integration.connection.modify_s.call_args.args[0] == dn3
+        assert (
+            "CN=Faa BAR"
+            in mock_launch_ssh_powershell_batch.call_args_list[0].args[0][1]
+        )
+
+
+class TestLDAPWritePipeline:
+    def test_pipeline(self, mocker: MockerFixture):
+        connection = mocker.Mock()
+        connection.add.side_effect = [1, 2, 3]
+        connection.delete.side_effect = [4]
+        results = {1: None, 2: ldap.ALREADY_EXISTS(), 3: None, 4: None}
+        in_flight = []
+
+        def result3(msgid):
+            in_flight.append(len(pipeline.pending) + 1)
+            if results[msgid] is not None:
+                raise results[msgid]
+            return ldap.RES_ADD, [], msgid, []
+
+        connection.result3.side_effect = result3
+        callback_results = []
+        with LDAPWritePipeline(connection, 2) as pipeline:
+            for dn in ("CN=1", "CN=2", "CN=3"):
+                pipeline.submit(
+                    "add",
+                    dn,
+                    [],
+                    callback=lambda error, dn=dn: callback_results.append((dn, error)),
+                )
+            # callbacks can chain other operations
+            pipeline.submit(
+                "delete",
+                "CN=4",
+                callback=lambda error: pipeline.submit(
+                    "delete", "CN=5", callback=callback_results.append
+                ),
+            )
+            connection.delete.side_effect = [5]
+            results[5] = ldap.NO_SUCH_OBJECT()
+
+        assert [dn for dn, _ in callback_results[:3]] == ["CN=1", "CN=2", "CN=3"]
+        assert callback_results[0][1] is None
+        assert isinstance(callback_results[1][1], ldap.ALREADY_EXISTS)
+        assert isinstance(callback_results[3], ldap.NO_SUCH_OBJECT)
+        assert not pipeline.pending
+        assert max(in_flight) == 2
+
+
+class TestLDAPConnectionPool:
+    def test_checkout_connection(self, mocker: MockerFixture):
+        connections = [mocker.Mock(name=f"connection{index}") for index in range(3)]
+        mocker.patch.object(OpenLDAPIntegration, "connect", side_effect=connections)
+        ldap_integration = OpenLDAPIntegration(pool_size=2)
+        with ldap_integration:
+            with ldap_integration:
+                # nested context managers share the same connections
+                assert ldap_integration.connection is connections[0]
+            # the pool is only bound when opened
+            assert ldap_integration.pool is None
+            assert OpenLDAPIntegration.connect.call_count == 1
+            with ldap_integration.open_pool():
+                with ldap_integration.checkout_connection() as connection:
+                    assert connection in connections[1:]
+                    assert ldap_integration.connection is connection
+                    thread_connections = []
+                    thread = threading.Thread(
+                        target=lambda: thread_connections.append(
+                            ldap_integration.connection
+                        )
+                    )
+                    thread.start()
+                    thread.join()
+                    # other threads don't see the checked out connection
+                    assert thread_connections == [connections[0]]
+            assert ldap_integration.connection is connections[0]
+
+        assert ldap_integration.pool is None
+        for connection in connections:
+            connection.unbind_s.assert_called_once()
+
+    def test_pool_checkout(self, mocker: MockerFixture):
+        pool = LDAPConnectionPool(mocker.Mock, 2)
+        with pool.checkout() as connection1, pool.checkout() as connection2:
+            assert connection1 is not connection2
+            assert pool.connections.empty()
+        assert pool.connections.qsize() == 2
+
+
+class TestInMemoryLDAPIntegration:
+    @pytest.fixture(autouse=True)
+    def clear_directory(self):
+        InMemoryLDAPIntegration.directory.clear()
+        yield
+        InMemoryLDAPIntegration.directory.clear()
+
+    def test_compile_filter(self):
+        values = {"uid": [b"C1@domain.com"], "cn": [b"Jean (MARTIN)"]}
+        assert compile_filter("(uid=c1@DOMAIN.com)")(values)
+        assert compile_filter("(|(uid=C2@domain.com)(cn=jean*))")(values)
+        assert compile_filter(r"(&(cn=*\28martin\29)(uid=*))")(values)
+        assert not compile_filter("(&(uid=*)(!(cn=Jean*)))")(values)
+        assert not compile_filter("(mail=*)")(values)
+
+        indexed_attributes = InMemoryDirectory.indexed_attributes
+        _, lookups = parse_filter(
+            "(|(uid=C1@domain.com)(UID=c2\\2a))", indexed_attributes
+        )
+        assert lookups == [("uid", b"c1@domain.com"), ("uid", b"c2*")]
+        _, lookups = parse_filter("(&(mail=*)(cn=Jean))", indexed_attributes)
+        assert lookups == [("cn", b"jean")]
+        for filterstr in ("(|(uid=C1)(mail=a))", "(uid=C1*)", "(!(uid=C1))"):
+            assert parse_filter(filterstr, indexed_attributes)[1] is None
+
+    def test_directory_index(self):
+        directory = InMemoryDirectory()
+        directory.add("CN=C1,OU=Users,DC=domain", [("uid", [b"C1@domain.com"])])
+        directory.add("CN=C2,OU=Other,DC=domain", [("uid", [b"C2@domain.com"])])
+
+        def search(base, filterstr):
+            return [
+                dn
+                for dn, _ in directory.search(
+                    base, ldap.SCOPE_SUBTREE, filterstr, ["uid"]
+                )
+            ]
+
+        assert search("OU=Users,DC=domain", "(uid=c1@domain.com)") == [
+            "CN=C1,OU=Users,DC=domain"
+        ]
+        assert search("OU=Users,DC=domain", "(uid=C2@domain.com)") == []
+        assert search("DC=domain", "(|(uid=C1@domain.com)(uid=C2@domain.com))") == [
+            "CN=C1,OU=Users,DC=domain",
+            "CN=C2,OU=Other,DC=domain",
+        ]
+        directory.modify(
+            "cn=c1,ou=users,dc=domain", [(ldap.MOD_REPLACE, "uid", [b"C3@domain.com"])]
+        )
+        assert search("DC=domain", "(uid=C1@domain.com)") == []
+        assert search("DC=domain", "(uid=C3@domain.com)") == [
+            "CN=C1,OU=Users,DC=domain"
+        ]
+        directory.delete("CN=C1,OU=Users,DC=domain")
+        assert search("DC=domain", "(uid=C3@domain.com)") == []
+        assert not directory.index.get(("uid", b"c3@domain.com"))
+
+    def test_user_management(self, settings):
+        with InMemoryLDAPIntegration() as ldap_integration:
+            dn, pwd = ldap_integration.create_ldap_user(
+                "C1@domain.com", "Foo", "BAR", "fbar@domain.com"
+            )
+            # newly created user should be able to connect directly
+            ldap_integration.connect().simple_bind_s(who=dn, cred=pwd)
+            with pytest.raises(ldap.INVALID_CREDENTIALS):
+                ldap_integration.connect().simple_bind_s(who=dn, cred="wrong")
+            with pytest.raises(ldap.ALREADY_EXISTS):
+                ldap_integration.create_ldap_user(
+                    "C1@domain.com", "Foo", "BAR", "fbar@domain.com"
+                )
+
+            assert ldap_integration.update_ldap_user(
+                "c1@domain.com", "Foo", "BAZ", "fbaz@domain.com"
+            ) == (dn, True)
+            _, values = ldap_integration.find_ldap_user("C1@domain.com")
+            assert values["sn"] == [b"BAZ"]
+            assert ldap_integration.delete_ldap_user("C1@domain.com") == dn
+            with pytest.raises(ldap.NO_SUCH_OBJECT):
+                ldap_integration.delete_ldap_user("C1@domain.com")
+
+    def test_snapshot(self, settings):
+        settings.LDAP_PAGE_SIZE = 2
+        with InMemoryLDAPIntegration() as ldap_integration:
+            for index in range(5):
+                ldap_integration.create_ldap_user(
+                    f"C{index}@domain.com", "Foo", "BAR", "fbar@domain.com"
+                )
+        with InMemoryLDAPIntegration(use_snapshot=True) as ldap_integration:
+            assert len(ldap_integration.snapshot) == 5
+            assert ldap_integration.operation_counts["search"] == 3
+
+    def test_pipeline_latency(self, settings):
+        settings.LDAP_IN_MEMORY_LATENCY = 0.05
+        with InMemoryLDAPIntegration() as ldap_integration:
+            for index in range(10):
+                ldap_integration.directory.add(
+                    f"CN=C{index}@domain.com,{settings.USERS_DN}",
+                    [("uid", [f"C{index}@domain.com".encode()])],
+                )
+            errors = []
+            start = time.monotonic()
+            with ldap_integration.write_pipeline(10) as pipeline:
+                for index in range(11):
+                    ldap_integration.submit_update_ldap_user(
+                        pipeline,
+                        errors.append,
+                        f"C{index}@domain.com",
+                        "Foo",
+                        "BAR",
+                        "fbar@domain.com",
+                    )
+            # lookups are synchronous but updates wait for their results concurrently
+            assert time.monotonic() - start < 0.05 * 20
+        # the failed lookup is reported right away, before the pending updates
+        assert isinstance(errors[0], ldap.NO_SUCH_OBJECT)
+        assert errors[1:] == [None] * 10
+
+    def test_pooled_writes(self, settings):
+        settings.LDAP_IN_MEMORY_LATENCY = 0.05
+        with InMemoryLDAPIntegration(pool_size=4) as ldap_integration:
+            for index in range(4):
+                ldap_integration.directory.add(
+                    f"CN=C{index}@domain.com,{settings.USERS_DN}",
+                    [("uid", [f"C{index}@domain.com".encode()])],
+                )
+            errors = []
+            start = time.monotonic()
+            with ldap_integration.pooled_writes(10) as writes:
+                for user_id, last_name in (
+                    ("C9@domain.com", "BAR"),
+                    ("C0@domain.com", "BAZ"),
+                    ("C0@domain.com", "BAR"),
+                    *((f"C{index}@domain.com", "BAR") for index in range(1, 4)),
+                ):
+                    writes.submit(
+                        user_id,
+                        "update_ldap_user",
+                        user_id,
+                        "Foo",
+                        last_name,
+                        "fbar@domain.com",
+                        callback=errors.append,
+                    )
+            # each update does a search and a modify, updates of different users are concurrent
+            assert time.monotonic() - start < 0.05 * 2 * 6
+            assert ldap_integration.pool is None
+        # results are given back in submission order
+        assert isinstance(errors[0], ldap.NO_SUCH_OBJECT)
+        assert errors[1:] == [None] * 5
+        # updates of a same user are done in order
+        _, values = ldap_integration.directory.get(
+            f"CN=C0@domain.com,{settings.USERS_DN}"
+        )
+        assert values["sn"] == [b"BAR"]
+
+    def test_pipeline_same_user(self, mocker: MockerFixture, settings):
+        # writes only land on the directory when their result is read
+        mocker.patch.object(
+            InMemoryLDAPIntegration,
+            "connect",
+            lambda self: InMemoryLDAPConnection(self.directory, deferred=True),
+        )
+        with InMemoryLDAPIntegration() as ldap_integration:
+            dn, _ = ldap_integration.create_ldap_user(
+                "C1@domain.com", "Foo", "BAR", "fbar@domain.com"
+            )
+        with InMemoryLDAPIntegration(use_snapshot=True) as ldap_integration:
+            errors = []
+            with ldap_integration.write_pipeline(10) as pipeline:
+                for last_name in ("BAZ", "BAR"):
+                    ldap_integration.submit_update_ldap_user(
+                        pipeline,
+                        errors.append,
+                        "C1@domain.com",
+                        "Foo",
+                        last_name,
+                        "fbar@domain.com",
+                    )
+                assert len(pipeline.pending) == 2
+            assert errors == [None, None]
+            # same result as the sequential updates
+            assert ldap_integration.directory.get(dn)[1]["sn"] == [b"BAR"]
+
+            with ldap_integration.write_pipeline(10) as pipeline:
+                ldap_integration.submit_update_ldap_user(
+                    pipeline, errors.append, "C1@domain.com", "Foo", "BAZ", ""
+                )
+                ldap_integration.directory.delete(dn)
+            assert isinstance(errors[-1], ldap.NO_SUCH_OBJECT)
+            # the failed update is rolled back in the snapshot
+            _, values = ldap_integration.find_ldap_user("C1@domain.com")
+            assert values["sn"] == [b"BAR"]
+            assert values["mail"] == [b"fbar@domain.com"]
@@ -1,13 +1,15 @@
+import io
 import logging
 from datetime import date, timedelta
 
 import ldap
 import pytest
 from _pytest.logging import LogCaptureFixture
+from django.utils import timezone
 from pytest_mock import MockerFixture
 
-from applications.ftp_integration.models import UserOperation
-from applications.ftp_integration.services import FTPIntegrationService
+from applications.ftp_integration.models import EmployeeFingerprint, UserOperation
+from applications.ftp_integration.services import FTPIntegrationService, PersonRecord
 
 
 class TestFTPIntegrationServiceOperation:
@@ -15,11 +17,11 @@ class TestFTPIntegrationServiceOperation:
         service = FTPIntegrationService()
         user_id = "01@domain.com"
         with pytest.raises(AssertionError):
-            service.process_creation("", {})
+            service.process_creation("", PersonRecord())
         with pytest.raises(ValueError):
-            service.process_creation(user_id, {})
+            service.process_creation(user_id, PersonRecord())
 
-        service.process_creation(user_id, {"date_begin": "01/01/1970"})
+        service.process_creation(user_id, PersonRecord(date_begin="01/01/1970"))
         assert (
             UserOperation.objects.filter(
                 type_operation=UserOperation.TypeChoices.CREATION
@@ -30,7 +32,7 @@ class TestFTPIntegrationServiceOperation:
             type_operation=UserOperation.TypeChoices.DELETION
         ).exists()
 
-        service.process_creation(user_id, {"date_begin": "01/01/1970"})
+        service.process_creation(user_id, PersonRecord(date_begin="01/01/1970"))
         assert (
             UserOperation.objects.filter(
                 type_operation=UserOperation.TypeChoices.CREATION
@@ -42,7 +44,7 @@ class TestFTPIntegrationServiceOperation:
         ).exists()
 
         service.process_creation(
-            user_id, {"date_begin": "01/01/1970", "date_end": "01/01/1970"}
+            user_id, PersonRecord(date_begin="01/01/1970", date_end="01/01/1970")
         )
         assert (
             UserOperation.objects.filter(
@@ -61,9 +63,9 @@ class TestFTPIntegrationServiceOperation:
         service = FTPIntegrationService()
         user_id = "01@domain.com"
         with pytest.raises(AssertionError):
-            service.process_employee_update("", {})
+            service.process_employee_update("", PersonRecord())
         mocker.patch.object(service.ldap_integration, "update_ldap_user")
-        service.process_employee_update(user_id, {})
+        service.process_employee_update(user_id, PersonRecord())
         assert not UserOperation.objects.exists()
 
         mocker.patch.object(
@@ -71,7 +73,7 @@ class TestFTPIntegrationServiceOperation:
             "update_ldap_user",
             side_effect=ldap.NO_SUCH_OBJECT,
         )
-        service.process_employee_update(user_id, {"date_begin": "01/01/1970"})
+        service.process_employee_update(user_id, PersonRecord(date_begin="01/01/1970"))
         assert (
             UserOperation.objects.filter(
                 type_operation=UserOperation.TypeChoices.CREATION
@@ -82,7 +84,7 @@ class TestFTPIntegrationServiceOperation:
             type_operation=UserOperation.TypeChoices.DELETION
         ).exists()
 
-        service.process_employee_update(user_id, {"date_begin": "01/01/1970"})
+        service.process_employee_update(user_id, PersonRecord(date_begin="01/01/1970"))
         assert (
             UserOperation.objects.filter(
                 type_operation=UserOperation.TypeChoices.CREATION
@@ -97,9 +99,9 @@ class TestFTPIntegrationServiceOperation:
         service = FTPIntegrationService()
         user_id = "01@domain.com"
         with pytest.raises(AssertionError):
-            service.process_position_update("", {})
+            service.process_position_update("", PersonRecord())
 
-        service.process_position_update(user_id, {})
+        service.process_position_update(user_id, PersonRecord())
         assert not UserOperation.objects.filter(
             type_operation=UserOperation.TypeChoices.CREATION
         ).exists()
@@ -107,7 +109,7 @@ class TestFTPIntegrationServiceOperation:
             type_operation=UserOperation.TypeChoices.DELETION
         ).exists()
 
-        service.process_position_update(user_id, {"date_begin": "01/01/1970"})
+        service.process_position_update(user_id, PersonRecord(date_begin="01/01/1970"))
         assert not UserOperation.objects.filter(
             type_operation=UserOperation.TypeChoices.CREATION
         ).exists()
@@ -116,7 +118,7 @@ class TestFTPIntegrationServiceOperation:
         ).exists()
 
         service.process_position_update(
-            user_id, {"date_begin": "01/01/1970", "date_end": "01/01/1970"}
+            user_id, PersonRecord(date_begin="01/01/1970", date_end="01/01/1970")
         )
         assert not UserOperation.objects.filter(
             type_operation=UserOperation.TypeChoices.CREATION
@@ -134,7 +136,7 @@ class TestFTPIntegrationServiceOperation:
             date_for_change=date.today(),
         )
         service.process_position_update(
-            user_id, {"date_begin": "01/01/1970", "date_end": "01/01/1970"}
+            user_id, PersonRecord(date_begin="01/01/1970", date_end="01/01/1970")
         )
         create_operation = UserOperation.objects.filter(
             type_operation=UserOperation.TypeChoices.CREATION
@@ -147,6 +149,193 @@ class TestFTPIntegrationServiceOperation:
             == 1
         )
 
+    def test_update_operation_retry_state(self, db):
+        service = FTPIntegrationService()
+        operation = UserOperation.objects.create(
+            type_operation=UserOperation.TypeChoices.CREATION,
+            user_id="01@domain.com",
+            date_for_change=date(1970, 1, 1),
+            status=UserOperation.StatusChoices.FAILED,
+            attempts=2,
+        )
+        # the same date given again by every position update file
+        service.process_position_update(
+            operation.user_id, PersonRecord(date_begin="01/01/1970")
+        )
+        operation.refresh_from_db()
+        assert operation.status == UserOperation.StatusChoices.FAILED
+        assert operation.attempts == 2
+
+        service.process_position_update(
+            operation.user_id, PersonRecord(date_begin="02/01/1970")
+        )
+        operation.refresh_from_db()
+        assert operation.date_for_change == date(1970, 1, 2)
+        assert operation.status == UserOperation.StatusChoices.PENDING
+        assert operation.attempts == 0
+
+    def test_parse_file_operation_buffer(
+        self, db, mocker: MockerFixture, caplog: LogCaptureFixture, settings
+    ):
+        settings.OPERATION_UPSERT_BATCH_SIZE = 3
+        service = FTPIntegrationService()
+        mock_bulk_create = mocker.spy(UserOperation.objects, "bulk_create")
+        UserOperation.objects.create(
+            type_operation=UserOperation.TypeChoices.CREATION,
+            user_id="1",
+            first_name="old",
+            date_for_change=date.today(),
+        )
+        headers = "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+        file = io.StringIO(
+            headers
+            + "1;a;A;01/01/1970;02/01/1970;e\n"
+            + "2;b;B;01/01/1970;;f\n"
+            + ";c;C;01/01/1970;;g\n"
+            + "2;b;B;03/01/1970;;h\n"
+        )
+        file.name = "hiring"
+        with caplog.at_level(logging.ERROR):
+            service.parse_file(file)
+
+        assert caplog.messages == ["Error 'user_id can't be empty' in file hiring L.3"]
+        # one query per set of updated fields when the buffer is full, then at the end of the file
+        assert mock_bulk_create.call_count == 3
+        assert service.operation_buffer is None
+        creations = UserOperation.objects.filter(
+            type_operation=UserOperation.TypeChoices.CREATION
+        ).order_by("user_id")
+        assert [
+            (operation.user_id, operation.first_name, operation.email)
+            for operation in creations
+        ] == [("1", "a", "e"), ("2", "b", "h")]
+        assert creations[1].date_for_change == date(1970, 1, 3)
+        assert UserOperation.objects.get(
+            type_operation=UserOperation.TypeChoices.DELETION
+        ).date_for_change == date(1970, 1, 2)
+
+        # updates of unknown users are scheduled as creations, even before being written
+        mocker.patch.object(
+            service.ldap_integration,
+            "update_ldap_user",
+            side_effect=ldap.NO_SUCH_OBJECT,
+        )
+        file = io.StringIO(
+            headers + "3;c;C;01/01/1970;;g\n" + "3;d;D;;;g\n" + "1;f;F;;;e\n"
+        )
+        file.name = "employee_update"
+        service.parse_file(file)
+        assert [
+            (operation.user_id, operation.first_name)
+            for operation in UserOperation.objects.filter(
+                type_operation=UserOperation.TypeChoices.CREATION
+            ).order_by("user_id")
+        ] == [("1", "f"), ("2", "b"), ("3", "d")]
+
+    def test_parse_file_employee_delta(self, db, mocker: MockerFixture, settings):
+        settings.FILE_EMPLOYEE_UPDATE_DELTA = True
+        service = FTPIntegrationService()
+
+        def update_ldap_user(user_id, **employee_data):
+            if user_id == "3":
+                raise ValueError("invalid")
+            return "", True
+
+        mock_update_ldap_user = mocker.patch.object(
+            service.ldap_integration,
+            "update_ldap_user",
+            side_effect=update_ldap_user,
+        )
+
+        def parse_file(*lines):
+            file = io.StringIO(
+                "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+                + "".join(f"{line}\n" for line in lines)
+            )
+            file.name = "employee_update"
+            mock_update_ldap_user.reset_mock()
+            service.parse_file(file)
+            return [call.args[0] for call in mock_update_ldap_user.call_args_list]
+
+        rows = ["1;a;A;;;e", "2;b;B;;;f", "3;c;C;;;g"]
+        assert parse_file(*rows) == ["1", "2", "3"]
+        assert EmployeeFingerprint.objects.count() == 2
+        # failed rows are applied again
+        assert parse_file(*rows) == ["3"]
+        assert parse_file("1;a;A;;;e", "2;b;B;;;h", "3;c;C;;;g") == ["2", "3"]
+        assert parse_file("1;a;A;01/01/2023;;e") == ["1"]
+        # rows decoded by worker processes have their dates already parsed
+        mock_update_ldap_user.reset_mock()
+        service.process_rows(
+            service.process_employee_update,
+            [
+                (
+                    "employee_update",
+                    0,
+                    "1",
+                    PersonRecord(
+                        first_name="a",
+                        last_name="A",
+                        email="e",
+                        user_id="1",
+                        date_begin=date(2023, 1, 1),
+                        date_end="",
+                    ),
+                )
+            ],
+        )
+        mock_update_ldap_user.assert_not_called()
+        # rows are compared to the previous ones of the same run, the last one applied is saved
+        assert parse_file("1;a;A;01/01/2023;;x", "1;a;A;01/01/2023;;e") == ["1", "1"]
+        assert parse_file("1;a;A;01/01/2023;;e") == []
+
+        # with pipelined writes, rows are saved once their result is received
+        settings.LDAP_PIPELINE_WINDOW = 2
+        mocker.patch.object(service.ldap_integration, "write_pipeline")
+        mocker.patch.object(
+            service.ldap_integration,
+            "submit_update_ldap_user",
+            side_effect=lambda pipeline, on_result, user_id, **employee_data: on_result(
+                ldap.NO_SUCH_OBJECT()
+            ),
+        )
+        parse_file("4;d;D;;;g", "5;e;E;01/01/2030;;g")
+        # the creation of user 4 could not be scheduled without date_begin
+        assert set(
+            EmployeeFingerprint.objects.filter(user_id__in=["4", "5"]).values_list(
+                "user_id", flat=True
+            )
+        ) == {"5"}
+
+    def test_parse_file_employee_pooled(self, db, settings):
+        settings.LDAP_POOL_SIZE = 3
+        settings.LDAP_INTEGRATION_CLASS = (
+            "applications.ftp_integration.ldap_memory.InMemoryLDAPIntegration"
+        )
+        service = FTPIntegrationService()
+        directory = service.ldap_integration.directory
+        directory.clear()
+        dn = f"CN=1,{settings.USERS_DN}"
+        directory.add(dn, [("uid", [b"1"])])
+        file = io.StringIO(
+            "Identifiant;Prénom;Nom;Date entrée poste;Date de fin;E-mail\n"
+            "1;a;A;;;e\n"
+            "2;b;B;01/01/2030;;f\n"
+            "1;a;C;;;e\n"
+        )
+        file.name = "employee_update"
+        try:
+            with service.ldap_integration:
+                service.parse_file(file)
+            assert directory.get(dn)[1]["sn"] == [b"C"]
+            # the creation of the unknown user is scheduled by the calling thread
+            assert list(UserOperation.objects.values_list("user_id", "last_name")) == [
+                ("2", "B")
+            ]
+            assert service.ldap_integration.pool is None
+        finally:
+            directory.clear()
+
     def test_process_db_operation(
         self, db, mocker: MockerFixture, caplog: LogCaptureFixture
     ):
@@ -222,15 +411,343 @@ class TestFTPIntegrationServiceOperation:
             )
             == 2
         )
-        assert (
+        # failed creations are kept to be retried, the one not due yet is untouched
+        assert sorted(
             UserOperation.objects.filter(
                 type_operation=UserOperation.TypeChoices.CREATION
-            ).count()
-            == 1
-        )
+            ).values_list("status", "attempts")
+        ) == [("F", 1)] * 4 + [("P", 0)]
         assert (
             UserOperation.objects.filter(
                 type_operation=UserOperation.TypeChoices.DELETION
             ).count()
             == 3
         )
+
+    def test_process_db_operation_pipeline(
+        self, db, mocker: MockerFixture, caplog: LogCaptureFixture, settings
+    ):
+        settings.LDAP_PIPELINE_WINDOW = 2
+        settings.LDAP_INTEGRATION_CLASS = (
+            "applications.ftp_integration.ldap.OpenLDAPIntegration"
+        )
+        connection = mocker.patch(
+            "applications.ftp_integration.ldap.ReconnectLDAPObject"
+        ).return_value
+        calls = []
+
+        def send(method_name):
+            def method(dn, *args):
+                calls.append((method_name, dn))
+                return len(calls)
+
+            return method
+
+        for method_name in ("add", "modify", "delete", "passwd"):
+            getattr(connection, method_name).side_effect = send(method_name)
+
+        def result3(msgid):
+            if calls[msgid - 1] == ("add", f"CN=C2@domain.com,{settings.USERS_DN}"):
+                raise ldap.ALREADY_EXISTS
+            return ldap.RES_ADD, [], msgid, []
+
+        connection.result3.side_effect = result3
+
+        def search_s(base, scope, filterstr, attrlist):
+            for user_id in ("C2@domain.com", "C3@domain.com"):
+                if user_id in filterstr:
+                    return [(f"CN={user_id},{settings.USERS_DN}", {"sn": [b"OLD"]})]
+            return []
+
+        connection.search_s.side_effect = search_s
+
+        service = FTPIntegrationService()
+        today = date.today()
+        for user_id in ("C1@domain.com", "C2@domain.com", "bad@domain.com"):
+            UserOperation.objects.create(
+                type_operation=UserOperation.TypeChoices.CREATION,
+                user_id=user_id,
+                first_name="Foo",
+                last_name="Bar",
+                date_for_change=today,
+            )
+        for user_id in ("C3@domain.com", "C4@domain.com"):
+            UserOperation.objects.create(
+                type_operation=UserOperation.TypeChoices.DELETION,
+                user_id=user_id,
+                date_for_change=today - timedelta(days=1),
+            )
+
+        with caplog.at_level(logging.WARNING):
+            service.process_db_operation()
+
+        assert sorted(calls) == sorted(
+            [
+                ("add", f"CN=C1@domain.com,{settings.USERS_DN}"),
+                ("add", f"CN=C2@domain.com,{settings.USERS_DN}"),
+                ("passwd", f"CN=C1@domain.com,{settings.USERS_DN}"),
+                ("modify", f"CN=C2@domain.com,{settings.USERS_DN}"),
+                ("delete", f"CN=C3@domain.com,{settings.USERS_DN}"),
+            ]
+        )
+        assert not connection.add_s.called
+        assert len(caplog.messages) == 3
+        assert "bad@domain.com" in caplog.records[0].message
+        assert caplog.records[0].levelno == logging.ERROR
+        assert list(UserOperation.objects.values_list("user_id", "status")) == [
+            ("bad@domain.com", UserOperation.StatusChoices.FAILED)
+        ]
+
+    def test_process_db_operation_parallel(
+        self, db, mocker: MockerFixture, caplog: LogCaptureFixture, settings
+    ):
+        settings.LDAP_POOL_SIZE = 3
+        service = FTPIntegrationService()
+        mocker.patch.object(
+            service,
+            "ldap_integration",
+        )
+        mock_create_ldap_user = mocker.patch.object(
+            service.ldap_integration,
+            "create_ldap_user",
+            side_effect=[None, ValueError, ldap.ALREADY_EXISTS],
+        )
+        mock_update_ldap_user = mocker.patch.object(
+            service.ldap_integration, "update_ldap_user"
+        )
+        mock_delete_ldap_user = mocker.patch.object(
+            service.ldap_integration, "delete_ldap_user"
+        )
+        today = date.today()
+        for index in range(3):
+            UserOperation.objects.create(
+                type_operation=UserOperation.TypeChoices.CREATION,
+                user_id=f"0{index}@domain.com",
+                date_for_change=today,
+            )
+        UserOperation.objects.create(
+            type_operation=UserOperation.TypeChoices.DELETION,
+            user_id="00@domain.com",
+            date_for_change=today - timedelta(days=1),
+        )
+
+        with caplog.at_level(logging.WARNING):
+            service.process_db_operation()
+
+        assert mock_create_ldap_user.call_count == 3
+        mock_update_ldap_user.assert_called_once()
+        mock_delete_ldap_user.assert_called_once_with(user_id="00@domain.com")
+        assert service.ldap_integration.checkout_connection.call_count == 4
+        assert len(caplog.messages) == 2
+        assert UserOperation.objects.get().last_error == "ValueError: "
+
+    @pytest.mark.parametrize("pool_size", [1, 3])
+    def test_process_db_operation_retry(
+        self, db, mocker: MockerFixture, settings, pool_size
+    ):
+        settings.LDAP_POOL_SIZE = pool_size
+        settings.OPERATION_RETRY_DELAY = 60
+        settings.OPERATION_MAX_ATTEMPTS = 3
+        service = FTPIntegrationService()
+        service.operation_chunk_size = 2
+        mocker.patch.object(service, "ldap_integration")
+
+        def create_ldap_user(user_id, **kwargs):
+            if user_id == "02@domain.com":
+                raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+
+        mock_create_ldap_user = mocker.patch.object(
+            service.ldap_integration,
+            "create_ldap_user",
+            side_effect=create_ldap_user,
+        )
+        today = date.today()
+        for index in range(5):
+            UserOperation.objects.create(
+                type_operation=UserOperation.TypeChoices.CREATION,
+                user_id=f"0{index}@domain.com",
+                # read by date first
+                date_for_change=today - timedelta(days=index % 2),
+            )
+
+        service.process_db_operation()
+        # operations are deleted once their chunk is done, except the failed one
+        assert mock_create_ldap_user.call_count == 5
+        operation = UserOperation.objects.get()
+        assert operation.user_id == "02@domain.com"
+        assert operation.status == UserOperation.StatusChoices.FAILED
+        assert operation.attempts == 1
+        assert operation.last_error.startswith("SERVER_DOWN")
+        assert operation.next_attempt_at > timezone.now() + timedelta(seconds=50)
+
+        # not retried before its delay
+        service.process_db_operation()
+        assert mock_create_ldap_user.call_count == 5
+
+        # delay doubled after each attempt, then given up
+        for attempts, delay in ((2, 120), (3, None)):
+            UserOperation.objects.update(next_attempt_at=timezone.now())
+            service.process_db_operation()
+            operation.refresh_from_db()
+            assert operation.attempts == attempts
+            if delay is None:
+                assert operation.next_attempt_at is None
+            else:
+                assert operation.next_attempt_at > timezone.now() + timedelta(
+                    seconds=delay - 10
+                )
+        service.process_db_operation()
+        assert mock_create_ldap_user.call_count == 7
+
+        # scheduled again from a file
+        service.process_creation(
+            "02@domain.com",
+            PersonRecord(
+                first_name="A",
+                last_name="B",
+                email="",
+                date_begin="01/01/2023",
+            ),
+        )
+        operation.refresh_from_db()
+        assert operation.status == UserOperation.StatusChoices.PENDING
+        assert operation.attempts == 0
+
+    def test_process_db_operation_interrupted(self, db, mocker: MockerFixture):
+        service = FTPIntegrationService()
+        mocker.patch.object(service, "ldap_integration")
+        service.ldap_integration.defers_password_resets = False
+
+        def create_ldap_user(user_id, **kwargs):
+            if user_id == "02@domain.com":
+                raise RuntimeError("stopped")
+            if user_id == "01@domain.com":
+                raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+
+        mock_create_ldap_user = mocker.patch.object(
+            service.ldap_integration,
+            "create_ldap_user",
+            side_effect=create_ldap_user,
+        )
+        for index in range(4):
+            UserOperation.objects.create(
+                type_operation=UserOperation.TypeChoices.CREATION,
+                user_id=f"0{index}@domain.com",
+                date_for_change=date.today(),
+            )
+
+        with pytest.raises(RuntimeError):
+            service.process_db_operation()
+        # operations processed before the run stopped are saved, without waiting for the end of their chunk
+        assert mock_create_ldap_user.call_count == 3
+        assert sorted(
+            UserOperation.objects.values_list("user_id", "status", "attempts")
+        ) == [
+            ("01@domain.com", "F", 1),
+            ("02@domain.com", "P", 0),
+            ("03@domain.com", "P", 0),
+        ]
+
+        mock_create_ldap_user.side_effect = None
+        service.process_db_operation()
+        # the next run only processes the remaining ones
+        assert [
+            call.kwargs["user_id"] for call in mock_create_ldap_user.call_args_list[3:]
+        ] == ["02@domain.com", "03@domain.com"]
+        assert list(UserOperation.objects.values_list("user_id", flat=True)) == [
+            "01@domain.com"
+        ]
+
+    def test_process_db_operation_password_reset(
+        self, db, mocker: MockerFixture, settings
+    ):
+        settings.LDAP_INTEGRATION_CLASS = (
+            "applications.ftp_integration.ldap.ActiveDirectoryIntegration"
+        )
+        settings.LDAP_TLS = False
+        settings.AD_PASSWORD_BATCH_SIZE = 10
+        connection = mocker.patch(
+            "applications.ftp_integration.ldap.ReconnectLDAPObject"
+        ).return_value
+        connection.search_s.return_value = []
+        mock_run = mocker.patch(
+            "applications.ftp_integration.utils.subprocess.run",
+            return_value=mocker.Mock(
+                returncode=0, stdout=b"OK 0\nKO 1 Access denied\n"
+            ),
+        )
+        service = FTPIntegrationService()
+        for index in range(2):
+            UserOperation.objects.create(
+                type_operation=UserOperation.TypeChoices.CREATION,
+                user_id=f"0{index}@domain.com",
+                first_name="Jean",
+                last_name=f"Martin{index}",
+                date_for_change=date.today(),
+            )
+
+        service.process_db_operation()
+        # both passwords are set in a single batch, before completing the operations
+        mock_run.assert_called_once()
+        connection.modify_s.assert_called_once()
+        # the user without password is kept disabled, its operation is retried
+        operation = UserOperation.objects.get()
+        assert operation.user_id == "01@domain.com"
+        assert operation.status == UserOperation.StatusChoices.FAILED
+        assert operation.last_error == "PasswordResetError: Access denied"
+
+        dn = f"CN=Jean MARTIN1,{settings.USERS_DN}"
+        connection.search_s.return_value = [
+            (
+                dn,
+                {
+                    "userPrincipalName": [b"01@domain.com"],
+                    "sAMAccountName": [b"jmartin1"],
+                },
+            )
+        ]
+        mock_run.return_value.stdout = b"OK 0\n"
+        UserOperation.objects.update(next_attempt_at=timezone.now())
+        service.process_db_operation()
+        # the existing user gets its password and is activated
+        assert mock_run.call_count == 2
+        assert dn in mock_run.call_args.kwargs["input"].decode()
+        dn_modified, modlist = connection.modify_s.call_args.args
+        assert dn_modified == dn
+        assert "userAccountControl" in [attribute for _, attribute, _ in modlist]
+        assert not UserOperation.objects.exists()
+
+    def test_process_db_operation_openldap_password_reset(
+        self, db, mocker: MockerFixture, settings
+    ):
+        settings.LDAP_INTEGRATION_CLASS = (
+            "applications.ftp_integration.ldap.OpenLDAPIntegration"
+        )
+        connection = mocker.patch(
+            "applications.ftp_integration.ldap.ReconnectLDAPObject"
+        ).return_value
+        connection.passwd_s.side_effect = ldap.LDAPError("Access denied")
+        service = FTPIntegrationService()
+        UserOperation.objects.create(
+            type_operation=UserOperation.TypeChoices.CREATION,
+            user_id="C1@domain.com",
+            first_name="Jean",
+            last_name="Martin",
+            date_for_change=date.today(),
+        )
+
+        service.process_db_operation()
+        operation = UserOperation.objects.get()
+        assert operation.status == UserOperation.StatusChoices.FAILED
+        assert operation.last_error.startswith("PasswordResetError: ")
+
+        # created by the failed attempt, only its password is set again
+        dn = f"CN=C1@domain.com,{settings.USERS_DN}"
+        connection.add_s.side_effect = ldap.ALREADY_EXISTS
+        connection.passwd_s.side_effect = None
+        connection.search_s.return_value = [(dn, {"uid": [b"C1@domain.com"]})]
+        UserOperation.objects.update(next_attempt_at=timezone.now())
+        service.process_db_operation()
+        assert connection.passwd_s.call_count == 2
+        assert connection.passwd_s.call_args.args == (dn, None, "C1@domain.com")
+        assert not UserOperation.objects.exists()
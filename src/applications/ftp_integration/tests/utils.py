@@ -0,0 +1,241 @@
+import gzip
+import io
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import date
+from ftplib import FTP, error_perm
+
+import pytest
+import zstandard
+from pytest_mock import MockerFixture
+
+from applications.ftp_integration.utils import (
+    ChunkStream,
+    CSVRowDecoder,
+    DateParser,
+    DeflateFTP,
+    KeyOrderedExecutor,
+    OffsetLineReader,
+    decompressed,
+    launch_ssh_powershell_batch,
+    powershell_quote,
+)
+
+
+class TestKeyOrderedExecutor:
+    def test_same_key_ordering(self):
+        results = []
+        lock = threading.Lock()
+
+        def task(key, index):
+            # later tasks of a key would overtake the first ones without ordering
+            time.sleep(0.01 * (5 - index))
+            with lock:
+                results.append((key, index))
+
+        with KeyOrderedExecutor(4) as executor:
+            for index in range(5):
+                for key in ("a", "b"):
+                    executor.submit(key, task, key, index)
+
+        for key in ("a", "b"):
+            assert [index for result_key, index in results if result_key == key] == [
+                0,
+                1,
+                2,
+                3,
+                4,
+            ]
+
+    def test_error(self):
+        def task():
+            raise ValueError("task error")
+
+        with pytest.raises(ValueError):
+            with KeyOrderedExecutor(2) as executor:
+                executor.submit("a", task)
+                executor.submit("a", lambda: None)
+
+
+class TestSSH:
+    def test_powershell_quote(self):
+        assert powershell_quote("CN=O'Neil $name") == "'CN=O''Neil $name'"
+
+    def test_launch_ssh_powershell_batch(self, mocker: MockerFixture):
+        mock_run = mocker.patch(
+            "applications.ftp_integration.utils.subprocess.run",
+            return_value=mocker.Mock(
+                returncode=0,
+                stdout=b"OK 0\nsome output\nKO 1 Access denied\nOK 9\n",
+                stderr=b"",
+            ),
+        )
+        errors = launch_ssh_powershell_batch(
+            ["Get-ADUser 1", "Get-ADUser 2", "Get-ADUser 3"], "id_ad_server"
+        )
+        assert errors[0] is None
+        assert errors[1] == "Access denied"
+        assert errors[2].startswith("no result")
+        mock_run.assert_called_once()
+        script = mock_run.call_args.kwargs["input"].decode().splitlines()
+        assert len(script) == 4
+        assert script[1].startswith("try { Get-ADUser 1; Write-Output 'OK 0' }")
+
+
+class TestCSVRowDecoder:
+    def test_decode(self):
+        decoder = CSVRowDecoder(
+            ["Unused", "Nom", "Identifiant", "Nom", "Unused"],
+            {"Identifiant": "user_id", "Nom": "last_name"},
+        )
+        assert not decoder.missing_headers
+        record = decoder(["u", "A", "1", "B", "u"])
+        assert record.user_id == "1"
+        # the last duplicated column wins
+        assert record._asdict() == {"user_id": "1", "last_name": "B"}
+        assert decoder(["u", "A", "1"])._asdict() == {"user_id": "1", "last_name": None}
+
+    def test_missing_headers(self):
+        decoder = CSVRowDecoder(
+            ["Nom"], {"Identifiant": "user_id", "Nom": "last_name", "E-mail": "email"}
+        )
+        assert decoder.missing_headers == ["Identifiant", "E-mail"]
+        assert CSVRowDecoder(["Nom"], {"Nom": "last_name"})(["A"]) == ("A",)
+
+    def test_record_class(self):
+        Record = namedtuple("Record", ["last_name", "user_id", "email"], defaults=[""])
+        decoder = CSVRowDecoder(
+            ["Identifiant", "Nom"],
+            {"Identifiant": "user_id", "Nom": "last_name"},
+            Record,
+        )
+        # columns are decoded in the order of the record fields, those not mapped keep their default
+        assert decoder(["1", "A"]) == Record(last_name="A", user_id="1", email="")
+
+
+class TestDateParser:
+    def test_parse(self):
+        date_parser = DateParser("%d/%m/%Y")
+        assert date_parser.parse("31/12/2023") == date(2023, 12, 31)
+        assert date_parser.parse("31/12/2023") == date(2023, 12, 31)
+        assert date_parser.parse.cache_info().hits == 1
+        # same values accepted as strptime
+        assert date_parser.parse("1/2/2023") == date(2023, 2, 1)
+        for value in ("31/02/2023", "2023-01-01", "0a/01/2023", "", "01/01/2023 "):
+            with pytest.raises(ValueError):
+                date_parser.parse(value)
+
+    def test_other_format(self):
+        assert DateParser("%Y-%m-%d").parse("2023-01-31") == date(2023, 1, 31)
+
+
+class TestChunkStream:
+    def test_read_lines(self):
+        stream = ChunkStream("hiring1", max_chunks=1)
+        content = "\ufeffNom;Prénom\r\nÉlise;Bar\n".encode()
+
+        def write():
+            # chunks cut in the middle of the BOM, a line ending and a character
+            for start, end in ((0, 2), (2, 13), (13, 16), (16, len(content))):
+                stream.put(content[start:end])
+            stream.end()
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        with io.TextIOWrapper(io.BufferedReader(stream), encoding="utf-8-sig") as f:
+            assert f.name == "hiring1"
+            assert list(f) == ["Nom;Prénom\n", "Élise;Bar\n"]
+        thread.join()
+
+    def test_error(self):
+        stream = ChunkStream("hiring1", max_chunks=1)
+        stream.put(b"Nom\n")
+        with pytest.raises(ValueError):
+            # the reader is closed while the writer waits
+            threading.Timer(0.2, stream.close).start()
+            stream.put(b"A\n")
+
+        stream = ChunkStream("hiring1")
+        stream.put(b"Nom\n")
+        stream.end(EOFError())
+        with io.TextIOWrapper(io.BufferedReader(stream)) as f:
+            with pytest.raises(EOFError):
+                f.read()
+
+
+class TestCompression:
+    @pytest.mark.parametrize(
+        "file_name, compress",
+        [("hiring1.csv.gz", gzip.compress), ("hiring1.csv.zst", zstandard.compress)],
+    )
+    def test_decompressed(self, tmp_path, file_name, compress):
+        (tmp_path / file_name).write_bytes(compress(b"Nom\nA\nB\n"))
+        with decompressed((tmp_path / file_name).open("rb")) as f:
+            reader = OffsetLineReader(f)
+            assert reader.name == str(tmp_path / file_name)
+            assert next(reader) == "Nom\n"
+            offset = reader.offset
+        with decompressed((tmp_path / file_name).open("rb")) as f:
+            reader = OffsetLineReader(f)
+            reader.seek(offset)
+            assert list(reader) == ["A\n", "B\n"]
+
+        (tmp_path / "hiring1").write_bytes(b"Nom\n")
+        with (tmp_path / "hiring1").open("rb") as f:
+            assert decompressed(f) is f
+
+    def test_mode_z(self, mocker: MockerFixture):
+        content = b"Nom\nA\n" * 100
+        compressed = zlib.compress(content)
+        mock_retrbinary = mocker.patch.object(
+            FTP,
+            "retrbinary",
+            side_effect=lambda cmd, callback, blocksize, rest: [
+                callback(compressed[start : start + 10])
+                for start in range(0, len(compressed), 10)
+            ],
+        )
+        mock_voidcmd = mocker.patch.object(FTP, "voidcmd")
+        ftp = DeflateFTP()
+        chunks = []
+        ftp.retrbinary("RETR hiring1", chunks.append)
+        assert b"".join(chunks) == content
+        assert [call.args[0] for call in mock_voidcmd.call_args_list] == [
+            "MODE Z",
+            "MODE S",
+        ]
+
+        # stream mode is restored after a failed transfer
+        mock_voidcmd.reset_mock()
+        mock_retrbinary.side_effect = EOFError
+        with pytest.raises(EOFError):
+            ftp.retrbinary("RETR hiring1", chunks.append)
+        assert [call.args[0] for call in mock_voidcmd.call_args_list] == [
+            "MODE Z",
+            "MODE S",
+        ]
+
+        # restarted transfers are kept in stream mode
+        mock_voidcmd.reset_mock()
+        mock_retrbinary.side_effect = lambda cmd, callback, blocksize, rest: callback(
+            content[rest:]
+        )
+        chunks = []
+        ftp.retrbinary("RETR hiring1", chunks.append, rest=6)
+        assert b"".join(chunks) == content[6:]
+        mock_voidcmd.assert_not_called()
+
+        # not supported by the server, not asked again
+        ftp = DeflateFTP()
+        mock_voidcmd.reset_mock()
+        mock_voidcmd.side_effect = error_perm("504 Command not implemented")
+        mock_retrbinary.side_effect = lambda cmd, callback, blocksize, rest: callback(
+            content
+        )
+        for _ in range(2):
+            chunks = []
+            ftp.retrbinary("RETR hiring1", chunks.append)
+            assert b"".join(chunks) == content
+        assert mock_voidcmd.call_count == 1
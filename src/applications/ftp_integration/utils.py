@@ -1,11 +1,26 @@
+import codecs
+import gzip
+import io
 import logging
+import queue
 import subprocess
-from ftplib import FTP_TLS
+import zlib
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import date, datetime
+from ftplib import FTP, FTP_TLS, error_perm
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from typing import BinaryIO, Callable, Generator, Hashable, Iterable, TypeVar
 
+import zstandard
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def launch_ssh_command(cmd: str, key_file_name) -> None:
     cmd = f"ssh {settings.SSH_USER}@{settings.LDAP_HOST} -o StrictHostKeyChecking=no -i /.ssh/{key_file_name} '{cmd}' "
@@ -22,7 +37,298 @@ def launch_ssh_command(cmd: str, key_file_name) -> None:
         logger.info(f"command error result: {result.returncode} {result.stderr}")
 
 
-class SessionReuseFTP_TLS(FTP_TLS):
+def powershell_quote(value: str) -> str:
+    # single quoted strings are not interpolated, only quotes need to be escaped
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def launch_ssh_powershell_batch(commands: list[str], key_file_name) -> list[str | None]:
+    """
+    Run PowerShell commands through a single SSH session, each one independently of the others.
+    Returns the error message of each command, None for those that succeeded
+    """
+    script = ["$ErrorActionPreference = 'Stop'"]
+    for index, command in enumerate(commands):
+        # one line per command, PowerShell reading stdin runs complete lines only
+        script.append(
+            f"try {{ {command}; Write-Output 'OK {index}' }} "
+            f'catch {{ Write-Output "KO {index} $($_.Exception.Message)" }}'
+        )
+    cmd = f"ssh {settings.SSH_USER}@{settings.LDAP_HOST} -o StrictHostKeyChecking=no -i /.ssh/{key_file_name} 'powershell -NoProfile -NonInteractive -Command -' "
+    logger.debug(f"run {len(commands)} commands: {cmd}")
+    result: subprocess.CompletedProcess = subprocess.run(
+        cmd, input="\n".join(script + [""]).encode(), capture_output=True, shell=True
+    )
+    logger.debug(f"command result: {result.returncode} {result.stdout}")
+    if result.returncode != 0:
+        logger.error(f"command error result: {result.returncode} {result.stderr}")
+
+    errors: list[str | None] = [
+        f"no result, exit code {result.returncode}: {result.stderr.decode(errors='replace')}"
+    ] * len(commands)
+    for line in result.stdout.decode(errors="replace").splitlines():
+        status, _, message = line.partition(" ")
+        index, _, message = message.partition(" ")
+        if status not in ("OK", "KO") or not index.isdigit():
+            continue
+        if int(index) < len(commands):
+            errors[int(index)] = None if status == "OK" else message
+    return errors
+
+
+def chunked(iterable: Iterable[T], size: int) -> Generator[list[T], None, None]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class CSVRowDecoder:
+    """
+    Decode rows read by csv.reader into namedtuples of the columns named by `mapping`
+    (header -> field name), resolving the column indices once from the header row.
+    `record_class` is the namedtuple class to decode into, by default one is built from the mapped field names.
+    Its fields not mapped keep their default value.
+    Like csv.DictReader, the last column wins when a header is duplicated
+    and missing trailing values are None
+    """
+
+    def __init__(
+        self,
+        header: list[str],
+        mapping: dict[str, str],
+        record_class: type[tuple] | None = None,
+    ):
+        header_indices = {name: index for index, name in enumerate(header)}
+        self.missing_headers = [name for name in mapping if name not in header_indices]
+        self.record_class = record_class or namedtuple("Record", mapping.values())
+        names = {field: name for name, field in mapping.items()}
+        fields = [field for field in self.record_class._fields if field in names]
+        indices = [header_indices.get(names[field], 0) for field in fields]
+        self.width = max(indices, default=-1) + 1
+        if len(indices) == 1:
+            self.get_values = lambda row: (row[indices[0]],)
+        else:
+            self.get_values = itemgetter(*indices)
+        if len(fields) == len(self.record_class._fields):
+            self.make_record = self.record_class._make
+        else:
+            self.make_record = lambda values: self.record_class(
+                **dict(zip(fields, values))
+            )
+
+    def __call__(self, row: list[str]) -> tuple:
+        if len(row) < self.width:
+            row = row + [None] * (self.width - len(row))
+        return self.make_record(self.get_values(row))
+
+
+class DateParser:
+    """
+    Parse dates of a strptime format, remembering the last `cache_size` values parsed
+    as exports contain few distinct dates. "%d/%m/%Y" dates are parsed without strptime
+    """
+
+    def __init__(self, date_format: str, cache_size: int = 1024):
+        self.date_format = date_format
+        self.parse: Callable[[str], date] = lru_cache(maxsize=cache_size)(
+            self.parse_uncached
+        )
+
+    def parse_uncached(self, value: str) -> date:
+        if (
+            self.date_format == "%d/%m/%Y"
+            and len(value) == 10
+            and value[2] == value[5] == "/"
+        ):
+            day, month, year = value[:2], value[3:5], value[6:]
+            if (day + month + year).isascii() and (day + month + year).isdigit():
+                return date(int(year), int(month), int(day))
+        # other formats and values strptime may still accept, like "1/2/2023"
+        return datetime.strptime(value, self.date_format).date()
+
+
+class OffsetLineReader:
+    """
+    Iterate over the decoded lines of a binary file, skipping a leading UTF-8 BOM.
+    `offset` is the byte offset of the end of the last line returned, so that reading can resume from there with seek
+    """
+
+    def __init__(self, file: BinaryIO, encoding: str = "utf-8"):
+        self.file = file
+        self.name = file.name
+        self.encoding = encoding
+        self.offset = file.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self.file.readline()
+        if not line:
+            raise StopIteration
+        start = self.offset
+        self.offset += len(line)
+        if start == 0 and line.startswith(codecs.BOM_UTF8):
+            line = line[len(codecs.BOM_UTF8) :]
+        return line.decode(self.encoding)
+
+    def seek(self, offset: int):
+        self.file.seek(offset)
+        self.offset = offset
+
+
+class ChunkStream(io.RawIOBase):
+    """
+    Readable stream of the bytes chunks put by another thread, e.g. from a retrbinary callback.
+    `put` blocks while `max_chunks` chunks are waiting to be read, and raises once the stream is closed
+    so that the reading side can stop the writing one
+    """
+
+    def __init__(self, name: str, max_chunks: int = 64):
+        super().__init__()
+        self.name = name
+        self.chunks = queue.Queue(max_chunks)
+        self.remaining = memoryview(b"")
+        self.finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.remaining and not self.finished:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.finished = True
+            elif isinstance(chunk, BaseException):
+                self.finished = True
+                raise chunk
+            else:
+                self.remaining = memoryview(chunk)
+        size = min(len(buffer), len(self.remaining))
+        buffer[:size] = self.remaining[:size]
+        self.remaining = self.remaining[size:]
+        return size
+
+    def drain(self):
+        """
+        Read until the end of the stream, without keeping what is read
+        """
+        buffer = bytearray(io.DEFAULT_BUFFER_SIZE)
+        while self.readinto(buffer):
+            pass
+
+    def put(self, chunk: bytes):
+        if not self._put(chunk):
+            raise ValueError(f"stream {self.name} closed by the reader")
+
+    def end(self, error: BaseException | None = None):
+        """
+        Mark the end of the stream, the error is raised by the reader once the previous chunks are read
+        """
+        self._put(error)
+
+    def _put(self, item: bytes | BaseException | None) -> bool:
+        while not self.closed:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class DecompressedReader(io.RawIOBase):
+    """
+    Decompressed content of a binary file, with gzip or zstandard according to the extension of its name.
+    Positions are the ones of the decompressed content, .zst files can only be read forward
+    """
+
+    compressed_extensions = (".gz", ".zst")
+
+    def __init__(self, file: BinaryIO, name: str | None = None):
+        super().__init__()
+        self.file = file
+        self.name = name or file.name
+        if self.name.endswith(".gz"):
+            self.reader = gzip.GzipFile(fileobj=file, mode="rb")
+        elif self.name.endswith(".zst"):
+            self.reader = zstandard.ZstdDecompressor().stream_reader(file)
+        else:
+            raise ValueError(f"File {self.name} is not compressed")
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self.reader.readinto(buffer)
+
+    def tell(self) -> int:
+        return self.reader.tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.reader.seek(offset, whence)
+
+    def close(self):
+        if not self.closed:
+            self.reader.close()
+            self.file.close()
+        super().close()
+
+
+def decompressed(file: BinaryIO, name: str | None = None) -> BinaryIO:
+    """
+    Buffered decompressed content of .gz and .zst files, other files are returned as they are
+    """
+    if (name or file.name).endswith(DecompressedReader.compressed_extensions):
+        return io.BufferedReader(DecompressedReader(file, name))
+    return file
+
+
+class DeflateTransferMixin:
+    """
+    Retrieve files with MODE Z, compressing the transferred data with deflate, when the server supports it.
+    Other transfers like listings, and retrievals restarted at an offset, are kept in stream mode
+    """
+
+    mode_z_supported: bool | None = None
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        if rest is not None:
+            # the restart offset of a compressed transfer is not defined the same way by every server
+            return super().retrbinary(cmd, callback, blocksize, rest)
+        if self.mode_z_supported is not False:
+            try:
+                self.voidcmd("MODE Z")
+                self.mode_z_supported = True
+            except error_perm:
+                self.mode_z_supported = False
+        if not self.mode_z_supported:
+            return super().retrbinary(cmd, callback, blocksize, rest)
+
+        decompressor = zlib.decompressobj()
+
+        def write(data: bytes):
+            if chunk := decompressor.decompress(data):
+                callback(chunk)
+
+        try:
+            response = super().retrbinary(cmd, write, blocksize, rest)
+            if chunk := decompressor.flush():
+                callback(chunk)
+        finally:
+            # the following commands of the session are in stream mode, even after a failed transfer
+            self.voidcmd("MODE S")
+        return response
+
+
+class DeflateFTP(DeflateTransferMixin, FTP):
+    pass
+
+
+class SessionReuseFTP_TLS(DeflateTransferMixin, FTP_TLS):
     """
     Explicit FTPS, with shared TLS session
     Using solution taken from https://stackoverflow.com/a/43301750/7438175
@@ -36,3 +342,44 @@ class SessionReuseFTP_TLS(FTP_TLS):
                 conn, server_hostname=self.host, session=self.sock.session
             )  # passing the session is the fix
         return conn, size
+
+
+class KeyOrderedExecutor:
+    """
+    Thread pool running tasks concurrently,
+    except tasks sharing the same key which are run one after the other in submission order.
+    The first exception raised by a task is raised again when leaving the context manager
+    """
+
+    def __init__(self, max_workers: int):
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.last_futures: dict[Hashable, Future] = {}
+        self.errors: list[BaseException] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.executor.shutdown(wait=True)
+        self.last_futures.clear()
+        if exc_type is None and self.errors:
+            raise self.errors[0]
+
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> Future:
+        previous = self.last_futures.get(key)
+
+        def run():
+            if previous is not None:
+                # tasks are started in submission order,
+                # so the previous one is already running in another thread or done
+                wait([previous])
+            return fn(*args, **kwargs)
+
+        future = self.executor.submit(run)
+        future.add_done_callback(self._collect_error)
+        self.last_futures[key] = future
+        return future
+
+    def _collect_error(self, future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            self.errors.append(future.exception())
@@ -2,6 +2,7 @@ from .base import *
 
 FTP_FOLDER = BASE_DIR / "data" / "ftp"
 FTP_PROCESSED_FOLDER = FTP_FOLDER / "processed/%Y/%m/"
+FTP_ARCHIVE_FOLDER = FTP_FOLDER / "archive"
 
 FTP_URL = env.str(
     "FTP_URL"
@@ -11,3 +12,23 @@ __user, __pwd = __credentials.split(":", 1)
 FTP_CONNEXION = {"host": __host, "user": __user, "passwd": __pwd}
 FTP_USE_TLS = env.bool("FTP_USE_TLS", default=True)
 FTP_CLEANUP_FILE = env.bool("FTP_CLEANUP_FILE", default=True)
+# number of scheduled operations parsed from files written with a single query, 0 to write each row on its own
+OPERATION_UPSERT_BATCH_SIZE = env.int("OPERATION_UPSERT_BATCH_SIZE", default=500)
+# read every pending file before processing their rows, so that each user is processed at most once per type of file
+FILE_COALESCE_ROWS = env.bool("FILE_COALESCE_ROWS", default=False)
+# only process employee update rows that changed since the last row applied for the same user
+FILE_EMPLOYEE_UPDATE_DELTA = env.bool("FILE_EMPLOYEE_UPDATE_DELTA", default=False)
+# number of processes decoding files in parallel, 1 to decode each file while processing its rows
+FILE_DECODE_WORKERS = env.int("FILE_DECODE_WORKERS", default=1)
+# number of rows processed between two checkpoints of the file progress, 0 to disable checkpoints
+FILE_CHECKPOINT_INTERVAL = env.int("FILE_CHECKPOINT_INTERVAL", default=0)
+# number of FTP connections downloading files in parallel
+FTP_DOWNLOAD_WORKERS = env.int("FTP_DOWNLOAD_WORKERS", default=1)
+# parse files while they are downloaded instead of once every file is downloaded
+FTP_STREAM_FILES = env.bool("FTP_STREAM_FILES", default=False)
+# archive processed files once per content in FTP_ARCHIVE_FOLDER, compressed with zstandard
+FILE_ARCHIVE_COMPRESSED = env.bool("FILE_ARCHIVE_COMPRESSED", default=False)
+# delay in seconds before retrying a failed scheduled operation, doubled after each attempt
+OPERATION_RETRY_DELAY = env.int("OPERATION_RETRY_DELAY", default=3600)
+# number of attempts of a scheduled operation before giving up, 0 to retry forever
+OPERATION_MAX_ATTEMPTS = env.int("OPERATION_MAX_ATTEMPTS", default=10)
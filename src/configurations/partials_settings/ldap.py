@@ -15,3 +15,20 @@ LDAP_INTEGRATION_CLASS = env.str(
     default="applications.ftp_integration.ldap.OpenLDAPIntegration",
 )
 SSH_USER = env.str("SSH_USER", default="Administrateur")
+# load every user of USERS_DN at connection instead of searching them one by one
+LDAP_USE_SNAPSHOT = env.bool("LDAP_USE_SNAPSHOT", default=False)
+# number of entries requested per page when iterating over a whole LDAP subtree
+LDAP_PAGE_SIZE = env.int("LDAP_PAGE_SIZE", default=500)
+# maximum number of asynchronous LDAP writes waiting for their result, 0 to write synchronously
+LDAP_PIPELINE_WINDOW = env.int("LDAP_PIPELINE_WINDOW", default=0)
+# number of bound connections used by worker threads to process scheduled operations and employee updates in parallel,
+# 1 to process them sequentially on a single connection
+LDAP_POOL_SIZE = env.int("LDAP_POOL_SIZE", default=1)
+# number of users looked for with a single LDAP search when processing files and deletions,
+# 0 to look for each user independently
+LDAP_LOOKUP_CHUNK_SIZE = env.int("LDAP_LOOKUP_CHUNK_SIZE", default=0)
+# number of ActiveDirectory passwords set through a single SSH session when LDAPS is not available,
+# 1 to set each password right after the user creation
+AD_PASSWORD_BATCH_SIZE = env.int("AD_PASSWORD_BATCH_SIZE", default=1)
+# latency in seconds of each request sent to the in-memory LDAP used for tests and benchmarks
+LDAP_IN_MEMORY_LATENCY = env.float("LDAP_IN_MEMORY_LATENCY", default=0)